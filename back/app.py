@@ -18,6 +18,16 @@ from config import MasterConfig, ReplicaConfig
 from routes.users import users_bp
 from routes.notes import notes_bp
 from routes.sync import sync_bp
+from routes.admin import admin_bp
+from routes.events import events_bp
+from services.sync_service import SyncService
+from services.replica_service import ReplicaService
+from services.merkle_service import MerkleService
+from services.consistency_service import ConsistencyService
+from services.event_broker import EventBroker
+from services.feed_cache import FeedCache
+from services.note_service import NoteService
+from services.lock_service import LockService
 
 def create_app(config_mode=None):
     app = Flask(__name__)
@@ -46,8 +56,14 @@ def create_app(config_mode=None):
     app.register_blueprint(users_bp)
     app.register_blueprint(notes_bp)
     app.register_blueprint(sync_bp)
+    app.register_blueprint(admin_bp)
+    app.register_blueprint(events_bp)
 
     app.config['SERVER_MODE'] = server_mode
+    ConsistencyService.init_app(app)
+    FeedCache.init_app(app)
+    EventBroker.init_app(app)
+    LockService.init_app(app)
 
     return app
 
@@ -59,6 +75,11 @@ limiter = Limiter(
     default_limits=["200 per day", "50 per hour"],
     storage_uri="memory://"
 )
+# Replication traffic comes from the master, metrics from the scraper, not from end users
+limiter.exempt(sync_bp)
+limiter.exempt(admin_bp)
+# One long request per client, reopened after each disconnect
+limiter.exempt(events_bp)
 
 @app.after_request
 def set_security_headers(response):
@@ -104,15 +125,41 @@ def reset_db():
     with app.app_context():
         db.drop_all()
         db.create_all()
+    FeedCache.invalidate_all()
+    LockService.init_app(app)
+
+def start_background_workers():
+    if app.config['SERVER_MODE'] == 'master':
+        SyncService.start_worker(app)
+        MerkleService.start_worker(app)
+        LockService.start_worker(app)
+    else:
+        ReplicaService.start_worker(app)
 
-if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5000))
-
+def prepare_database():
     with app.app_context():
-        db.drop_all()  # To review later          
+        # Keep existing data: replicas resume from their last applied LSN
         db.create_all()
+        NoteService.ensure_search_index()
+        NoteService.ensure_note_versions()
+        NoteService.ensure_change_tracking()
+        LockService.ensure_lock_leases()
         print("Database tables created.")
 
         setup_logging()
+
+    if not app.config['SYNC_TOKEN']:
+        app.logger.error("SYNC_TOKEN is not set: /api/sync/* refuses every call and replication "
+                         "is stopped. Set the same value on the master and the replicas (see .env.example)")
+
+# Development server: one thread per request, so every open /api/events
+# stream holds a thread. serve.py runs the app under gevent instead.
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 5000))
+
+    prepare_database()
     
+    # The debug reloader re-runs this script in the child process that serves requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
     app.run(debug=True, port=port)
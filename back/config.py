@@ -11,6 +11,88 @@ class Config:
     JWT_COOKIE_DOMAIN = None
 
     SERVER_MODE = os.environ.get('SERVER_MODE', 'master')
+
+    # Notes listings: page size when ?limit= is not given, and its maximum
+    NOTES_PAGE_SIZE = int(os.environ.get('NOTES_PAGE_SIZE', 50))
+    NOTES_MAX_PAGE_SIZE = int(os.environ.get('NOTES_MAX_PAGE_SIZE', 200))
+    # Characters of content in the "preview" field of summary listings
+    NOTES_PREVIEW_LENGTH = int(os.environ.get('NOTES_PREVIEW_LENGTH', 200))
+    # Most ids accepted by POST /api/notes/batch-get
+    NOTES_BATCH_MAX_IDS = int(os.environ.get('NOTES_BATCH_MAX_IDS', 100))
+    # Most notes accepted by POST /api/notes/bulk
+    NOTES_BULK_MAX_ITEMS = int(os.environ.get('NOTES_BULK_MAX_ITEMS', 1000))
+    # Pages of the public notes feed kept in memory (0 disables), and for how long
+    PUBLIC_FEED_CACHE_SIZE = int(os.environ.get('PUBLIC_FEED_CACHE_SIZE', 256))
+    PUBLIC_FEED_CACHE_TTL = float(os.environ.get('PUBLIC_FEED_CACHE_TTL', 30))
+    # Event stream: events a client may fall behind before it is told to resync,
+    # events kept for clients reconnecting with Last-Event-ID, and the keep-alive interval
+    EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))
+    EVENTS_BACKLOG_SIZE = int(os.environ.get('EVENTS_BACKLOG_SIZE', 1000))
+    EVENTS_HEARTBEAT_SECONDS = float(os.environ.get('EVENTS_HEARTBEAT_SECONDS', 15))
+
+    # Edit locks are leases renewed by the editor; the master frees expired
+    # ones every LOCK_REAPER_INTERVAL_SECONDS, LOCK_REAPER_BATCH_SIZE per statement
+    LOCK_LEASE_SECONDS = float(os.environ.get('LOCK_LEASE_SECONDS', 300))
+    LOCK_REAPER_INTERVAL_SECONDS = float(os.environ.get('LOCK_REAPER_INTERVAL_SECONDS', 30))
+    LOCK_REAPER_BATCH_SIZE = int(os.environ.get('LOCK_REAPER_BATCH_SIZE', 500))
+    # "database" (default) or "memory": the master then holds the leases in an
+    # in-process table of LOCK_TABLE_STRIPES stripes, copied to the locks table
+    # every LOCK_TABLE_FLUSH_SECONDS. Requires a single master process.
+    LOCK_MANAGER = os.environ.get('LOCK_MANAGER', 'database')
+    LOCK_TABLE_STRIPES = int(os.environ.get('LOCK_TABLE_STRIPES', 64))
+    LOCK_TABLE_FLUSH_SECONDS = float(os.environ.get('LOCK_TABLE_FLUSH_SECONDS', 1))
+    # POST /lock?wait=<seconds>: longest wait allowed, editors queued per note,
+    # and how often a waiter checks for locks released by another process
+    LOCK_WAIT_MAX_SECONDS = float(os.environ.get('LOCK_WAIT_MAX_SECONDS', 30))
+    LOCK_WAIT_QUEUE_SIZE = int(os.environ.get('LOCK_WAIT_QUEUE_SIZE', 16))
+    LOCK_WAIT_RECHECK_SECONDS = float(os.environ.get('LOCK_WAIT_RECHECK_SECONDS', 5))
+
+    # Replication outbox (master only)
+    # REPLICA_URL accepts a comma separated list; timeouts can be overridden per
+    # replica with ?connect_timeout=&read_timeout= on its URL
+    REPLICA_URLS = [url.strip() for url in os.environ.get('REPLICA_URL', 'http://localhost:5001').split(',') if url.strip()]
+    REPLICA_CONNECT_TIMEOUT = float(os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+    REPLICA_READ_TIMEOUT = float(os.environ.get('REPLICA_READ_TIMEOUT', 10))
+    SYNC_INTERVAL_SECONDS = float(os.environ.get('SYNC_INTERVAL_SECONDS', 2))
+    SYNC_BATCH_SIZE = int(os.environ.get('SYNC_BATCH_SIZE', 100))
+    SYNC_MAX_WORKERS = int(os.environ.get('SYNC_MAX_WORKERS', 4))
+    SYNC_MAX_BACKOFF_SECONDS = int(os.environ.get('SYNC_MAX_BACKOFF_SECONDS', 300))
+    # A change a replica rejects (400/413) this many times in a row is moved to
+    # the dead letters and skipped; anti-entropy then repairs the notes it touched
+    SYNC_DEAD_LETTER_ATTEMPTS = int(os.environ.get('SYNC_DEAD_LETTER_ATTEMPTS', 5))
+
+    # Replication payload format: "msgpack" (JSON if the package is missing) or "json";
+    # request bodies of at least SYNC_COMPRESS_MIN_BYTES are deflated (0 disables)
+    SYNC_ENCODING = os.environ.get('SYNC_ENCODING', 'msgpack')
+    SYNC_COMPRESS_MIN_BYTES = int(os.environ.get('SYNC_COMPRESS_MIN_BYTES', 16384))
+    # Largest size a compressed request body may decompress to (413 beyond)
+    SYNC_MAX_BODY_BYTES = int(os.environ.get('SYNC_MAX_BODY_BYTES', 32 * 1024 * 1024))
+
+    # Shared secret required on /api/sync/* (X-Sync-Token header); the endpoints
+    # refuse every call while it is unset
+    SYNC_TOKEN = os.environ.get('SYNC_TOKEN')
+
+    # Replica catch-up from the master's replication log
+    MASTER_URL = os.environ.get('MASTER_URL', 'http://localhost:5000')
+    CATCHUP_INTERVAL_SECONDS = float(os.environ.get('CATCHUP_INTERVAL_SECONDS', 30))
+    CATCHUP_CHUNK_SIZE = int(os.environ.get('CATCHUP_CHUNK_SIZE', 500))
+
+    # Bearer token required on /api/admin/* (metrics); the endpoints refuse
+    # every call while it is unset
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+    # Read-your-writes on replicas: a read carrying a replication position the
+    # replica has not applied yet waits this long, then is redirected to MASTER_URL
+    READ_WAIT_SECONDS = float(os.environ.get('READ_WAIT_SECONDS', 0.5))
+
+    # Snapshots used to seed new replicas
+    SNAPSHOT_CHUNK_SIZE = int(os.environ.get('SNAPSHOT_CHUNK_SIZE', 1000))
+    SNAPSHOT_COMMIT_ROWS = int(os.environ.get('SNAPSHOT_COMMIT_ROWS', 50000))
+
+    # Anti-entropy: hash tree over notes compared with each replica
+    MERKLE_BUCKET_SIZE = int(os.environ.get('MERKLE_BUCKET_SIZE', 256))
+    MERKLE_FANOUT = int(os.environ.get('MERKLE_FANOUT', 16))
+    MERKLE_INTERVAL_SECONDS = float(os.environ.get('MERKLE_INTERVAL_SECONDS', 900))
     
     @property
     def SQLALCHEMY_DATABASE_URI(self):
@@ -6,5 +6,10 @@ db = SQLAlchemy()
 from .user import User
 from .note import Note
 from .lock import Lock
+from .outbox import SyncOutbox
+from .replica_state import ReplicaState
+from .sync_dead_letter import SyncDeadLetter
+from .sync_position import SyncPosition
+from .note_change import NoteChangeCounter, NoteTombstone
 
-__all__ = ["db", "User", "Note", "Lock"]
+__all__ = ["db", "User", "Note", "Lock", "SyncOutbox", "ReplicaState", "SyncDeadLetter", "SyncPosition", "NoteChangeCounter", "NoteTombstone"]
@@ -1,14 +1,35 @@
+from datetime import datetime, timezone
+
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import Boolean, ForeignKey
+from sqlalchemy import Boolean, DateTime, ForeignKey, Index
 
 from models import db
 
 
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 class Lock(db.Model):
+    """Edit lock on a note, held as a lease.
+
+    A lock only counts while `expires_at` is in the future: the editor
+    renews it, and a lock left behind by a closed browser frees itself when
+    the lease runs out. Released and expired locks have no `expires_at`, so
+    the expiry index only holds live leases, oldest first for the reaper.
+    """
     __tablename__ = "locks"
+    __table_args__ = (
+        Index("ix_locks_expires_at", "expires_at"),
+    )
 
     note_id: Mapped[int] = mapped_column(ForeignKey("notes.id", ondelete="CASCADE"), primary_key=True)
     user_id: Mapped[int | None] = mapped_column(ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
     locked: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    expires_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
 
     note: Mapped["Note"] = relationship("Note", back_populates="lock")
+
+    def is_held(self, now: datetime | None = None) -> bool:
+        """Locked, and the lease has not expired"""
+        return self.locked and self.expires_at is not None and self.expires_at > (now or utcnow())
@@ -1,12 +1,20 @@
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import  ForeignKey, Text, func, Enum as SQLEnum
+from sqlalchemy import  DDL, ForeignKey, Index, Text, event, func, Enum as SQLEnum
 
 from models import db
 class Note(db.Model):
     __tablename__ = "notes"
+    __table_args__ = (
+        # Keyset pagination of the listings, newest first; version makes
+        # them covering for the listing fingerprint
+        Index("ix_notes_owner_listing", "owner_id", "id", "version"),
+        Index("ix_notes_visibility_listing", "visibility", "id", "version"),
+        # Changes feed: notes changed after a cursor
+        Index("ix_notes_change_seq", "change_seq"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     title: Mapped[str] = mapped_column(nullable=False)
     content: Mapped[str] = mapped_column(Text, nullable=False, default="")
     visibility: Mapped[str] = mapped_column(
@@ -14,8 +22,63 @@ class Note(db.Model):
         nullable=False,
         default="private",
     )
+    # Incremented on every update, replicated with the note; used in ETags
+    version: Mapped[int] = mapped_column(nullable=False, default=1, server_default="1")
+    # Set by the notes_change_* triggers on every write; local to each database
+    change_seq: Mapped[int] = mapped_column(nullable=False, server_default="0")
     created_at: Mapped[str] = mapped_column(server_default=func.current_date(), nullable=False)
     updated_at: Mapped[str] = mapped_column(server_default=func.current_date(), onupdate=func.current_date(), nullable=False)
 
     owner: Mapped["User"] = relationship("User", back_populates="notes_owned")
     lock: Mapped["Lock"] = relationship("Lock", back_populates="note", uselist=False, cascade="all, delete-orphan")
+
+
+# Full-text index over title and content (SQLite FTS5). It reads the text from
+# the notes table and is kept in sync by triggers, so every write path (ORM,
+# bulk inserts, replicated changes, snapshots) updates it. Matches in the
+# title weigh ten times more in the ranking.
+NOTES_FTS_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+        title, content, content='notes', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    "INSERT INTO notes_fts(notes_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+    """CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+        INSERT INTO notes_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, content ON notes BEGIN
+        INSERT INTO notes_fts(notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO notes_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+)
+
+# Changes feed: every write takes the next number of note_change_counter
+# (models/note_change.py) as the note's change_seq. Deleting a note, or making
+# a public note private, leaves a tombstone so clients drop it.
+NEXT_CHANGE_SEQ = "UPDATE note_change_counter SET seq = seq + 1 WHERE id = 1;"
+CURRENT_CHANGE_SEQ = "(SELECT seq FROM note_change_counter WHERE id = 1)"
+
+NOTES_CHANGES_DDL = (
+    f"""CREATE TRIGGER IF NOT EXISTS notes_change_insert AFTER INSERT ON notes BEGIN
+        {NEXT_CHANGE_SEQ}
+        UPDATE notes SET change_seq = {CURRENT_CHANGE_SEQ} WHERE id = new.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS notes_change_update AFTER UPDATE OF owner_id, title, content, visibility ON notes BEGIN
+        {NEXT_CHANGE_SEQ}
+        UPDATE notes SET change_seq = {CURRENT_CHANGE_SEQ} WHERE id = new.id;
+        INSERT INTO note_tombstones (change_seq, note_id, owner_id, visibility, reason)
+        SELECT {CURRENT_CHANGE_SEQ}, old.id, old.owner_id, old.visibility, 'hidden'
+        WHERE old.visibility IN ('read', 'write') AND new.visibility = 'private';
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS notes_change_delete AFTER DELETE ON notes BEGIN
+        {NEXT_CHANGE_SEQ}
+        INSERT INTO note_tombstones (change_seq, note_id, owner_id, visibility, reason)
+        VALUES ({CURRENT_CHANGE_SEQ}, old.id, old.owner_id, old.visibility, 'deleted');
+    END""",
+)
+
+for statement in NOTES_FTS_DDL + NOTES_CHANGES_DDL:
+    event.listen(Note.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Note.__table__, "before_drop", DDL("DROP TABLE IF EXISTS notes_fts").execute_if(dialect="sqlite"))
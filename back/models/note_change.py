@@ -0,0 +1,41 @@
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import DDL, Integer, String, event
+
+from models import db
+
+
+class NoteChangeCounter(db.Model):
+    """Single row holding the last change sequence number given to a note.
+
+    Every insert, update or delete of a note takes the next number (see the
+    triggers in models/note.py). The epoch is random per database, so a
+    changes cursor from another node or from before a reset is recognized.
+    """
+    __tablename__ = "note_change_counter"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    seq: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    epoch: Mapped[str] = mapped_column(String(32), nullable=False)
+
+
+event.listen(
+    NoteChangeCounter.__table__,
+    "after_create",
+    DDL("INSERT INTO note_change_counter (id, seq, epoch) VALUES (1, 0, lower(hex(randomblob(8))))"),
+)
+
+
+class NoteTombstone(db.Model):
+    """A note that left someone's listing at change `change_seq`.
+
+    reason "deleted": the note was deleted (visibility is the one it had).
+    reason "hidden": a public note was made private, removing it from the
+    other users' listings.
+    """
+    __tablename__ = "note_tombstones"
+
+    change_seq: Mapped[int] = mapped_column(Integer, primary_key=True)
+    note_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    owner_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    visibility: Mapped[str] = mapped_column(String(10), nullable=False)
+    reason: Mapped[str] = mapped_column(String(10), nullable=False)
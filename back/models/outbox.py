@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import JSON, DateTime, String
+
+from models import db
+
+
+class SyncOutbox(db.Model):
+    """Replication change waiting to be delivered to the replica.
+
+    Rows are written in the same transaction as the user/note change they
+    describe, so a committed write can never be missing from the outbox.
+    The id is the change's log sequence number (LSN). Rows are removed
+    once every configured replica has received them.
+    """
+    __tablename__ = "sync_outbox"
+    # Never reuse ids once pruned: replicas track their progress by id
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    operation: Mapped[str] = mapped_column(String(50), nullable=False)
+    payload: Mapped[dict] = mapped_column(JSON, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
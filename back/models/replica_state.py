@@ -0,0 +1,17 @@
+from datetime import datetime
+
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import DateTime, Integer, String, Text
+
+from models import db
+
+
+class ReplicaState(db.Model):
+    """Delivery progress of the outbox to one replica"""
+    __tablename__ = "sync_replicas"
+
+    url: Mapped[str] = mapped_column(String(255), primary_key=True)
+    last_sent_id: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    next_attempt_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
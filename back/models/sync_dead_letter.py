@@ -0,0 +1,23 @@
+from datetime import datetime
+
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import JSON, DateTime, Integer, String, Text
+
+from models import db
+
+
+class SyncDeadLetter(db.Model):
+    """Logged change a replica kept rejecting, skipped so it could move on.
+
+    Kept for inspection and manual replay; anti-entropy repairs the notes
+    it touched once the replica has caught up.
+    """
+    __tablename__ = "sync_dead_letters"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    replica_url: Mapped[str] = mapped_column(String(255), nullable=False, index=True)
+    lsn: Mapped[int] = mapped_column(Integer, nullable=False)
+    operation: Mapped[str] = mapped_column(String(50), nullable=False)
+    payload: Mapped[dict] = mapped_column(JSON, nullable=False)
+    error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
@@ -0,0 +1,25 @@
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import Integer, String
+
+from models import db
+
+
+class SyncPosition(db.Model):
+    """Named replication log position (LSN).
+
+    On a replica, "applied" is the last change applied from the master.
+    On the master, "pruned" is the last change removed from the log.
+    """
+    __tablename__ = "sync_positions"
+
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    lsn: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    @staticmethod
+    def get(name: str) -> "SyncPosition":
+        """Returns the position row, adding it to the session at 0 if missing"""
+        position = db.session.get(SyncPosition, name)
+        if position is None:
+            position = SyncPosition(name=name, lsn=0)
+            db.session.add(position)
+        return position
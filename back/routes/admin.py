@@ -0,0 +1,23 @@
+import hmac
+
+from flask import Blueprint, Response, current_app, jsonify, request
+
+from services.metrics import REGISTRY
+
+admin_bp = Blueprint("admin", __name__, url_prefix="/api/admin")
+
+
+@admin_bp.before_request
+def check_admin_token():
+    """Requires `Authorization: Bearer <ADMIN_TOKEN>`, and refuses every call when no token is configured"""
+    token = current_app.config.get("ADMIN_TOKEN")
+    if not token:
+        return jsonify({"success": False, "error": "admin endpoints disabled: ADMIN_TOKEN is not set"}), 403
+    if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+        return jsonify({"success": False, "error": "invalid admin token"}), 403
+
+
+@admin_bp.route("/metrics", methods=["GET"])
+def metrics():
+    """Replication metrics of this node, in the Prometheus text format"""
+    return Response(REGISTRY.render(), content_type=REGISTRY.CONTENT_TYPE)
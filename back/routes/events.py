@@ -0,0 +1,36 @@
+from flask import Blueprint, Response, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+
+from services.event_broker import EventBroker
+
+events_bp = Blueprint("events", __name__, url_prefix="/api")
+
+
+@events_bp.route("/events", methods=["GET"])
+@jwt_required()
+def stream_events():
+    """
+    Server-Sent Events stream of note-created, note-updated, lock-acquired
+    and lock-released events for the notes the user can read. Browsers
+    reconnect with the Last-Event-ID header and get the events they missed;
+    a "resync" event means they are gone and the client should reload
+    through /api/notes/changes.
+    """
+    user_id = int(get_jwt_identity())
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    if last_event_id is not None:
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            return jsonify({"success": False, "error": "Invalid Last-Event-ID"}), 400
+
+    subscription = EventBroker.subscribe(user_id, last_event_id)
+    # The stream holds no request context nor database session while it waits
+    response = Response(
+        EventBroker.stream(subscription),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Also when the client is gone before the stream started
+    response.call_on_close(lambda: EventBroker.unsubscribe(subscription))
+    return response
@@ -1,5 +1,10 @@
-from flask import Blueprint, jsonify, request
-from services.note_service import NoteService
+import base64
+import binascii
+import hashlib
+import json
+
+from flask import Blueprint, current_app, jsonify, request
+from services.note_service import ChangesCursorExpired, NoteService
 from services.user_service import UserService
 from services.lock_service import LockService
 from flask_jwt_extended import jwt_required, get_jwt_identity
@@ -19,32 +24,142 @@ def serialize_note(note, is_owner: bool):
     }
 
 
+def serialize_note_detail(note, is_owner: bool, lock_info: dict):
+    return {
+        **serialize_note(note, is_owner),
+        "access_level": "write" if is_owner else note.visibility,
+        "lock": lock_info,
+    }
+
+
+def encode_cursor(before_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"before": before_id}).encode()).decode().rstrip("=")
+
+
+def read_cursor(cursor: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError("invalid cursor") from e
+    if not isinstance(data, dict):
+        raise ValueError("invalid cursor")
+    return data
+
+
+def decode_cursor(cursor: str) -> int:
+    """Raises ValueError on a malformed cursor"""
+    try:
+        return int(read_cursor(cursor)["before"])
+    except (TypeError, KeyError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+def encode_changes_cursor(position: tuple) -> str:
+    epoch, seq = position
+    return base64.urlsafe_b64encode(json.dumps({"epoch": epoch, "seq": seq}).encode()).decode().rstrip("=")
+
+
+def decode_changes_cursor(cursor: str) -> tuple:
+    """(epoch, seq) position in the changes feed; raises ValueError on a malformed cursor"""
+    try:
+        data = read_cursor(cursor)
+        return str(data["epoch"]), int(data["seq"])
+    except (TypeError, KeyError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+def encode_search_cursor(rank: float, note_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"rank": rank, "after": note_id}).encode()).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: str) -> tuple:
+    """(rank, id) of the last note of the previous page; raises ValueError on a malformed cursor"""
+    try:
+        data = read_cursor(cursor)
+        return float(data["rank"]), int(data["after"])
+    except (TypeError, KeyError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+def make_etag(*parts) -> str:
+    return hashlib.sha256("|".join(str(part) for part in parts).encode()).hexdigest()[:32]
+
+
+def not_modified(etag: str):
+    """304 response when the client's If-None-Match already has this version, else None"""
+    if request.if_none_match.contains(etag):
+        return with_etag(current_app.response_class(status=304), etag)
+    return None
+
+
+def with_etag(response, etag: str):
+    response.set_etag(etag)
+    # Cached by the browser, but revalidated on every use
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+# ?view=summary: what a listing needs to display, without the full content
+SUMMARY_FIELDS = ["id", "title", "preview", "created_at", "updated_at", "is_owner", "visibility", "owner_name"]
+
+
+def listing_fields():
+    """Fields asked for with ?fields=a,b,... or ?view=summary; None for the full notes"""
+    if request.args.get("fields"):
+        return [field.strip() for field in request.args["fields"].split(",") if field.strip()]
+    view = request.args.get("view", "full")
+    if view == "summary":
+        return SUMMARY_FIELDS
+    if view != "full":
+        raise ValueError("view must be 'full' or 'summary'")
+    return None
+
+
+def page_size() -> int:
+    limit = request.args.get("limit", current_app.config["NOTES_PAGE_SIZE"], type=int)
+    return max(1, min(limit, current_app.config["NOTES_MAX_PAGE_SIZE"]))
+
+
+def notes_page(user_id: int):
+    """Page of a user's owned + shared notes, from the ?limit=, ?cursor=, ?fields= and ?view= parameters"""
+    limit = page_size()
+    cursor = request.args.get("cursor")
+    before_id = decode_cursor(cursor) if cursor else None
+    fields = listing_fields()
+
+    etag = make_etag(user_id, NoteService.listing_fingerprint(user_id), limit, before_id, fields)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    # Read before the page, so changes made while it loads are not missed
+    changes_cursor = encode_changes_cursor(NoteService.changes_head()) if before_id is None else None
+    page, next_before = NoteService.get_notes_page(user_id, limit, before_id, fields)
+    body = {
+        'success': True,
+        'notes': page,
+        'next_cursor': encode_cursor(next_before) if next_before is not None else None,
+    }
+    if changes_cursor is not None:
+        # Position to follow this listing from with /api/notes/changes
+        body['changes_cursor'] = changes_cursor
+    return with_etag(jsonify(body), etag), 200
+
+
 @notes_bp.route('/notes', methods=['GET'])
 @jwt_required()
 def get_user_notes_jwt():
-    """Get all notes for the logged-in user (owned + shared)"""
+    """Get the notes of the logged-in user (owned + shared), newest first, one page at a time"""
     try:
         current_user_id = int(get_jwt_identity())
-        
-        # Notes owned by the user
-        owned_notes = NoteService.get_user_notes(user_id=current_user_id)
-        
-        # Notes shared with the user
-        shared_notes = NoteService.get_shared_public_notes(user_id=current_user_id)
-        
-        notes_data = [
-            serialize_note(note, True)
-            for note in owned_notes
-        ] + [
-            serialize_note(note, False)
-            for note in shared_notes
-        ]
-        
+        return notes_page(current_user_id)
+
+    except ValueError as e:
         return jsonify({
-            'success': True,
-            'notes': notes_data
-        }), 200
-        
+            'success': False,
+            'error': str(e)
+        }), 400
+
     except Exception as e:
         return jsonify({
             'success': False,
@@ -54,28 +169,96 @@ def get_user_notes_jwt():
 
 @notes_bp.route('/users/<int:user_id>/notes', methods=['GET'])
 def get_user_notes(user_id):
-    """Get all notes for a user (owned + shared)"""
+    """Get the notes of a user (owned + shared), newest first, one page at a time"""
     try:
-        # Notes owned by the user
-        owned_notes = NoteService.get_user_notes(user_id=user_id)
-        
-        # Notes shared with the user
-        shared_notes = NoteService.get_shared_public_notes(user_id=user_id)
-        notes_data = []
-        
-        notes_data = [
-            serialize_note(note, True)
-            for note in owned_notes
-        ] + [
-            serialize_note(note, False)
-            for note in shared_notes
-        ]
-        
+        return notes_page(user_id)
+
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@notes_bp.route('/notes/changes', methods=['GET'])
+@jwt_required()
+def get_notes_changes():
+    """Notes added to, updated in or removed from the logged-in user's listing since ?since= (a changes_cursor)"""
+    try:
+        current_user_id = int(get_jwt_identity())
+        since = request.args.get("since")
+        if not since:
+            return jsonify({
+                'success': False,
+                'error': 'since is required'
+            }), 400
+
+        notes, removed, position, has_more = NoteService.get_changes(
+            current_user_id,
+            decode_changes_cursor(since),
+            page_size(),
+            listing_fields(),
+        )
         return jsonify({
             'success': True,
-            'notes': notes_data
+            'notes': notes,
+            'removed': removed,
+            'next_cursor': encode_changes_cursor(position),
+            'has_more': has_more,
         }), 200
-        
+
+    except ChangesCursorExpired:
+        # From another server or an older database: the client has to reload the listing
+        return jsonify({
+            'success': False,
+            'error': 'Changes cursor expired, reload the notes'
+        }), 410
+
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@notes_bp.route('/notes/search', methods=['GET'])
+@jwt_required()
+def search_notes():
+    """Search the notes the logged-in user can read, best matches first, one page at a time (?q=, ?limit=, ?cursor=, ?fields=, ?view=)"""
+    try:
+        current_user_id = int(get_jwt_identity())
+        cursor = request.args.get("cursor")
+        page, after = NoteService.search_notes(
+            current_user_id,
+            request.args.get("q", ""),
+            page_size(),
+            decode_search_cursor(cursor) if cursor else None,
+            listing_fields(),
+        )
+        return jsonify({
+            'success': True,
+            'notes': page,
+            'next_cursor': encode_search_cursor(*after) if after is not None else None,
+        }), 200
+
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
     except Exception as e:
         return jsonify({
             'success': False,
@@ -100,7 +283,7 @@ def get_note_detail(note_id):
         
         # Check permissions
         is_owner = note.owner_id == current_user_id
-        can_read_note = NoteService.can_user_read(note.id, current_user_id)
+        can_read_note = NoteService.can_read(note, current_user_id)
 
         if not can_read_note:
             return jsonify({
@@ -110,15 +293,16 @@ def get_note_detail(note_id):
         
         # Get lock status
         lock_info = LockService.get_lock_status(note.id)
+
+        etag = make_etag(note.id, note.version, is_owner, json.dumps(lock_info, sort_keys=True, default=str))
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
         
-        return jsonify({
+        return with_etag(jsonify({
             'success': True,
-            'note': {
-                **serialize_note(note, is_owner),
-                'access_level': 'write' if is_owner else note.visibility,
-                'lock': lock_info,
-            }
-        }), 200
+            'note': serialize_note_detail(note, is_owner, lock_info)
+        }), etag), 200
         
     except Exception as e:
         return jsonify({
@@ -127,6 +311,85 @@ def get_note_detail(note_id):
         }), 500
     
 
+@notes_bp.route('/notes/batch-get', methods=['POST'])
+@jwt_required()
+def batch_get_notes():
+    """Get the details of several notes: {"ids": [...]} -> one result per id, in the same order"""
+    try:
+        current_user_id = int(get_jwt_identity())
+        data = request.get_json(silent=True) or {}
+        ids = data.get("ids")
+
+        if not isinstance(ids, list) or not all(isinstance(note_id, int) and not isinstance(note_id, bool) for note_id in ids):
+            return jsonify({
+                'success': False,
+                'error': 'ids must be a list of note ids'
+            }), 400
+        if len(ids) > current_app.config["NOTES_BATCH_MAX_IDS"]:
+            return jsonify({
+                'success': False,
+                'error': f'At most {current_app.config["NOTES_BATCH_MAX_IDS"]} ids per request'
+            }), 400
+
+        # Notes, owners and locks in one query; the lock lookups reuse it
+        notes = NoteService.get_notes(set(ids))
+        results = []
+        for note_id in ids:
+            note = notes.get(note_id)
+            if note is None:
+                results.append({'id': note_id, 'status': 404, 'error': 'Note not found'})
+            elif not NoteService.can_read(note, current_user_id):
+                results.append({'id': note_id, 'status': 403, 'error': 'Access denied'})
+            else:
+                is_owner = note.owner_id == current_user_id
+                lock_info = LockService.get_lock_status(note.id)
+                results.append({'id': note_id, 'status': 200, 'note': serialize_note_detail(note, is_owner, lock_info)})
+
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@notes_bp.route('/notes/bulk', methods=['POST'])
+@jwt_required()
+def bulk_write_notes():
+    """Create and update many notes in one transaction: {"notes": [{"title", "content", "visibility"} | {"id", "title", "content"}, ...]}"""
+    try:
+        current_user_id = int(get_jwt_identity())
+        data = request.get_json(silent=True) or {}
+        items = data.get("notes")
+
+        if not isinstance(items, list):
+            return jsonify({
+                'success': False,
+                'error': 'notes must be a list'
+            }), 400
+        if len(items) > current_app.config["NOTES_BULK_MAX_ITEMS"]:
+            return jsonify({
+                'success': False,
+                'error': f'At most {current_app.config["NOTES_BULK_MAX_ITEMS"]} notes per request'
+            }), 400
+
+        results = NoteService.bulk_write(current_user_id, items)
+        return jsonify({
+            'success': True,
+            'results': results
+        }), 200
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
 @notes_bp.route('/notes', methods=["POST"])
 @jwt_required()
 def add_new_note():
@@ -164,13 +427,20 @@ def add_new_note():
 @notes_bp.route('/notes/<int:note_id>/lock', methods=['POST'])
 @jwt_required()
 def acquire_note_lock(note_id):
-    """Acquire a lock on a note for editing"""
+    """Acquire a lock on a note for editing; with ?wait=<seconds>, wait in line for a held lock"""
     try:
         current_user_id = int(get_jwt_identity())
-        result = LockService.acquire_lock(note_id, current_user_id)
+        wait = request.args.get("wait", 0, type=float)
+        if wait > 0:
+            wait = min(wait, current_app.config["LOCK_WAIT_MAX_SECONDS"])
+            result = LockService.wait_for_lock(note_id, current_user_id, wait)
+        else:
+            result = LockService.acquire_lock(note_id, current_user_id)
         
         if result["success"]:
             return jsonify(result), 200
+        elif result.get("queue_full"):
+            return jsonify(result), 429
         else:
             return jsonify(result), 409  # Conflict
             
@@ -181,6 +451,26 @@ def acquire_note_lock(note_id):
         }), 500
 
 
+@notes_bp.route('/notes/<int:note_id>/lock/renew', methods=['POST'])
+@jwt_required()
+def renew_note_lock(note_id):
+    """Extend the lease of a lock held by the user (editor heartbeat)"""
+    try:
+        current_user_id = int(get_jwt_identity())
+        result = LockService.renew_lock(note_id, current_user_id)
+        
+        if result["success"]:
+            return jsonify(result), 200
+        else:
+            return jsonify(result), 409  # Lost: acquire the lock again
+            
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
 @notes_bp.route('/notes/<int:note_id>/lock', methods=['DELETE'])
 @jwt_required()
 def release_note_lock(note_id):
@@ -237,18 +527,20 @@ def edit_note(note_id):
         return jsonify({"error": "invalid note data"}), 400
 
     try:
-        note = NoteService.get_note(note_id=note_id)
-        if not note:
-            return jsonify({"error": "note not found"}), 404
-
         if note.owner_id != current_user_id and not NoteService.can_write(note, current_user_id):
             return jsonify({"error": "access denied"}), 403
 
+        # The editor's lease may have run out, and the lock been taken by someone else
+        if LockService.lock_holder(note) != current_user_id:
+            return jsonify({"error": "edit lock not held or expired"}), 409
+
         updated_note = NoteService.update_note(
             note_id,
             title,
             content
         )
+        # Serialized before releasing the lock commits again and expires the note
+        serialized = serialize_note(updated_note, True) if updated_note else None
     
         result = LockService.release_lock(note_id, current_user_id)
         if not result["success"]:
@@ -257,7 +549,7 @@ def edit_note(note_id):
         if not updated_note:
             return jsonify({"error": "could not update note"}), 400
 
-        return jsonify({"success": True, "note": serialize_note(updated_note, True)}), 200
+        return jsonify({"success": True, "note": serialized}), 200
 
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
@@ -271,18 +563,20 @@ def get_note_for_edit(note_id):
     if not note:
         return jsonify({"error": "note not found"}), 404
     
-    if note.owner_id != current_user_id and not NoteService.can_write(NoteService.get_note(note_id), current_user_id):
+    if note.owner_id != current_user_id and not NoteService.can_write(note, current_user_id):
         return jsonify({"error": "access denied"}), 403
     
     lock_info = LockService.get_lock_status(note.id)
     if lock_info['locked'] and lock_info['user_id'] != current_user_id:
         return jsonify({"error": "note is locked by another user"}), 409
     else:
+        # Serialized first: acquiring the lock commits, which expires the loaded note
+        serialized = serialize_note(note, True)
         result = LockService.acquire_lock(note.id, current_user_id)
         if not result["success"]:
             return jsonify({"error": "could not acquire lock"}), 409
         
     return jsonify({
         "success": True,
-        "note": serialize_note(note, True)
+        "note": serialized
     }), 200
\ No newline at end of file
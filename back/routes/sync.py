@@ -1,70 +1,215 @@
-from flask import Blueprint, request, jsonify
-from models import db, Note, User
+import hmac
+import json
+import time
+
+from flask import Blueprint, Response, current_app, g, request, stream_with_context
+from models import db
+from models.outbox import SyncOutbox
+from services.merkle_service import MerkleService
+from services.metrics import SYNC_BYTES_RECEIVED, SYNC_REQUEST_DURATION
+from services.replica_service import DeltaMismatch, ReplicaService, ReplicationGap
+from services.snapshot_service import SnapshotService
+from services.sync_codec import PayloadTooLarge, SyncCodec, UnsupportedFormat
+from services.sync_service import SyncService
 
 sync_bp = Blueprint("sync", __name__, url_prefix="/api/sync")
 
+
+def reply(payload, status=200):
+    """Response body in the format negotiated with the caller's Accept header (see SyncCodec)"""
+    content_type = SyncCodec.negotiate(request.accept_mimetypes)
+    return Response(SyncCodec.encode(payload, content_type), status=status, content_type=content_type)
+
+
+def read_payload():
+    return g.get("sync_payload") or {}
+
+
+@sync_bp.before_request
+def start_timer():
+    g.sync_started = time.perf_counter()
+
+
+@sync_bp.after_request
+def record_request(response):
+    endpoint = request.endpoint or "unknown"
+    SYNC_REQUEST_DURATION.observe(time.perf_counter() - g.sync_started, endpoint=endpoint)
+    if request.content_length:
+        SYNC_BYTES_RECEIVED.inc(request.content_length, endpoint=endpoint)
+    return response
+
+
+@sync_bp.before_request
+def check_sync_token():
+    """Node-to-node endpoints: require the shared token, and refuse every call when none is configured"""
+    token = current_app.config.get("SYNC_TOKEN")
+    if not token:
+        return reply({"success": False, "error": "sync endpoints disabled: SYNC_TOKEN is not set"}, 403)
+    if not hmac.compare_digest(request.headers.get("X-Sync-Token", "").encode(), token.encode()):
+        return reply({"success": False, "error": "invalid sync token"}, 403)
+
+
+@sync_bp.before_request
+def decode_payload():
+    """Request bodies may be JSON or msgpack, optionally deflate/gzip compressed"""
+    if request.method != "POST":
+        return None
+    try:
+        g.sync_payload = SyncCodec.decode(request.get_data(), request.content_type,
+                                          request.headers.get("Content-Encoding"),
+                                          current_app.config["SYNC_MAX_BODY_BYTES"])
+    except PayloadTooLarge as e:
+        return reply({"success": False, "error": str(e)}, 413)
+    except UnsupportedFormat as e:
+        return reply({"success": False, "error": str(e)}, 415)
+    except ValueError as e:
+        return reply({"success": False, "error": f"invalid payload: {e}"}, 400)
+
+
 @sync_bp.route("/create_note", methods=["POST"])
 def sync_create_note():
-    data = request.get_json() or {}
+    data = read_payload()
 
     try:
-        note = Note(
-            id=data["id"],
-            owner_id=data["owner_id"],
-            title=data["title"],
-            content=data["content"],
-            visibility=data["visibility"]
-        )
-
-        db.session.add(note)
+        ReplicaService.create_note(data)
         db.session.commit()
 
-        return jsonify({"success": True}), 201
-    
+        return reply({"success": True}, 201)
+
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 400
-    
+        db.session.rollback()
+        return reply({"success": False, "error": str(e)}, 400)
+
 @sync_bp.route("/register_user", methods=["POST"])
 def sync_register_user():
-    data = request.get_json() or {}
+    data = read_payload()
 
     try:
-        user = User(
-            id=data["id"],
-            nom=data["nom"],
-            pswd_hashed=data["pswd_hashed"]
-        )
-
-        db.session.add(user)
+        ReplicaService.register_user(data)
         db.session.commit()
 
-        return jsonify({"success": True}), 201
-    
+        return reply({"success": True}, 201)
+
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 400
-    
+        db.session.rollback()
+        return reply({"success": False, "error": str(e)}, 400)
+
 
 @sync_bp.route("/update_note", methods=["POST"])
 def sync_update_note():
-    data = request.get_json() or {}
-
-    try: 
-        title = data.get("title")
-        content = data.get("content")
-        note_id = data.get("id")
+    data = read_payload()
 
-        updated_note = Note.query.filter_by(id=note_id).first()
-        if updated_note:
-            updated_note.title = title
-            updated_note.content = content
-            db.session.commit()
+    try:
+        ReplicaService.update_note(data)
+        db.session.commit()
 
-        if not updated_note:
-            print("Could not update note - not found")
-            return jsonify({"error": "could not update note"}), 400
+        return reply({"success": True}, 200)
 
-        return jsonify({"success": True}), 200
+    except LookupError as e:
+        print("Could not update note - not found")
+        return reply({"error": str(e)}, 400)
 
     except Exception as e:
         print(e)
-        return jsonify({"success": False, "error": str(e)}), 400
+        db.session.rollback()
+        return reply({"success": False, "error": str(e)}, 400)
+
+
+@sync_bp.route("/batch", methods=["POST"])
+def sync_batch():
+    """Applies an ordered list of operations in a single transaction"""
+    data = read_payload()
+    operations = data.get("operations")
+
+    if not isinstance(operations, list):
+        return reply({"success": False, "error": "operations must be a list"}, 400)
+
+    try:
+        applied = ReplicaService.apply_batch(operations, data.get("from_lsn"), data.get("to_lsn"))
+        return reply({"success": True, "applied": applied, "last_lsn": ReplicaService.get_applied_lsn()}, 200)
+
+    except ReplicationGap as e:
+        return reply({"success": False, "error": str(e), "last_lsn": e.last_lsn}, 409)
+
+    except DeltaMismatch as e:
+        return reply({"success": False, "error": str(e), "resync": e.note_ids}, 409)
+
+    except Exception as e:
+        return reply({"success": False, "error": str(e)}, 400)
+
+
+@sync_bp.route("/since/<int:lsn>", methods=["GET"])
+def sync_since(lsn):
+    """Streams the master's logged changes after `lsn`, one JSON object per line"""
+    if current_app.config.get("SERVER_MODE") != "master":
+        return reply({"success": False, "error": "only the master serves the replication log"}, 400)
+
+    pruned_lsn = SyncService.get_pruned_lsn()
+    if lsn < pruned_lsn:
+        return reply({
+            "success": False,
+            "error": f"changes up to LSN {pruned_lsn} are no longer in the log",
+            "pruned_lsn": pruned_lsn,
+        }, 410)
+
+    head_lsn = SyncService.get_head_lsn()
+    if lsn > head_lsn:
+        return reply({
+            "success": False,
+            "error": f"LSN {lsn} is ahead of the master log",
+            "head_lsn": head_lsn,
+        }, 409)
+
+    chunk_size = current_app.config["CATCHUP_CHUNK_SIZE"]
+
+    def generate():
+        last = lsn
+        while True:
+            entries = (
+                SyncOutbox.query
+                .filter(SyncOutbox.id > last, SyncOutbox.id <= head_lsn)
+                .order_by(SyncOutbox.id)
+                .limit(chunk_size)
+                .all()
+            )
+            if not entries:
+                break
+            for entry in entries:
+                yield json.dumps({"lsn": entry.id, "operation": entry.operation, "data": entry.payload}) + "\n"
+            last = entries[-1].id
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson",
+                    headers={"X-Head-LSN": str(head_lsn)})
+
+
+@sync_bp.route("/snapshot", methods=["GET"])
+def sync_snapshot():
+    """Streams users, notes and locks as chunked NDJSON, gzip compressed with ?compress=gzip"""
+    if current_app.config.get("SERVER_MODE") != "master":
+        return reply({"success": False, "error": "only the master serves snapshots"}, 400)
+
+    chunk_size = request.args.get("chunk_size", type=int)
+    lines = SnapshotService.export(chunk_size)
+
+    if request.args.get("compress") == "gzip":
+        return Response(stream_with_context(SnapshotService.gzip(lines)), mimetype="application/gzip")
+    return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+
+@sync_bp.route("/merkle", methods=["POST"])
+def sync_merkle():
+    """Hashes of the notes in the requested id ranges, for anti-entropy checks"""
+    data = read_payload()
+    ranges = data.get("ranges") or []
+
+    try:
+        hashes = MerkleService.range_hashes([(int(lo), int(hi)) for lo, hi in ranges])
+    except (TypeError, ValueError):
+        return reply({"success": False, "error": "ranges must be a list of [lo, hi] pairs"}, 400)
+
+    return reply({
+        "success": True,
+        "hashes": hashes,
+        "max_id": MerkleService.max_id(),
+        "last_lsn": ReplicaService.get_applied_lsn(),
+    }, 200)
@@ -1,4 +1,4 @@
 export PORT=5000
 export SERVER_MODE=master
-export DATABASE_URL="sqlite:///master.db"
-python3 app.py
\ No newline at end of file
+export DATABASE_URI="sqlite:///master.db"
+python3 serve.py
\ No newline at end of file
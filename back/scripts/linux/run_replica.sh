@@ -1,4 +1,4 @@
 export PORT=5001
 export SERVER_MODE=replica
-export DATABASE_URL="sqlite:///replica.db"
-python3 app.py
\ No newline at end of file
+export DATABASE_REPLICA_URI="sqlite:///replica.db"
+python3 serve.py
\ No newline at end of file
@@ -1,4 +1,4 @@
 set PORT=5000
 set SERVER_MODE=master
-set DATABASE_URL=sqlite:///master.db
-python app.py
\ No newline at end of file
+set DATABASE_URI=sqlite:///master.db
+python serve.py
\ No newline at end of file
@@ -1,4 +1,4 @@
 set PORT=5001
 set SERVER_MODE=replica
-set DATABASE_URL=sqlite:///replica.db
-python app.py
\ No newline at end of file
+set DATABASE_REPLICA_URI=sqlite:///replica.db
+python serve.py
\ No newline at end of file
@@ -0,0 +1,24 @@
+from gevent import monkey
+
+# Must run before anything imports threading, socket or ssl: locks, events
+# and sockets then park a greenlet instead of blocking a thread
+monkey.patch_all()
+
+import os
+
+from gevent.pywsgi import WSGIServer
+
+from app import app, prepare_database, start_background_workers
+
+# Serves the app under gevent: each request, and so each open /api/events
+# stream, is a greenlet, and thousands of idle clients cost no thread each.
+# Reads PORT, SERVER_MODE and DATABASE_URI / DATABASE_REPLICA_URI like app.py.
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 5000))
+
+    prepare_database()
+    start_background_workers()
+
+    server = WSGIServer((os.environ.get('HOST', '127.0.0.1'), port), app)
+    print(f"Serving on http://{server.address[0]}:{port} (gevent)")
+    server.serve_forever()
@@ -0,0 +1,38 @@
+import threading
+
+from models import db
+
+
+class BackgroundWorker(threading.Thread):
+    """Daemon thread running a task periodically inside the application context"""
+
+    def __init__(self, app, task, interval: float, name: str):
+        super().__init__(name=name, daemon=True)
+        self.app = app
+        self.task = task
+        self.interval = interval
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+
+    def wake(self) -> None:
+        """Runs the task as soon as possible instead of waiting for the interval"""
+        self._wake_event.set()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wake_event.wait(self.interval)
+            self._wake_event.clear()
+            if self._stop_event.is_set():
+                break
+
+            with self.app.app_context():
+                try:
+                    self.task()
+                except Exception:
+                    self.app.logger.exception(f"Background task {self.name} failed")
+                finally:
+                    db.session.remove()
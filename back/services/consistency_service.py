@@ -0,0 +1,71 @@
+from flask import current_app, g, has_request_context, redirect, request
+
+from services.replica_service import ReplicaService
+from services.sync_service import SyncService
+
+POSITION_HEADER = "X-Replication-Position"
+POSITION_COOKIE = "replication_position"
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+class ConsistencyService:
+    """Read-your-writes for reads served by replicas.
+
+    A master response to a write that was logged for replication carries
+    the log position (LSN) of that write, both as the X-Replication-Position
+    header and as a cookie, so browsers send it back automatically. A
+    replica serves a read carrying a position only once it has applied it:
+    it waits up to READ_WAIT_SECONDS, then redirects the read to the master.
+    """
+
+    @staticmethod
+    def init_app(app) -> None:
+        if app.config["SERVER_MODE"] == "master":
+            app.after_request(ConsistencyService.attach_position)
+        else:
+            app.before_request(ConsistencyService.check_position)
+
+    @staticmethod
+    def mark_write() -> None:
+        """Called when a change is logged, so the response carries its position"""
+        if has_request_context():
+            g.replicated_write = True
+
+    @staticmethod
+    def _is_api_request() -> bool:
+        return request.path.startswith("/api/") and request.blueprint != "sync"
+
+    @staticmethod
+    def attach_position(response):
+        if (
+            request.method in WRITE_METHODS
+            and response.status_code < 400
+            and g.get("replicated_write")
+            and ConsistencyService._is_api_request()
+        ):
+            # The head is at or past this request's changes, which are committed by now
+            position = str(SyncService.get_head_lsn())
+            response.headers[POSITION_HEADER] = position
+            response.set_cookie(POSITION_COOKIE, position, path="/api/", httponly=True, samesite="Lax")
+        return response
+
+    @staticmethod
+    def requested_position() -> int:
+        value = request.headers.get(POSITION_HEADER) or request.cookies.get(POSITION_COOKIE)
+        try:
+            return int(value) if value else 0
+        except ValueError:
+            return 0
+
+    @staticmethod
+    def check_position():
+        if request.method != "GET" or not ConsistencyService._is_api_request():
+            return None
+
+        position = ConsistencyService.requested_position()
+        if not position or ReplicaService.wait_for_lsn(position, current_app.config["READ_WAIT_SECONDS"]):
+            return None
+
+        current_app.logger.info(f"Replica behind position {position}, redirecting {request.path} to the master")
+        master = current_app.config["MASTER_URL"].rstrip("/")
+        return redirect(f"{master}{request.full_path.rstrip('?')}", code=307)
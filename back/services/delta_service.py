@@ -0,0 +1,74 @@
+import hashlib
+from difflib import SequenceMatcher
+from typing import List
+
+# A delta is a list of [start, end, text] edits: replace old[start:end] with text.
+# Positions refer to the old string and edits are sorted and non-overlapping.
+Delta = List[list]
+
+
+class DeltaService:
+    """Compact diffs of note content for replication"""
+
+    # The changed region is sent as a single edit instead of being diffed when
+    # it is longer than MAX_DIFF_REGION, when its characters could be matched
+    # more than MAX_DIFF_PAIRS ways (SequenceMatcher slows down sharply on
+    # repetitive text), or when old and new share too little for a diff to pay.
+    # This keeps make_delta to a few milliseconds on the write path.
+    MAX_DIFF_REGION = 256
+    MAX_DIFF_PAIRS = 2048
+    MIN_DIFF_RATIO = 0.5
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+    @staticmethod
+    def make_delta(old: str, new: str) -> Delta:
+        """Diff of old -> new, trimming the common prefix and suffix first"""
+        prefix = 0
+        limit = min(len(old), len(new))
+        while prefix < limit and old[prefix] == new[prefix]:
+            prefix += 1
+
+        suffix = 0
+        limit -= prefix
+        while suffix < limit and old[-1 - suffix] == new[-1 - suffix]:
+            suffix += 1
+
+        old_middle = old[prefix:len(old) - suffix]
+        new_middle = new[prefix:len(new) - suffix]
+        if not old_middle and not new_middle:
+            return []
+
+        single_edit = [[prefix, prefix + len(old_middle), new_middle]]
+        if max(len(old_middle), len(new_middle)) > DeltaService.MAX_DIFF_REGION:
+            return single_edit
+
+        matcher = SequenceMatcher(None, old_middle, new_middle, autojunk=False)
+        pairs = sum(len(matcher.b2j.get(char, ())) for char in old_middle)
+        if pairs > DeltaService.MAX_DIFF_PAIRS or matcher.quick_ratio() < DeltaService.MIN_DIFF_RATIO:
+            return single_edit
+        return [
+            [prefix + i1, prefix + i2, new_middle[j1:j2]]
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+            if tag != "equal"
+        ]
+
+    @staticmethod
+    def apply_delta(old: str, delta: Delta) -> str:
+        parts = []
+        position = 0
+        for start, end, text in delta:
+            if start < position or end < start or end > len(old):
+                raise ValueError("Invalid delta for this content")
+            parts.append(old[position:start])
+            parts.append(text)
+            position = end
+        parts.append(old[position:])
+        return "".join(parts)
+
+    @staticmethod
+    def delta_size(delta: Delta) -> int:
+        """Approximate wire size of a delta, to compare with sending the full content"""
+        return sum(len(text) + 12 for _, _, text in delta)
@@ -0,0 +1,164 @@
+import itertools
+import json
+import threading
+from collections import deque
+from types import SimpleNamespace
+from typing import Any, Deque, Dict, Iterator, List, Set
+
+from services.metrics import EVENTS_DROPPED, EVENTS_PUBLISHED
+
+
+class Subscription:
+    """One connected client: the events waiting to be sent to it.
+
+    Publishers only append to `pending` and set `ready`, so they never wait
+    for a slow client. A client that falls more than `max_pending` events
+    behind is marked `overflowed`; its stream then asks it to resync.
+    """
+
+    def __init__(self, user_id: int, max_pending: int):
+        self.user_id = user_id
+        self.max_pending = max_pending
+        self.pending: Deque[dict] = deque()
+        self.ready = threading.Event()
+        self.overflowed = False
+
+    def push(self, event: dict) -> None:
+        if self.overflowed:
+            return
+        if len(self.pending) >= self.max_pending:
+            self.overflowed = True
+            self.pending.clear()
+            EVENTS_DROPPED.inc()
+        else:
+            self.pending.append(event)
+        self.ready.set()
+
+    def wait(self, timeout: float) -> List[dict]:
+        """Events published since the last call, waiting up to `timeout` for one"""
+        self.ready.wait(timeout)
+        self.ready.clear()
+        events = []
+        while self.pending:
+            events.append(self.pending.popleft())
+        return events
+
+
+class EventBroker:
+    """In-process fan-out of note and lock changes to connected clients.
+
+    Events are published after the change is committed. Each one goes to
+    the subscriptions of the users who can read the note (see
+    NoteService.can_read): subscriptions are indexed by user, so an event
+    on a private note only touches its owner's connections. The last
+    EVENTS_BACKLOG_SIZE events are kept so a client reconnecting with
+    Last-Event-ID gets what it missed.
+
+    Holding a connection costs no thread of its own: the stream waits on a
+    threading.Event, which serve.py monkey-patches with gevent, so an idle
+    client is a parked greenlet.
+    """
+
+    _subscribers: Dict[int, Set[Subscription]] = {}  # user id -> subscriptions
+    _backlog: Deque[dict] = deque(maxlen=1000)
+    _ids = itertools.count(1)
+    _last_id = 0
+    _lock = threading.Lock()
+    queue_size = 100
+    heartbeat_seconds = 15.0
+
+    @staticmethod
+    def init_app(app) -> None:
+        config = app.config
+        with EventBroker._lock:
+            EventBroker._backlog = deque(EventBroker._backlog, maxlen=config["EVENTS_BACKLOG_SIZE"])
+        EventBroker.queue_size = config["EVENTS_QUEUE_SIZE"]
+        EventBroker.heartbeat_seconds = config["EVENTS_HEARTBEAT_SECONDS"]
+
+    @staticmethod
+    def note_ref(note) -> SimpleNamespace:
+        """What the access check needs of a note, read before a commit expires it"""
+        return SimpleNamespace(id=note.id, owner_id=note.owner_id, visibility=note.visibility)
+
+    @staticmethod
+    def publish(event_type: str, note, data: Dict[str, Any]) -> None:
+        """Sends an event about `note` (a Note or a note_ref) to the users who can read it"""
+        from services.note_service import NoteService
+
+        with EventBroker._lock:
+            event_id = next(EventBroker._ids)
+            event = {"id": event_id, "type": event_type, "note": EventBroker.note_ref(note), "data": data}
+            EventBroker._backlog.append(event)
+            EventBroker._last_id = event_id
+            if note.visibility in ("read", "write"):
+                targets = [subscription for subscriptions in EventBroker._subscribers.values() for subscription in subscriptions]
+            else:
+                targets = list(EventBroker._subscribers.get(note.owner_id, ()))
+            for subscription in targets:
+                if NoteService.can_read(event["note"], subscription.user_id):
+                    subscription.push(event)
+        EVENTS_PUBLISHED.inc(type=event_type)
+
+    @staticmethod
+    def subscribe(user_id: int, last_event_id: int | None = None) -> Subscription:
+        """
+        Registers a client. With `last_event_id`, the events it missed are
+        queued first, or the subscription starts overflowed when they are
+        no longer in the backlog.
+        """
+        from services.note_service import NoteService
+
+        subscription = Subscription(user_id, EventBroker.queue_size)
+        with EventBroker._lock:
+            if last_event_id is not None and last_event_id < EventBroker._last_id:
+                oldest = EventBroker._backlog[0]["id"] if EventBroker._backlog else EventBroker._last_id + 1
+                if last_event_id < oldest - 1:
+                    subscription.overflowed = True
+                    subscription.ready.set()
+                else:
+                    for event in EventBroker._backlog:
+                        if event["id"] > last_event_id and NoteService.can_read(event["note"], user_id):
+                            subscription.push(event)
+            EventBroker._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    @staticmethod
+    def unsubscribe(subscription: Subscription) -> None:
+        with EventBroker._lock:
+            subscriptions = EventBroker._subscribers.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del EventBroker._subscribers[subscription.user_id]
+
+    @staticmethod
+    def subscriber_count() -> int:
+        with EventBroker._lock:
+            return sum(len(subscriptions) for subscriptions in EventBroker._subscribers.values())
+
+    @staticmethod
+    def format(event: dict) -> str:
+        return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'], default=str)}\n\n"
+
+    @staticmethod
+    def stream(subscription: Subscription) -> Iterator[str]:
+        """
+        Server-Sent Events for a subscription: the events as they come, a
+        comment line every heartbeat_seconds so proxies keep the connection
+        open, and a final "resync" event if the client fell too far behind
+        (it should then reload through /api/notes/changes and reconnect).
+        """
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                events = subscription.wait(EventBroker.heartbeat_seconds)
+                if subscription.overflowed:
+                    yield "event: resync\ndata: {}\n\n"
+                    return
+                if not events:
+                    yield ": keep-alive\n\n"
+                for event in events:
+                    yield EventBroker.format(event)
+        finally:
+            EventBroker.unsubscribe(subscription)
+
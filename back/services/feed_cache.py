@@ -0,0 +1,169 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from models.note import Note
+from services.metrics import CACHE_ENTRIES, CACHE_EVICTIONS, CACHE_HITS, CACHE_MISSES
+
+PUBLIC_VISIBILITIES = ("read", "write")
+
+
+class LRUCache:
+    """Bounded in-process mapping: least recently used entries are evicted
+    beyond `max_entries` and entries expire `ttl_seconds` after being stored.
+    Hits, misses and evictions are counted under `name` in the metrics.
+
+    `generation` changes on every invalidation; pass the value read before
+    computing an entry to `put` so a result computed from data that was
+    written in the meantime is not stored.
+    """
+
+    def __init__(self, name: str, max_entries: int = 256, ttl_seconds: float = 30):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.generation = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_entries: int, ttl_seconds: float) -> None:
+        with self._lock:
+            self.max_entries = max_entries
+            self.ttl_seconds = ttl_seconds
+            self._evict()
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                CACHE_EVICTIONS.inc(cache=self.name)
+                CACHE_ENTRIES.set(len(self._entries), cache=self.name)
+                entry = None
+            if entry is None:
+                CACHE_MISSES.inc(cache=self.name)
+                return default
+            self._entries.move_to_end(key)
+            CACHE_HITS.inc(cache=self.name)
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any, generation: int | None = None) -> bool:
+        with self._lock:
+            if self.max_entries <= 0 or (generation is not None and generation != self.generation):
+                return False
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            self._evict()
+            return True
+
+    def _evict(self) -> None:
+        while len(self._entries) > max(self.max_entries, 0):
+            self._entries.popitem(last=False)
+            CACHE_EVICTIONS.inc(cache=self.name)
+        CACHE_ENTRIES.set(len(self._entries), cache=self.name)
+
+    def discard(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """Removes the entries for which predicate(key, value) is true"""
+        with self._lock:
+            self.generation += 1
+            stale = [key for key, (_, value) in self._entries.items() if predicate(key, value)]
+            for key in stale:
+                del self._entries[key]
+            CACHE_ENTRIES.set(len(self._entries), cache=self.name)
+            return len(stale)
+
+    def clear(self) -> None:
+        self.discard(lambda key, value: True)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class FeedCache:
+    """Pages of the public notes feed, shared by all users.
+
+    An entry is keyed by (database url, before_id, limit, fields) and holds
+    the id window [lo, hi) its rows were read from, so a write to a public
+    note only drops the pages whose window contains that note. Notes written
+    through the ORM (the notes API and the replica's sync handlers) are
+    tracked by the session listeners below; other writes call mark_dirty or
+    invalidate_all.
+    """
+
+    cache = LRUCache("public_feed")
+
+    @staticmethod
+    def init_app(app) -> None:
+        FeedCache.cache.configure(app.config["PUBLIC_FEED_CACHE_SIZE"], app.config["PUBLIC_FEED_CACHE_TTL"])
+
+    @staticmethod
+    def get(key: Hashable) -> List[Dict[str, Any]] | None:
+        entry = FeedCache.cache.get(key)
+        return entry[2] if entry is not None else None
+
+    @staticmethod
+    def put(key: Hashable, window: Tuple[int, int | None], rows: List[Dict[str, Any]], generation: int) -> None:
+        FeedCache.cache.put(key, (*window, rows), generation)
+
+    @staticmethod
+    def invalidate(url: str, ranges) -> None:
+        """Drops the pages of `url` whose window overlaps one of the id ranges [lo, hi)"""
+        ranges = list(ranges)
+
+        def affected(key, entry):
+            window_lo, window_hi, _ = entry
+            return key[0] == url and any(
+                (window_hi is None or lo < window_hi) and hi > window_lo for lo, hi in ranges
+            )
+
+        FeedCache.cache.discard(affected)
+
+    @staticmethod
+    def mark_dirty(session, lo: int, hi: int) -> None:
+        """Invalidates the ids [lo, hi) when `session` commits, for writes the listeners cannot see"""
+        url = str(session.get_bind(mapper=Note.__mapper__).url)
+        session.info.setdefault("feed_dirty", set()).add((url, lo, hi))
+
+    @staticmethod
+    def invalidate_all(url: str | None = None) -> None:
+        """For bulk loads, which replace everything"""
+        FeedCache.cache.discard(lambda key, entry: url is None or key[0] == url)
+
+
+def _is_public(note: Note) -> bool:
+    history = inspect(note).attrs.visibility.history
+    return any(value in PUBLIC_VISIBILITIES for value in (note.visibility, *history.deleted))
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_public_notes(session, flush_context):
+    notes = [
+        obj for obj in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(obj, Note) and _is_public(obj)
+    ]
+    if notes:
+        dirty = session.info.setdefault("feed_dirty", set())
+        url = str(session.get_bind(mapper=Note.__mapper__).url)
+        dirty.update((url, note.id, note.id + 1) for note in notes if note.id is not None)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_public_notes(session):
+    dirty = session.info.pop("feed_dirty", None)
+    if not dirty:
+        return
+    by_url = {}
+    for url, lo, hi in dirty:
+        by_url.setdefault(url, []).append((lo, hi))
+    for url, ranges in by_url.items():
+        FeedCache.invalidate(url, ranges)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_public_notes(session):
+    session.info.pop("feed_dirty", None)
@@ -1,81 +1,208 @@
+from flask import current_app
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
 from models import db
-from models.lock import Lock
+from models.lock import Lock, utcnow
 from models.note import Note
+from services.event_broker import EventBroker
+from services.lock_table import LockTable
+from services.lock_waiters import LockWaitQueue
 from datetime import datetime, timedelta
+import time
 
 class LockService:
-    """Service to manage note locking in collaborative editing"""
-    
-    LOCK_TIMEOUT_MINUTES = 5  # Duration before automatic lock expiration
+    """Service to manage note locking in collaborative editing
+
+    Locks are leases of LOCK_LEASE_SECONDS: acquiring or renewing a lock
+    pushes its expiry back, and an expired lock is free for anyone to take.
+    The reaper worker clears expired locks so they also show as released.
+
+    With LOCK_MANAGER = "memory", the master keeps the leases in a
+    LockTable instead and the locks table is only its write-behind copy,
+    read back after a restart.
+    """
+
+    table: LockTable | None = None
+    waiters = LockWaitQueue()
+    _worker = None
+    _writer = None
+
+    @staticmethod
+    def init_app(app) -> None:
+        memory = app.config["LOCK_MANAGER"] == "memory" and app.config["SERVER_MODE"] == "master"
+        LockService.table = LockTable(app.config["LOCK_TABLE_STRIPES"]) if memory else None
+        LockService.waiters = LockWaitQueue(app.config["LOCK_WAIT_QUEUE_SIZE"])
+
+    @staticmethod
+    def memory_table() -> LockTable | None:
+        """The in-memory lock table if enabled, loaded from the locks table on first use"""
+        table = LockService.table
+        if table is not None and not table.loaded:
+            table.ensure_loaded(lambda: db.session.execute(
+                db.select(Lock.note_id, Lock.user_id, Lock.expires_at)
+                .where(Lock.locked.is_(True), Lock.expires_at > utcnow())
+            ).all())
+        return table
+
+    @staticmethod
+    def lease_expiry(now: datetime) -> datetime:
+        return now + timedelta(seconds=current_app.config["LOCK_LEASE_SECONDS"])
+
+    @staticmethod
+    def lock_info(note_id: int, lock: Lock | None, now: datetime | None = None) -> dict:
+        if lock is None or not lock.is_held(now):
+            return {"note_id": note_id, "locked": False, "user_id": None, "expires_at": None}
+        return {"note_id": note_id, "locked": True, "user_id": lock.user_id, "expires_at": lock.expires_at}
     
     @staticmethod
-    def acquire_lock(note_id: int, user_id: int) -> dict:
+    def acquire_lock(note_id: int, user_id: int, queued: bool = False) -> dict:
         """
         Attempts to acquire a lock on a note for a user.
         Returns dict with success, message, and lock info
         """
         # Check that the note exists
-        note = Note.query.get(note_id)
+        from services.note_service import NoteService
+        note = NoteService.get_note(note_id)
         if not note:
             return {"success": False, "error": "Note not found"}
         
         # Check write permissions
-        from services.note_service import NoteService
         if not NoteService.can_write(note, user_id):
             return {"success": False, "error": "Write access denied"}
         
-        # Find or create the lock
-        lock = Lock.query.filter_by(note_id=note_id).first()
-        
-        if not lock:
-            # Create new lock
-            lock = Lock(note_id=note_id, user_id=user_id, locked=True)
-            db.session.add(lock)
-            db.session.commit()
-            return {
-                "success": True,
-                "message": "Lock acquired",
-                "lock": {
-                    "note_id": note_id,
-                    "user_id": user_id,
-                    "locked": True
-                }
-            }
-        
-        # If lock already exists
-        if lock.locked:
-            if lock.user_id == user_id:
-                # Same user, renew the lock
-                return {
-                    "success": True,
-                    "message": "Lock renewed",
-                    "lock": {
-                        "note_id": note_id,
-                        "user_id": user_id,
-                        "locked": True
-                    }
-                }
-            else:
-                # Someone else has the lock
+        # Users waiting in the note's queue go first (see wait_for_lock)
+        if not queued and LockService.waiters.blocks(note_id, user_id):
+            holder = LockService.lock_holder(note)
+            if holder != user_id:
                 return {
                     "success": False,
-                    "error": "Note locked by another user",
-                    "locked_by_user_id": lock.user_id
+                    "error": "Other editors are waiting for this note",
+                    "locked_by_user_id": holder
                 }
+        
+        now = utcnow()
+        expires_at = LockService.lease_expiry(now)
+        note_ref = EventBroker.note_ref(note)
+        table = LockService.memory_table()
+        if table is not None:
+            granted, lease, renewed = table.acquire(note_id, user_id, now, expires_at)
+            holder = lease.user_id
         else:
-            # Lock available, acquire it
-            lock.locked = True
-            lock.user_id = user_id
-            db.session.commit()
+            granted, holder, renewed = LockService._acquire_in_database(note, user_id, now, expires_at)
+        
+        if not granted:
+            # Someone else has the lock
             return {
-                "success": True,
-                "message": "Lock acquired",
-                "lock": {
-                    "note_id": note_id,
-                    "user_id": user_id,
-                    "locked": True
-                }
+                "success": False,
+                "error": "Note locked by another user",
+                "locked_by_user_id": holder
             }
+        
+        info = {"note_id": note_id, "locked": True, "user_id": user_id, "expires_at": expires_at}
+        if not renewed:
+            EventBroker.publish("lock-acquired", note_ref, info)
+        return {
+            "success": True,
+            "message": "Lock renewed" if renewed else "Lock acquired",
+            "lock": info
+        }
+
+    @staticmethod
+    def wait_for_lock(note_id: int, user_id: int, timeout: float) -> dict:
+        """
+        acquire_lock, waiting up to `timeout` seconds for a held lock in the
+        note's FIFO queue: the first waiter tries again when the lock is
+        released or its lease runs out. Locks released by another process
+        are noticed within LOCK_WAIT_RECHECK_SECONDS.
+        """
+        result = LockService.acquire_lock(note_id, user_id)
+        if result["success"] or "locked_by_user_id" not in result or timeout <= 0:
+            return result
+        
+        waiter = LockService.waiters.join(note_id, user_id)
+        if waiter is None:
+            return {"success": False, "error": "Too many editors waiting for this note", "queue_full": True}
+        
+        deadline = time.monotonic() + timeout
+        recheck = current_app.config["LOCK_WAIT_RECHECK_SECONDS"]
+        try:
+            while True:
+                waiter.reset()
+                delay = recheck
+                if LockService.waiters.is_first(note_id, waiter):
+                    result = LockService.acquire_lock(note_id, user_id, queued=True)
+                    if result["success"] or "locked_by_user_id" not in result:
+                        return result
+                    # Woken by a release, or else when the current lease expires
+                    expires_at = LockService.get_lock_status(note_id)["expires_at"]
+                    if expires_at is not None:
+                        delay = min(delay, max((expires_at - utcnow()).total_seconds(), 0) + 0.01)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return result
+                # Give the connection back to the pool while parked
+                db.session.remove()
+                waiter.wait(min(delay, remaining))
+        finally:
+            LockService.waiters.leave(note_id, waiter)
+
+    @staticmethod
+    def _acquire_in_database(note: Note, user_id: int, now: datetime, expires_at: datetime) -> tuple:
+        """Returns (granted, user holding the lock, whether the user already held it)"""
+        # The lock loaded with the note only tells whether this is a renewal:
+        # who gets the lock is decided by the conditional upsert below
+        previous = note.lock
+        renewed = previous is not None and previous.is_held(now) and previous.user_id == user_id
+        
+        insert = sqlite_insert(Lock).values(note_id=note.id, user_id=user_id, locked=True, expires_at=expires_at)
+        result = db.session.execute(
+            insert.on_conflict_do_update(
+                index_elements=[Lock.note_id],
+                set_={"user_id": insert.excluded.user_id, "locked": True, "expires_at": insert.excluded.expires_at},
+                # Free, expired, or already ours
+                where=db.or_(
+                    Lock.locked.is_(False),
+                    Lock.expires_at.is_(None),
+                    Lock.expires_at <= now,
+                    Lock.user_id == user_id,
+                ),
+            ).returning(Lock.expires_at)
+        )
+        granted = result.scalar() is not None
+        db.session.commit()
+        
+        if granted:
+            return True, user_id, renewed
+        return False, db.session.scalar(db.select(Lock.user_id).where(Lock.note_id == note.id)), False
+
+    @staticmethod
+    def renew_lock(note_id: int, user_id: int) -> dict:
+        """
+        Extends the lease of a lock the user holds, in a single UPDATE.
+        Fails when the lease has already expired: the editor must acquire
+        the lock again, as someone else may have taken it meanwhile.
+        """
+        now = utcnow()
+        expires_at = LockService.lease_expiry(now)
+        table = LockService.memory_table()
+        if table is not None:
+            renewed = table.renew(note_id, user_id, now, expires_at) is not None
+        else:
+            result = db.session.execute(
+                db.update(Lock)
+                .where(Lock.note_id == note_id, Lock.user_id == user_id, Lock.locked.is_(True), Lock.expires_at > now)
+                .values(expires_at=expires_at)
+            )
+            db.session.commit()
+            renewed = result.rowcount > 0
+
+        if not renewed:
+            return {"success": False, "error": "Lock not held or expired"}
+        return {
+            "success": True,
+            "message": "Lock renewed",
+            "lock": {"note_id": note_id, "locked": True, "user_id": user_id, "expires_at": expires_at}
+        }
     
     @staticmethod
     def release_lock(note_id: int, user_id: int) -> dict:
@@ -83,42 +210,71 @@ class LockService:
         Releases the lock on a note.
         Only the lock owner or note owner can release.
         """
-        lock = Lock.query.filter_by(note_id=note_id).first()
-        
-        if not lock or not lock.locked:
+        from services.note_service import NoteService
+        note = NoteService.get_note(note_id)
+        if not note:
             return {"success": False, "error": "No active lock on this note"}
         
-        # Check that it's the right user
-        note = Note.query.get(note_id)
-        if lock.user_id != user_id and note.owner_id != user_id:
+        # The note owner may release anyone's lock, others only their own
+        holder = None if note.owner_id == user_id else user_id
+        note_ref = EventBroker.note_ref(note)
+        table = LockService.memory_table()
+        if table is not None:
+            released, lease = table.release(note_id, holder)
+            held = lease is not None
+        else:
+            conditions = [Lock.note_id == note_id, Lock.locked.is_(True)]
+            if holder is not None:
+                conditions.append(Lock.user_id == holder)
+            result = db.session.execute(
+                db.update(Lock).where(*conditions).values(locked=False, user_id=None, expires_at=None),
+                execution_options={"synchronize_session": False},
+            )
+            db.session.commit()
+            released = result.rowcount > 0
+            held = released or bool(db.session.scalar(db.select(Lock.locked).where(Lock.note_id == note_id)))
+        
+        if not released:
+            if not held:
+                return {"success": False, "error": "No active lock on this note"}
+            # Check that it's the right user
             return {"success": False, "error": "Cannot release lock owned by another user"}
         
-        lock.locked = False
-        lock.user_id = None
-        db.session.commit()
+        LockService.announce_release(note_ref)
         
         return {
             "success": True,
             "message": "Lock released"
         }
     
+    @staticmethod
+    def announce_release(note) -> None:
+        """Tells the event stream and the note's waiters that its lock is free"""
+        EventBroker.publish("lock-released", note, LockService.lock_info(note.id, None))
+        LockService.waiters.wake(note.id)
+    
     @staticmethod
     def get_lock_status(note_id: int) -> dict:
         """Returns the lock status of a note"""
-        lock = Lock.query.filter_by(note_id=note_id).first()
-        
-        if not lock:
-            return {
-                "note_id": note_id,
-                "locked": False,
-                "user_id": None
-            }
+        table = LockService.memory_table()
+        if table is not None:
+            lease = table.status(note_id, utcnow())
+            if lease is None:
+                return LockService.lock_info(note_id, None)
+            return {"note_id": note_id, "locked": True, "user_id": lease.user_id, "expires_at": lease.expires_at}
         
-        return {
-            "note_id": note_id,
-            "locked": lock.locked,
-            "user_id": lock.user_id
-        }
+        from services.note_service import NoteService
+        note = NoteService.get_note(note_id)
+        return LockService.lock_info(note_id, note.lock if note else None)
+    
+    @staticmethod
+    def lock_holder(note: Note) -> int | None:
+        """The user holding a live lock on a loaded note, if any"""
+        table = LockService.memory_table()
+        if table is not None:
+            lease = table.status(note.id, utcnow())
+            return lease.user_id if lease is not None else None
+        return note.lock.user_id if note.lock is not None and note.lock.is_held() else None
     
     @staticmethod
     def force_release_lock(note_id: int) -> dict:
@@ -126,16 +282,156 @@ class LockService:
         Forces the release of a lock (admin or timeout).
         Use with caution.
         """
-        lock = Lock.query.filter_by(note_id=note_id).first()
-        
-        if not lock:
-            return {"success": False, "error": "No lock found"}
-        
-        lock.locked = False
-        lock.user_id = None
-        db.session.commit()
+        table = LockService.memory_table()
+        if table is not None:
+            from services.note_service import NoteService
+            released, _ = table.release(note_id)
+            note = NoteService.get_note(note_id) if released else None
+            if note is None:
+                return {"success": False, "error": "No lock found"}
+            note_ref = EventBroker.note_ref(note)
+        else:
+            lock = Lock.query.filter_by(note_id=note_id).first()
+            
+            if not lock:
+                return {"success": False, "error": "No lock found"}
+            
+            lock.locked = False
+            lock.user_id = None
+            lock.expires_at = None
+            note_ref = EventBroker.note_ref(lock.note)
+            db.session.commit()
+        LockService.announce_release(note_ref)
         
         return {
             "success": True,
             "message": "Lock forcefully released"
-        }
\ No newline at end of file
+        }
+
+    @staticmethod
+    def expired_leases_query(now: datetime, limit: int):
+        """Oldest expired locks first, read from the expiry index"""
+        return (
+            db.select(Lock.note_id.label("id"), Note.owner_id, Note.visibility)
+            .join(Note, Note.id == Lock.note_id)
+            .where(Lock.expires_at <= now)
+            .order_by(Lock.expires_at)
+            .limit(limit)
+        )
+
+    @staticmethod
+    def expire_leases(batch_size: int | None = None) -> int:
+        """
+        Releases the locks whose lease has expired, `batch_size` per
+        transaction, and publishes lock-released for each of them.
+        Returns the number of locks released.
+        """
+        now = utcnow()
+        table = LockService.memory_table()
+        if table is not None:
+            note_ids = table.expire(now)
+            if note_ids:
+                notes = db.session.execute(
+                    db.select(Note.id, Note.owner_id, Note.visibility).where(Note.id.in_(note_ids))
+                ).all()
+                for note in notes:
+                    LockService.announce_release(note)
+            return len(note_ids)
+        
+        batch_size = batch_size or current_app.config["LOCK_REAPER_BATCH_SIZE"]
+        released = 0
+        while True:
+            rows = db.session.execute(LockService.expired_leases_query(now, batch_size)).all()
+            if not rows:
+                break
+            # A lease renewed since the SELECT is left alone
+            note_ids = set(db.session.scalars(
+                db.update(Lock)
+                .where(Lock.note_id.in_([row.id for row in rows]), Lock.expires_at <= now)
+                .values(locked=False, user_id=None, expires_at=None)
+                .returning(Lock.note_id),
+                execution_options={"synchronize_session": False},
+            ))
+            db.session.commit()
+            for row in rows:
+                if row.id in note_ids:
+                    LockService.announce_release(row)
+            released += len(note_ids)
+            if len(rows) < batch_size:
+                break
+        return released
+
+    @staticmethod
+    def write_behind() -> int:
+        """
+        Copies the changes of the in-memory lock table to the locks table,
+        so a restarted master gets its leases back. Returns the number of
+        locks written.
+        """
+        table = LockService.table
+        dirty = table.take_dirty() if table is not None else {}
+        if not dirty:
+            return 0
+        
+        try:
+            held = {note_id: lease for note_id, lease in dirty.items() if lease is not None}
+            if held:
+                # Notes deleted since are skipped
+                existing = set(db.session.scalars(db.select(Note.id).where(Note.id.in_(held))))
+                rows = [
+                    {"note_id": note_id, "user_id": lease.user_id, "locked": True, "expires_at": lease.expires_at}
+                    for note_id, lease in held.items() if note_id in existing
+                ]
+                if rows:
+                    insert = sqlite_insert(Lock)
+                    db.session.execute(insert.on_conflict_do_update(
+                        index_elements=[Lock.note_id],
+                        set_={"user_id": insert.excluded.user_id, "locked": True, "expires_at": insert.excluded.expires_at},
+                    ), rows)
+            released = [note_id for note_id, lease in dirty.items() if lease is None]
+            if released:
+                db.session.execute(
+                    db.update(Lock).where(Lock.note_id.in_(released)).values(locked=False, user_id=None, expires_at=None),
+                    execution_options={"synchronize_session": False},
+                )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            table.restore_dirty(dirty)
+            raise
+        return len(dirty)
+
+    @staticmethod
+    def ensure_lock_leases() -> None:
+        """Adds expires_at and its index to a locks table created before leases existed"""
+        if db.engine.dialect.name != "sqlite":
+            return
+        columns = {row[1] for row in db.session.execute(db.text("PRAGMA table_info(locks)"))}
+        if "expires_at" in columns:
+            return
+        # Locks taken before leases have no expiry: they count as released
+        db.session.execute(db.text("ALTER TABLE locks ADD COLUMN expires_at DATETIME"))
+        db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_locks_expires_at ON locks (expires_at)"))
+        db.session.commit()
+
+    @staticmethod
+    def start_worker(app):
+        from services.background import BackgroundWorker
+
+        if LockService._worker is None:
+            LockService._worker = BackgroundWorker(
+                app,
+                LockService.expire_leases,
+                app.config["LOCK_REAPER_INTERVAL_SECONDS"],
+                name="lock-reaper",
+            )
+            LockService._worker.start()
+        if LockService.table is not None and LockService._writer is None:
+            LockService._writer = BackgroundWorker(
+                app,
+                LockService.write_behind,
+                app.config["LOCK_TABLE_FLUSH_SECONDS"],
+                name="lock-write-behind",
+            )
+            LockService._writer.start()
+        return LockService._worker
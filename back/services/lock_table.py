@@ -0,0 +1,126 @@
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, NamedTuple, Tuple
+
+
+class Lease(NamedTuple):
+    user_id: int
+    expires_at: datetime
+
+
+class LockTable:
+    """Lock leases held in memory, authoritative for the master process.
+
+    Leases are spread over `stripes` dicts by note id, each with its own
+    mutex, so operations on different notes rarely wait for each other and
+    none of them touches the database. Every change is also recorded in a
+    dirty map that LockService writes to the locks table in the background
+    (write-behind); after a restart, the table is loaded back from there.
+    Only valid with a single master process: another process would have
+    its own table.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._stripes: List[Tuple[Dict[int, Lease], threading.Lock]] = [
+            ({}, threading.Lock()) for _ in range(max(stripes, 1))
+        ]
+        self._dirty: Dict[int, Lease | None] = {}  # note id -> lease, None once released
+        self._dirty_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.loaded = False
+
+    def _stripe(self, note_id: int) -> Tuple[Dict[int, Lease], threading.Lock]:
+        return self._stripes[note_id % len(self._stripes)]
+
+    def _mark(self, note_id: int, lease: Lease | None) -> None:
+        # Called with the note's stripe held, so the dirty map sees each note's changes in order
+        with self._dirty_lock:
+            self._dirty[note_id] = lease
+
+    def ensure_loaded(self, read_leases: Callable[[], Iterable[Tuple[int, int, datetime]]]) -> None:
+        """Fills the table once from read_leases() -> (note_id, user_id, expires_at) rows"""
+        if self.loaded:
+            return
+        with self._load_lock:
+            if self.loaded:
+                return
+            for note_id, user_id, expires_at in read_leases():
+                leases, mutex = self._stripe(note_id)
+                with mutex:
+                    leases.setdefault(note_id, Lease(user_id, expires_at))
+            self.loaded = True
+
+    def acquire(self, note_id: int, user_id: int, now: datetime, expires_at: datetime) -> Tuple[bool, Lease, bool]:
+        """
+        Takes or renews the lease unless another user holds a live one.
+        Returns (granted, the lease holding the note, whether the user already held it).
+        """
+        leases, mutex = self._stripe(note_id)
+        with mutex:
+            current = leases.get(note_id)
+            held = current is not None and current.expires_at > now
+            if held and current.user_id != user_id:
+                return False, current, False
+            lease = Lease(user_id, expires_at)
+            leases[note_id] = lease
+            self._mark(note_id, lease)
+            return True, lease, held
+
+    def renew(self, note_id: int, user_id: int, now: datetime, expires_at: datetime) -> Lease | None:
+        """Extends a live lease of the user; None when it does not hold one"""
+        leases, mutex = self._stripe(note_id)
+        with mutex:
+            current = leases.get(note_id)
+            if current is None or current.user_id != user_id or current.expires_at <= now:
+                return None
+            lease = Lease(user_id, expires_at)
+            leases[note_id] = lease
+            self._mark(note_id, lease)
+            return lease
+
+    def release(self, note_id: int, user_id: int | None = None) -> Tuple[bool, Lease | None]:
+        """
+        Drops the lease if it belongs to `user_id` (anyone's when None).
+        Returns (released, the lease found).
+        """
+        leases, mutex = self._stripe(note_id)
+        with mutex:
+            current = leases.get(note_id)
+            if current is None or (user_id is not None and current.user_id != user_id):
+                return False, current
+            del leases[note_id]
+            self._mark(note_id, None)
+            return True, current
+
+    def status(self, note_id: int, now: datetime) -> Lease | None:
+        """The live lease on the note, if any"""
+        leases, mutex = self._stripe(note_id)
+        with mutex:
+            current = leases.get(note_id)
+        return current if current is not None and current.expires_at > now else None
+
+    def expire(self, now: datetime) -> List[int]:
+        """Drops the expired leases; returns their note ids"""
+        expired = []
+        for leases, mutex in self._stripes:
+            with mutex:
+                for note_id in [note_id for note_id, lease in leases.items() if lease.expires_at <= now]:
+                    del leases[note_id]
+                    self._mark(note_id, None)
+                    expired.append(note_id)
+        return expired
+
+    def take_dirty(self) -> Dict[int, Lease | None]:
+        """The changes not written yet, forgotten until given back with restore_dirty"""
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, {}
+        return dirty
+
+    def restore_dirty(self, dirty: Dict[int, Lease | None]) -> None:
+        """Puts back changes that could not be written, unless the note changed since"""
+        with self._dirty_lock:
+            for note_id, lease in dirty.items():
+                self._dirty.setdefault(note_id, lease)
+
+    def __len__(self) -> int:
+        return sum(len(leases) for leases, _ in self._stripes)
@@ -0,0 +1,87 @@
+import threading
+from collections import deque
+from typing import Deque, Dict
+
+
+class Waiter:
+    """A request parked until it may try to take a note's lock"""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._event = threading.Event()
+
+    def wake(self) -> None:
+        self._event.set()
+
+    def reset(self) -> None:
+        """Forgets earlier wake-ups. Called before checking the lock, so a
+        wake-up arriving after the check is kept for the next `wait`."""
+        self._event.clear()
+
+    def wait(self, timeout: float) -> None:
+        self._event.wait(timeout)
+
+
+class LockWaitQueue:
+    """Editors waiting for notes' locks, first come first served.
+
+    Only the first waiter of a note tries to take the lock; it is woken
+    when the lock is released or expires, and the next one when it leaves
+    the queue. While a note has waiters, other users cannot take its lock
+    without queueing (see `blocks`), so the lock goes to them in order.
+    Each note's queue holds at most `max_waiters`.
+    """
+
+    def __init__(self, max_waiters: int = 16):
+        self.max_waiters = max_waiters
+        self._queues: Dict[int, Deque[Waiter]] = {}
+        self._mutex = threading.Lock()
+
+    def join(self, note_id: int, user_id: int) -> Waiter | None:
+        """Queues a waiter; None when the note's queue is full"""
+        with self._mutex:
+            queue = self._queues.setdefault(note_id, deque())
+            if len(queue) >= self.max_waiters:
+                if not queue:
+                    del self._queues[note_id]
+                return None
+            waiter = Waiter(user_id)
+            queue.append(waiter)
+            return waiter
+
+    def leave(self, note_id: int, waiter: Waiter) -> None:
+        """Removes a waiter (served or timed out) and lets the next one try"""
+        with self._mutex:
+            queue = self._queues.get(note_id)
+            if queue is None:
+                return
+            try:
+                queue.remove(waiter)
+            except ValueError:
+                return
+            if not queue:
+                del self._queues[note_id]
+            else:
+                queue[0].wake()
+
+    def is_first(self, note_id: int, waiter: Waiter) -> bool:
+        with self._mutex:
+            queue = self._queues.get(note_id)
+            return bool(queue) and queue[0] is waiter
+
+    def blocks(self, note_id: int, user_id: int) -> bool:
+        """Whether others wait for the note ahead of `user_id`"""
+        with self._mutex:
+            queue = self._queues.get(note_id)
+            return bool(queue) and queue[0].user_id != user_id
+
+    def wake(self, note_id: int) -> None:
+        """Lets the first waiter of the note try again"""
+        with self._mutex:
+            queue = self._queues.get(note_id)
+            if queue:
+                queue[0].wake()
+
+    def waiting(self, note_id: int) -> int:
+        with self._mutex:
+            return len(self._queues.get(note_id, ()))
@@ -0,0 +1,234 @@
+import hashlib
+import threading
+from typing import Dict, List, Tuple
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db
+from models.note import Note
+
+
+class MerkleService:
+    """Hash tree over the notes table, used to find master/replica divergence.
+
+    Leaves are buckets of MERKLE_BUCKET_SIZE consecutive note ids, hashed
+    over (id, visibility, title, content). An interior node is the hash of
+    the non-empty leaves below it, for any bucket-aligned id range. Leaf
+    hashes are cached per database and invalidated when notes are written
+    through the ORM, so a node only rescans the buckets that changed.
+
+    `reconcile` walks the tree top-down against a replica, MERKLE_FANOUT
+    children per level, and re-syncs only the leaf ranges that differ.
+    """
+
+    _leaves: Dict[str, Dict[int, bytes]] = {}  # database url -> bucket -> leaf hash
+    _generations: Dict[str, int] = {}  # database url -> invalidation counter
+    _lock = threading.Lock()
+    _worker = None
+
+    @staticmethod
+    def invalidate(url: str, buckets) -> None:
+        with MerkleService._lock:
+            MerkleService._generations[url] = MerkleService._generations.get(url, 0) + 1
+            leaves = MerkleService._leaves.get(url)
+            if leaves:
+                for bucket in buckets:
+                    leaves.pop(bucket, None)
+
+    @staticmethod
+    def mark_dirty(session, note_ids) -> None:
+        """Invalidates the buckets of `note_ids` when `session` commits, for writes that bypass the ORM"""
+        url = str(session.get_bind(mapper=Note.__mapper__).url)
+        session.info.setdefault("merkle_dirty", set()).update((url, note_id) for note_id in note_ids)
+
+    @staticmethod
+    def invalidate_all() -> None:
+        """For writes that bypass the ORM (bulk loads)"""
+        url = str(db.engine.url)
+        with MerkleService._lock:
+            MerkleService._generations[url] = MerkleService._generations.get(url, 0) + 1
+            MerkleService._leaves.pop(url, None)
+
+    @staticmethod
+    def _compute_leaves(first: int, last: int) -> Dict[int, bytes]:
+        """
+        Hashes the buckets first..last (inclusive) with a single range scan.
+        Results are cached unless notes were written in the meantime.
+        """
+        size = current_app.config["MERKLE_BUCKET_SIZE"]
+        url = str(db.engine.url)
+        with MerkleService._lock:
+            generation = MerkleService._generations.get(url, 0)
+        computed = {bucket: hashlib.sha256() for bucket in range(first, last + 1)}
+        rows = db.session.execute(
+            db.select(Note.id, Note.visibility, Note.title, Note.content)
+            .where(Note.id >= first * size, Note.id < (last + 1) * size)
+            .order_by(Note.id)
+            .execution_options(yield_per=1000)
+        )
+        for note_id, visibility, title, content in rows:
+            computed[note_id // size].update(f"{note_id}\x1f{visibility}\x1f{title}\x1f{content}\x1e".encode("utf-8"))
+
+        leaves = {bucket: digest.digest() for bucket, digest in computed.items()}
+        with MerkleService._lock:
+            if MerkleService._generations.get(url, 0) == generation:
+                MerkleService._leaves.setdefault(url, {}).update(leaves)
+        return leaves
+
+    @staticmethod
+    def max_id() -> int:
+        return db.session.query(db.func.max(Note.id)).scalar() or 0
+
+    @staticmethod
+    def range_hashes(ranges: List[Tuple[int, int]]) -> List[str]:
+        """Hashes of the notes in each bucket-aligned id range [lo, hi)"""
+        size = current_app.config["MERKLE_BUCKET_SIZE"]
+        with MerkleService._lock:
+            leaves = dict(MerkleService._leaves.get(str(db.engine.url), {}))
+        last_bucket = MerkleService.max_id() // size
+        empty = hashlib.sha256().digest()
+
+        hashes = []
+        for lo, hi in ranges:
+            buckets = range(lo // size, min(-(-hi // size), last_bucket + 1))
+            missing = [bucket for bucket in buckets if bucket not in leaves]
+            # Rescan contiguous runs of missing buckets
+            start = None
+            for index, bucket in enumerate(missing):
+                if start is None:
+                    start = bucket
+                if index + 1 == len(missing) or missing[index + 1] != bucket + 1:
+                    leaves.update(MerkleService._compute_leaves(start, bucket))
+                    start = None
+
+            node = hashlib.sha256()
+            for bucket in buckets:
+                leaf = leaves.get(bucket, empty)
+                if leaf != empty:
+                    node.update(bucket.to_bytes(8, "big") + leaf)
+            hashes.append(node.hexdigest())
+        return hashes
+
+    @staticmethod
+    def reconcile(replica) -> List[Tuple[int, int]]:
+        """
+        Compares the notes tree with a replica's and re-syncs differing ranges.
+        Skipped while the replica is still applying the log, since in-flight
+        changes would show up as differences, unless its deliveries keep
+        failing: a stuck replica would otherwise never be repaired.
+        Returns the repaired id ranges.
+        """
+        from services.sync_service import SyncService
+
+        config = current_app.config
+        size = config["MERKLE_BUCKET_SIZE"]
+        fanout = config["MERKLE_FANOUT"]
+        head_lsn = SyncService.get_head_lsn()
+
+        remote = replica.decode(replica.post("/api/sync/merkle", {"ranges": []}))
+        if remote["last_lsn"] < head_lsn and not SyncService.is_stuck(replica.url):
+            current_app.logger.info(f"Skipping anti-entropy with {replica.url}: replica is behind the log")
+            return []
+
+        domain = size
+        while domain <= max(MerkleService.max_id(), remote["max_id"]):
+            domain *= fanout
+
+        differing = [(0, domain)]
+        leaves = []
+        while differing:
+            remote_hashes = replica.decode(replica.post("/api/sync/merkle", {"ranges": differing}))["hashes"]
+            local_hashes = MerkleService.range_hashes(differing)
+
+            children = []
+            for (lo, hi), local, remote_hash in zip(differing, local_hashes, remote_hashes):
+                if local == remote_hash:
+                    continue
+                if hi - lo <= size:
+                    leaves.append((lo, hi))
+                else:
+                    step = (hi - lo) // fanout
+                    children.extend((start, start + step) for start in range(lo, hi, step))
+            differing = children
+
+        if leaves:
+            operations = [MerkleService.range_operation(lo, hi) for lo, hi in leaves]
+            SyncService.send_batch(replica, operations, None, None)
+            current_app.logger.warning(f"Anti-entropy repaired {len(leaves)} note range(s) on {replica.url}")
+        return leaves
+
+    @staticmethod
+    def range_operation(lo: int, hi: int) -> dict:
+        """Sync operation replacing the replica's notes in [lo, hi) with the master's"""
+        notes = Note.query.filter(Note.id >= lo, Note.id < hi).order_by(Note.id).all()
+        return {
+            "operation": "replace_note_range",
+            "data": {
+                "lo": lo,
+                "hi": hi,
+                "notes": [
+                    {
+                        "id": note.id,
+                        "owner_id": note.owner_id,
+                        "title": note.title,
+                        "content": note.content,
+                        "visibility": note.visibility,
+                        "version": note.version,
+                    }
+                    for note in notes
+                ],
+            },
+        }
+
+    @staticmethod
+    def reconcile_all() -> None:
+        from services.sync_service import SyncService
+
+        for replica in SyncService.get_replicas():
+            try:
+                MerkleService.reconcile(replica)
+            except Exception as e:
+                current_app.logger.warning(f"Anti-entropy with {replica.url} failed: {e}")
+
+    @staticmethod
+    def start_worker(app):
+        from services.background import BackgroundWorker
+
+        if MerkleService._worker is None:
+            MerkleService._worker = BackgroundWorker(
+                app,
+                MerkleService.reconcile_all,
+                app.config["MERKLE_INTERVAL_SECONDS"],
+                name="anti-entropy",
+            )
+            MerkleService._worker.start()
+        return MerkleService._worker
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_dirty_buckets(session, flush_context):
+    notes = [obj for obj in (*session.new, *session.dirty, *session.deleted) if isinstance(obj, Note)]
+    if notes:
+        dirty = session.info.setdefault("merkle_dirty", set())
+        url = str(session.get_bind(mapper=Note.__mapper__).url)
+        dirty.update((url, note.id) for note in notes if note.id is not None)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_dirty_buckets(session):
+    dirty = session.info.pop("merkle_dirty", None)
+    if not dirty:
+        return
+    size = current_app.config["MERKLE_BUCKET_SIZE"]
+    by_url = {}
+    for url, note_id in dirty:
+        by_url.setdefault(url, set()).add(note_id // size)
+    for url, buckets in by_url.items():
+        MerkleService.invalidate(url, buckets)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_dirty_buckets(session):
+    session.info.pop("merkle_dirty", None)
@@ -0,0 +1,237 @@
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """A named family of samples, one per combination of label values"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, key: LabelValues, extra: Dict[str, str] | None = None) -> str:
+        pairs = list(zip(self.labels, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in pairs) + "}"
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._label_text(key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(Metric):
+    """Either set directly, or computed at scrape time by `callback`
+    (returning {label values tuple: value})"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 callback: Callable[[], Dict[LabelValues, float]] | None = None):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self) -> List[str]:
+        if self.callback is not None:
+            values = sorted(self.callback().items())
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+        return [f"{self.name}{self._label_text(key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            counts = self._counts.get(self._key(labels))
+            return counts[-1] if counts else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            series = sorted((key, list(counts), self._sums[key]) for key, counts in self._counts.items())
+        lines = []
+        for key, counts, total in series:
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{self._label_text(key, {'le': _format_value(bound)})} {count}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {counts[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process-wide metrics, rendered in the Prometheus text exposition format"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Iterable[str] = (), callback=None) -> Gauge:
+        return self.register(Gauge(name, help, labels, callback))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (), **kwargs) -> Histogram:
+        return self.register(Histogram(name, help, labels, **kwargs))
+
+    def get(self, name: str) -> Metric:
+        return self._metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+# Master side: delivery to the replicas
+SYNC_OPERATIONS_SENT = REGISTRY.counter(
+    "sync_operations_sent_total", "Logged changes delivered to a replica", ["replica"])
+SYNC_SEND_FAILURES = REGISTRY.counter(
+    "sync_send_failures_total", "Failed batch deliveries to a replica", ["replica"])
+SYNC_DEAD_LETTERS = REGISTRY.counter(
+    "sync_dead_letters_total", "Logged changes a replica kept rejecting, skipped", ["replica"])
+SYNC_BYTES_SENT = REGISTRY.counter(
+    "sync_bytes_sent_total", "Request body bytes sent to a replica, after compression", ["replica"])
+SYNC_BATCH_DURATION = REGISTRY.histogram(
+    "sync_batch_duration_seconds", "Round trip time of batch deliveries", ["replica"])
+
+# Replica side: applying changes
+SYNC_OPERATIONS_APPLIED = REGISTRY.counter(
+    "sync_operations_applied_total", "Replicated operations applied", ["operation"])
+SYNC_OPERATIONS_FAILED = REGISTRY.counter(
+    "sync_operations_failed_total", "Replicated operations that failed to apply", ["operation"])
+SYNC_APPLY_DURATION = REGISTRY.histogram(
+    "sync_apply_duration_seconds", "Time to apply one replicated operation", ["operation"])
+SYNC_BYTES_RECEIVED = REGISTRY.counter(
+    "sync_bytes_received_total", "Request body bytes received on the sync endpoints", ["endpoint"])
+SYNC_REQUEST_DURATION = REGISTRY.histogram(
+    "sync_request_duration_seconds", "Time to handle sync endpoint requests", ["endpoint"])
+
+# In-process caches
+CACHE_HITS = REGISTRY.counter("cache_hits_total", "Lookups answered from the cache", ["cache"])
+CACHE_MISSES = REGISTRY.counter("cache_misses_total", "Lookups not found in the cache, or expired", ["cache"])
+CACHE_EVICTIONS = REGISTRY.counter(
+    "cache_evictions_total", "Entries dropped because they expired or the cache was full", ["cache"])
+CACHE_ENTRIES = REGISTRY.gauge("cache_entries", "Entries currently held by the cache", ["cache"])
+
+# Event stream
+EVENTS_PUBLISHED = REGISTRY.counter("events_published_total", "Note and lock events published", ["type"])
+EVENTS_DROPPED = REGISTRY.counter(
+    "events_dropped_total", "Event stream clients told to resync because they fell too far behind")
+
+
+def _replica_backlog(index: int) -> Dict[LabelValues, float]:
+    from services.sync_service import SyncService
+
+    return {(url,): values[index] for url, values in SyncService.backlog().items()}
+
+
+def _outbox_depth() -> Dict[LabelValues, float]:
+    from services.sync_service import SyncService
+
+    return {(): SyncService.outbox_depth()}
+
+
+def _applied_lsn() -> Dict[LabelValues, float]:
+    from services.replica_service import ReplicaService
+
+    return {(): ReplicaService.get_applied_lsn()}
+
+
+def _event_subscribers() -> Dict[LabelValues, float]:
+    from services.event_broker import EventBroker
+
+    return {(): EventBroker.subscriber_count()}
+
+
+# Computed from the database at scrape time
+REGISTRY.gauge("sync_outbox_depth", "Changes in the master's outbox", callback=_outbox_depth)
+REGISTRY.gauge("sync_replica_pending_operations", "Logged changes not yet delivered to a replica",
+               ["replica"], callback=lambda: _replica_backlog(0))
+REGISTRY.gauge("sync_replica_lag_seconds", "Age of the oldest change not yet delivered to a replica",
+               ["replica"], callback=lambda: _replica_backlog(1))
+REGISTRY.gauge("sync_applied_lsn", "Last log position applied by this replica", callback=_applied_lsn)
+REGISTRY.gauge("events_subscribers", "Clients connected to the event stream", callback=_event_subscribers)
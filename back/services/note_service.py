@@ -1,9 +1,30 @@
+import re
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
 from flask import current_app
+from sqlalchemy.orm import joinedload
 
 from models import db
-from models.note import Note
+from models.note import Note, NOTES_CHANGES_DDL, NOTES_FTS_DDL
+from models.note_change import NoteChangeCounter, NoteTombstone
+from models.user import User
+from services.delta_service import DeltaService
+from services.event_broker import EventBroker
+from services.feed_cache import FeedCache, PUBLIC_VISIBILITIES
+from services.lock_service import LockService
+from services.merkle_service import MerkleService
 from services.sync_service import SyncService
+
+
+class ChangesCursorExpired(Exception):
+	"""The changes cursor comes from another database, or from before it was reset"""
+
+
 class NoteService:
+	# Fields a listing can return; "preview" is the start of the content
+	LISTING_FIELDS = ("id", "title", "content", "preview", "created_at", "updated_at", "is_owner", "visibility", "owner_name")
+
 	@staticmethod
 	def can_read(note: Note, user_id: int | None) -> bool:
 		if user_id is not None and note.owner_id == user_id:
@@ -17,7 +38,19 @@ class NoteService:
 		return note.visibility == "write"
 
 	@staticmethod
-	def create_note(owner_id: int, title: str, content: str = "", visibility: str = "private") -> Note:
+	def event_data(note) -> dict:
+		"""What the event stream sends about a note; clients fetch the content if they need it"""
+		return {
+			"id": note.id,
+			"title": note.title,
+			"owner_id": note.owner_id,
+			"visibility": note.visibility,
+			"version": note.version,
+		}
+
+	@staticmethod
+	def validate_note(title: str, content: str, visibility: str | None = None) -> None:
+		"""Raises ValueError when a note cannot be saved with these values"""
 		if not title or not title.strip():
 			raise ValueError("Title cannot be empty")
 		
@@ -27,76 +60,497 @@ class NoteService:
 		if len(content) > 10000:
 			raise ValueError("Content cannot exceed 10000 characters")
 		
-		if visibility not in ["private", "read", "write"]:
+		if visibility is not None and visibility not in ["private", "read", "write"]:
 			raise ValueError("Invalid visibility value")
+
+	@staticmethod
+	def create_note(owner_id: int, title: str, content: str = "", visibility: str = "private") -> Note:
+		NoteService.validate_note(title, content, visibility)
 		
 		note = Note(owner_id=owner_id, title=title.strip(), content=content.strip(), visibility=visibility)
 		db.session.add(note)
-		db.session.commit()
 		
-		if current_app.config.get("SERVER_MODE") == "master":
-			SyncService.sync_to_replica("create_note", {
+		is_master = current_app.config.get("SERVER_MODE") == "master"
+		if is_master:
+			db.session.flush()  # assigns note.id for the outbox payload
+			SyncService.enqueue("create_note", {
 				"id": note.id,
 				"owner_id": owner_id,
 				"title": title,
 				"content": content,
-				"visibility": visibility
+				"visibility": visibility,
+				"version": note.version
 			})
+		db.session.commit()
+		
+		if is_master:
+			SyncService.notify()
+		EventBroker.publish("note-created", note, NoteService.event_data(note))
 		return note
 
 	@staticmethod
-	def get_user_notes(user_id: int):
-		return Note.query.filter_by(owner_id=user_id).all()
+	def check_fields(fields):
+		"""The listing fields asked for, all but "preview" when None; raises ValueError on unknown ones"""
+		if fields is None:
+			return [field for field in NoteService.LISTING_FIELDS if field != "preview"]
+		unknown = set(fields) - set(NoteService.LISTING_FIELDS)
+		if unknown:
+			raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+		return fields
+
+	@staticmethod
+	def listing_columns(fields):
+		"""Labeled columns for the listing `fields`; "owner_name" needs a join with User"""
+		columns = {
+			"id": Note.id,
+			"title": Note.title,
+			"content": Note.content,
+			"preview": db.func.substr(Note.content, 1, current_app.config["NOTES_PREVIEW_LENGTH"]),
+			"created_at": Note.created_at,
+			"updated_at": Note.updated_at,
+			"visibility": Note.visibility,
+			"owner_name": User.nom,
+		}
+		return [columns[field].label(field) for field in fields if field in columns]
+
+	@staticmethod
+	def listing_notes(rows, fields, user_id: int | None):
+		"""Note dicts with the requested `fields` from listing rows"""
+		notes = []
+		for row in rows:
+			note = {field: row[field] for field in fields if field != "is_owner"}
+			if "is_owner" in fields:
+				note["is_owner"] = user_id is not None and row["cursor_owner"] == user_id
+			notes.append({field: note[field] for field in fields})
+		return notes
+
+	@staticmethod
+	def listing_rows(streams, fields, limit: int, before_id: int | None = None):
+		"""
+		Up to limit + 1 notes matched by any of `streams` (lists of criteria),
+		newest first. Each stream is read from its (owner_id, id) or
+		(visibility, id) index starting below `before_id`, so deep pages cost
+		the same as the first, and the streams are merged and joined with the
+		owners in a single query selecting only `fields`. The rows also carry
+		"cursor_id" and "cursor_owner" (the note's id and owner id).
+		"""
+		def stream(*criteria):
+			query = db.select(Note.id).where(*criteria)
+			if before_id is not None:
+				query = query.where(Note.id < before_id)
+			return db.select(query.order_by(Note.id.desc()).limit(limit + 1).subquery())
+
+		page_ids = db.union_all(*(stream(*criteria) for criteria in streams)).subquery()
+		query = (
+			db.select(Note.id.label("cursor_id"), Note.owner_id.label("cursor_owner"), *NoteService.listing_columns(fields))
+			.select_from(Note)
+			.join(page_ids, page_ids.c.id == Note.id)
+			.order_by(Note.id.desc())
+			.limit(limit + 1)
+		)
+		if "owner_name" in fields:
+			query = query.join(User, User.id == Note.owner_id)
+		return [dict(row) for row in db.session.execute(query).mappings()]
 
 	@staticmethod
-	def get_shared_public_notes(user_id: int):
-		return (
-			Note.query
-			.filter(
-				Note.owner_id != user_id,
-				Note.visibility.in_(["read", "write"])
+	def get_public_feed(limit: int, before_id: int | None = None, fields=()):
+		"""
+		listing_rows of all the public notes, whoever owns them. The result is
+		the same for every user, so it is served from the FeedCache, which the
+		writes to public notes invalidate.
+		"""
+		key = (str(db.engine.url), before_id, limit, tuple(fields))
+		rows = FeedCache.get(key)
+		if rows is None:
+			generation = FeedCache.cache.generation
+			rows = NoteService.listing_rows(
+				[[Note.visibility == visibility] for visibility in PUBLIC_VISIBILITIES], fields, limit, before_id
 			)
-			.all()
+			# The rows stand for every public note with an id in [lo, hi)
+			lo = rows[-1]["cursor_id"] if len(rows) > limit else 0
+			FeedCache.put(key, (lo, before_id), rows, generation)
+		return rows
+
+	@staticmethod
+	def get_notes_page(user_id: int, limit: int, before_id: int | None = None, fields=None):
+		"""
+		One page of the notes visible to a user, newest first: their own notes
+		and the public ones (see get_public_feed), with only the requested
+		`fields` (see LISTING_FIELDS, all but "preview" by default).
+		Returns a list of dicts and the id to continue before, or None.
+		"""
+		fields = NoteService.check_fields(fields)
+
+		# The user's public notes are in both streams
+		merged = {row["cursor_id"]: row for row in NoteService.get_public_feed(limit, before_id, fields)}
+		merged.update(
+			(row["cursor_id"], row)
+			for row in NoteService.listing_rows([[Note.owner_id == user_id]], fields, limit, before_id)
 		)
-	
+		rows = [merged[note_id] for note_id in sorted(merged, reverse=True)[:limit + 1]]
+
+		page = NoteService.listing_notes(rows[:limit], fields, user_id)
+		next_before = rows[limit - 1]["cursor_id"] if len(rows) > limit else None
+		return page, next_before
+
+	@staticmethod
+	def changes_head() -> tuple:
+		"""(epoch, seq) of the last change made to the notes of this database"""
+		return tuple(db.session.execute(db.select(NoteChangeCounter.epoch, NoteChangeCounter.seq)).one())
+
+	@staticmethod
+	def get_changes(user_id: int, since: tuple, limit: int, fields=None):
+		"""
+		What changed in a user's listing after the (epoch, seq) position
+		`since`: the notes created, updated or made visible to them, with the
+		requested `fields`, and the ids of the notes that left it (deleted, or
+		someone else's note made private). Both are read from change_seq
+		indexes, so the cost follows the number of changes, not of notes.
+		Returns the notes, the removed ids, the position to continue from and
+		whether more changes follow; raises ChangesCursorExpired when `since`
+		does not belong to this database.
+		"""
+		fields = NoteService.check_fields(fields)
+		epoch, head = NoteService.changes_head()
+		since_epoch, since_seq = since
+		if since_epoch != epoch or since_seq > head:
+			raise ChangesCursorExpired()
+
+		query = (
+			db.select(
+				Note.change_seq.label("cursor_seq"),
+				Note.id.label("cursor_id"),
+				Note.owner_id.label("cursor_owner"),
+				*NoteService.listing_columns(fields),
+			)
+			.where(Note.change_seq > since_seq, db.or_(Note.owner_id == user_id, Note.visibility.in_(PUBLIC_VISIBILITIES)))
+			.order_by(Note.change_seq)
+			.limit(limit + 1)
+		)
+		if "owner_name" in fields:
+			query = query.join(User, User.id == Note.owner_id)
+		changed = db.session.execute(query).mappings().all()
+		removed = db.session.execute(
+			db.select(NoteTombstone.change_seq, NoteTombstone.note_id)
+			.where(
+				NoteTombstone.change_seq > since_seq,
+				db.or_(
+					db.and_(NoteTombstone.owner_id == user_id, NoteTombstone.reason == "deleted"),
+					db.and_(NoteTombstone.owner_id != user_id, NoteTombstone.visibility.in_(PUBLIC_VISIBILITIES)),
+				),
+			)
+			.order_by(NoteTombstone.change_seq)
+			.limit(limit + 1)
+		).all()
+
+		events = sorted(
+			[(row["cursor_seq"], row["cursor_id"], row) for row in changed]
+			+ [(seq, note_id, None) for seq, note_id in removed],
+			key=lambda event: event[0],
+		)
+		has_more = len(events) > limit
+		events = events[:limit]
+		# A note changed several times since the cursor: its last change wins
+		latest = {note_id: row for _, note_id, row in events}
+		notes = NoteService.listing_notes([row for row in latest.values() if row is not None], fields, user_id)
+		removed_ids = [note_id for note_id, row in latest.items() if row is None]
+		next_seq = events[-1][0] if has_more else max(head, events[-1][0] if events else since_seq)
+		return notes, removed_ids, (epoch, next_seq), has_more
+
+	@staticmethod
+	def match_query(text: str) -> str:
+		"""
+		FTS5 query for what a user typed: all the words must match, the last
+		one as a prefix (search as you type). Words are quoted, so the FTS5
+		operators and syntax characters are searched for as plain text.
+		"""
+		words = re.findall(r"\w+", text)
+		if not words:
+			raise ValueError("Search query cannot be empty")
+		return " ".join(f'"{word}"' for word in words) + "*"
+
+	@staticmethod
+	def search_notes(user_id: int | None, text: str, limit: int, after=None, fields=None):
+		"""
+		One page of the notes readable by a user (see can_read) matching
+		`text` in their title or content, best matches first. Candidates come
+		from the notes_fts index, so the cost depends on the number of
+		matches, not on the size of the table. `after` is the (rank, id) of
+		the last note of the previous page. Returns a list of dicts and the
+		(rank, id) to continue after, or None.
+		"""
+		fields = NoteService.check_fields(fields)
+		fts = db.table("notes_fts", db.column("rowid"), db.column("rank"))
+		readable = Note.visibility.in_(PUBLIC_VISIBILITIES)
+		if user_id is not None:
+			readable = db.or_(Note.owner_id == user_id, readable)
+
+		query = (
+			db.select(
+				fts.c.rank.label("cursor_rank"),
+				Note.id.label("cursor_id"),
+				Note.owner_id.label("cursor_owner"),
+				*NoteService.listing_columns(fields),
+			)
+			.select_from(fts)
+			.join(Note, Note.id == fts.c.rowid)
+			.where(db.literal_column("notes_fts").match(NoteService.match_query(text)), readable)
+			.order_by(fts.c.rank, Note.id)
+			.limit(limit + 1)
+		)
+		if after is not None:
+			rank, note_id = after
+			query = query.where(db.or_(fts.c.rank > rank, db.and_(fts.c.rank == rank, Note.id > note_id)))
+		if "owner_name" in fields:
+			query = query.join(User, User.id == Note.owner_id)
+		rows = db.session.execute(query).mappings().all()
+
+		page = NoteService.listing_notes(rows[:limit], fields, user_id)
+		last = rows[limit - 1] if len(rows) > limit else None
+		return page, (last["cursor_rank"], last["cursor_id"]) if last is not None else None
+
+	@staticmethod
+	def ensure_search_index() -> None:
+		"""Creates and fills the full-text index of a database created before it existed"""
+		if db.engine.dialect.name != "sqlite":
+			return
+		exists = db.session.execute(db.text("SELECT 1 FROM sqlite_master WHERE name = 'notes_fts'")).first()
+		if exists:
+			return
+		for statement in NOTES_FTS_DDL:
+			db.session.execute(db.text(statement))
+		db.session.execute(db.text("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')"))
+		db.session.commit()
+
+	@staticmethod
+	def ensure_note_versions() -> None:
+		"""Adds version and the covering listing indexes to a notes table created before they existed"""
+		if db.engine.dialect.name != "sqlite":
+			return
+		columns = {row[1] for row in db.session.execute(db.text("PRAGMA table_info(notes)"))}
+		if "version" in columns:
+			return
+		db.session.execute(db.text("ALTER TABLE notes ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+		for index in Note.__table__.indexes:
+			if "version" in index.columns:
+				index.create(db.session.connection(), checkfirst=True)
+		db.session.commit()
+
+	@staticmethod
+	def ensure_change_tracking() -> None:
+		"""Adds change_seq and its triggers to a notes table created before they existed"""
+		if db.engine.dialect.name != "sqlite":
+			return
+		columns = {row[1] for row in db.session.execute(db.text("PRAGMA table_info(notes)"))}
+		if "change_seq" in columns:
+			return
+		db.session.execute(db.text("ALTER TABLE notes ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0"))
+		db.session.execute(db.text("CREATE INDEX IF NOT EXISTS ix_notes_change_seq ON notes (change_seq)"))
+		for statement in NOTES_CHANGES_DDL:
+			db.session.execute(db.text(statement))
+		db.session.commit()
+
+	@staticmethod
+	def listing_fingerprint(user_id: int) -> str:
+		"""
+		Changes whenever a note is added to, removed from or updated in the
+		user's listing: count, highest id and sum of versions of the user's
+		notes and of the public ones, read from the covering listing indexes.
+		"""
+		def aggregate(*criteria):
+			return db.select(
+				db.func.count(Note.id), db.func.max(Note.id), db.func.sum(Note.version)
+			).where(*criteria)
+
+		rows = db.session.execute(db.union_all(
+			aggregate(Note.owner_id == user_id),
+			aggregate(Note.visibility == "read"),
+			aggregate(Note.visibility == "write"),
+		)).all()
+		return "-".join(f"{count}.{max_id or 0}.{versions or 0}" for count, max_id, versions in rows)
+
 	@staticmethod
 	def can_user_read(note_id: int, user_id: int | None) -> bool:
-		note = Note.query.filter_by(id=note_id).first()
+		note = NoteService.get_note(note_id)
 		if note is None:
 			return False
-		if user_id is not None and note.owner_id == user_id:
-			return True
-		return note.visibility in ("read", "write")
+		return NoteService.can_read(note, user_id)
 	
 	@staticmethod
 	def get_note(note_id:int):
-		return Note.query.filter_by(id=note_id).first()
+		"""
+		The note with its owner and lock, loaded in one query. It then stays in
+		the session's identity map for the rest of the request, so looking the
+		same id up again (permission checks, lock status) reuses the loaded row.
+		"""
+		return db.session.get(Note, note_id, options=[joinedload(Note.owner), joinedload(Note.lock)])
+	
+	@staticmethod
+	def get_notes(note_ids) -> dict:
+		"""
+		The notes with the given ids, with their owners and locks, in one IN
+		query; returns {id: note} without the ids that do not exist.
+		"""
+		notes = db.session.scalars(
+			db.select(Note)
+			.options(joinedload(Note.owner), joinedload(Note.lock))
+			.where(Note.id.in_(list(note_ids)))
+		).unique()
+		return {note.id: note for note in notes}
 	
 	@staticmethod
 	def update_note(note_id: int, title: str, content: str) -> Note | None:
-		note = Note.query.filter_by(id=note_id).first()
+		note = NoteService.get_note(note_id)
 		if note is None:
 			return None
 		
-		if not title or not title.strip():
-			raise ValueError("Title cannot be empty")
-		
-		if len(title) > 200:
-			raise ValueError("Title cannot exceed 200 characters")
-		
-		if len(content) > 10000:
-			raise ValueError("Content cannot exceed 10000 characters")
+		NoteService.validate_note(title, content)
 		
+		previous_content = note.content
 		note.title = title.strip()
 		note.content = content.strip()
 		note.updated_at = db.func.now()
-		db.session.commit()
+		note.version += 1
 		
-		if current_app.config.get("SERVER_MODE") == "master":
-			SyncService.sync_to_replica("update_note", {
+		is_master = current_app.config.get("SERVER_MODE") == "master"
+		if is_master:
+			payload = {
 				"id": note.id,
 				"title": note.title,
-				"content": note.content
-			})
+				"content": note.content,
+				"version": note.version
+			}
+			# Lets the replica apply a small diff instead of receiving the full content
+			delta = DeltaService.make_delta(previous_content, note.content)
+			if DeltaService.delta_size(delta) < len(note.content):
+				payload.update(
+					base_hash=DeltaService.content_hash(previous_content),
+					hash=DeltaService.content_hash(note.content),
+					delta=delta,
+				)
+			SyncService.enqueue("update_note", payload)
+		note_ref, data = EventBroker.note_ref(note), NoteService.event_data(note)
+		db.session.commit()
+		
+		if is_master:
+			SyncService.notify()
+		EventBroker.publish("note-updated", note_ref, data)
+		
+		return note
+
+	@staticmethod
+	def bulk_write(user_id: int, items: list) -> list:
+		"""
+		Creates (items without an "id") and updates (items with one) many
+		notes in one transaction: one multi-row INSERT, one executemany
+		UPDATE and a single "bulk_notes" replication event. Items are
+		validated like create_note/update_note; an invalid item, or one the
+		user cannot write or someone else has locked, is reported and skipped
+		while the others are saved. Returns one result per item, in order.
+		"""
+		results = [None] * len(items)
+		creates = []  # (index, row)
+		updates = []  # (index, note, title, content)
+
+		update_ids = {item["id"] for item in items if isinstance(item, dict) and isinstance(item.get("id"), int)}
+		existing = NoteService.get_notes(update_ids) if update_ids else {}
+		seen = set()
+		for index, item in enumerate(items):
+			try:
+				if not isinstance(item, dict):
+					raise ValueError("Each note must be an object")
+				title = item.get("title") if isinstance(item.get("title"), str) else ""
+				content = item.get("content") if isinstance(item.get("content"), str) else ""
+				note_id = item.get("id")
+				if note_id is None:
+					visibility = item.get("visibility", "private")
+					NoteService.validate_note(title, content, visibility)
+					creates.append((index, {
+						"owner_id": user_id,
+						"title": title.strip(),
+						"content": content.strip(),
+						"visibility": visibility,
+						"version": 1,
+					}))
+					continue
+
+				note = existing.get(note_id)
+				if note is None:
+					results[index] = {"index": index, "id": note_id, "status": 404, "error": "Note not found"}
+					continue
+				if note_id in seen:
+					raise ValueError("Note updated twice in the same request")
+				if not NoteService.can_write(note, user_id):
+					results[index] = {"index": index, "id": note_id, "status": 403, "error": "Write access denied"}
+					continue
+				if LockService.lock_holder(note) not in (None, user_id):
+					results[index] = {"index": index, "id": note_id, "status": 409, "error": "Note locked by another user"}
+					continue
+				NoteService.validate_note(title, content)
+				seen.add(note_id)
+				updates.append((index, note, title.strip(), content.strip()))
+			except ValueError as e:
+				results[index] = {"index": index, "status": 400, "error": str(e)}
+
+		created = []
+		if creates:
+			# Multi-row INSERT ... RETURNING. RETURNING lists the rows in no
+			# particular order, so they are matched back to the items by what
+			# was inserted; identical items may get each other's ids harmlessly.
+			returned = db.session.execute(
+				db.insert(Note).returning(Note.id, Note.title, Note.content, Note.visibility),
+				[row for _, row in creates],
+			)
+			ids = defaultdict(deque)
+			for note_id, title, content, visibility in sorted(returned):
+				ids[(title, content, visibility)].append(note_id)
+			for index, row in creates:
+				note_id = ids[(row["title"], row["content"], row["visibility"])].popleft()
+				created.append({"id": note_id, **row})
+				results[index] = {"index": index, "id": note_id, "status": 201}
+
+		updated = []
+		if updates:
+			table = Note.__table__
+			for index, note, title, content in updates:
+				updated.append({"id": note.id, "title": title, "content": content, "version": note.version + 1})
+				results[index] = {"index": index, "id": note.id, "status": 200}
+			db.session.execute(
+				table.update()
+				.where(table.c.id == db.bindparam("b_id"))
+				.values(
+					title=db.bindparam("b_title"),
+					content=db.bindparam("b_content"),
+					version=db.bindparam("b_version"),
+					updated_at=db.func.now(),
+				),
+				[{f"b_{key}": value for key, value in row.items()} for row in updated],
+			)
+
+		if not created and not updated:
+			return results
+
+		# Written around the ORM: tell the caches which notes changed
+		for row in created:
+			if row["visibility"] in PUBLIC_VISIBILITIES:
+				FeedCache.mark_dirty(db.session, row["id"], row["id"] + 1)
+		for _, note, _, _ in updates:
+			if note.visibility in PUBLIC_VISIBILITIES:
+				FeedCache.mark_dirty(db.session, note.id, note.id + 1)
+		MerkleService.mark_dirty(db.session, [row["id"] for row in created + updated])
+
+		is_master = current_app.config.get("SERVER_MODE") == "master"
+		if is_master:
+			SyncService.enqueue("bulk_notes", {"create": created, "update": updated})
+		events = [("note-created", SimpleNamespace(**row)) for row in created]
+		events += [
+			("note-updated", SimpleNamespace(**row, owner_id=note.owner_id, visibility=note.visibility))
+			for row, (_, note, _, _) in zip(updated, updates)
+		]
+		db.session.commit()
 		
-		return note
\ No newline at end of file
+		if is_master:
+			SyncService.notify()
+		for event_type, note in events:
+			EventBroker.publish(event_type, note, NoteService.event_data(note))
+		return results
@@ -0,0 +1,78 @@
+from urllib.parse import urlsplit, urlunsplit, parse_qs
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from services.metrics import SYNC_BYTES_SENT
+from services.sync_codec import JSON, SyncCodec
+
+
+class ReplicaClient:
+    """Keep-alive HTTP connection pool to one replica.
+
+    A replica is configured by its base URL. Connect/read timeouts default
+    to the application settings and can be overridden per replica with
+    query parameters, e.g. ``http://replica-2:5001?connect_timeout=0.5&read_timeout=10``.
+
+    Payloads are sent in the configured encoding (see `SyncCodec`); a
+    replica answering 415 is switched to JSON for the client's lifetime.
+    """
+
+    def __init__(self, url: str, connect_timeout: float, read_timeout: float, pool_size: int = 4,
+                 token: str | None = None, encoding: str = "json", compress_min_bytes: int = 0):
+        self.url = url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.content_type = SyncCodec.content_type(encoding)
+        self.compress_min_bytes = compress_min_bytes
+        self.session = requests.Session()
+        self.session.headers["Accept"] = SyncCodec.accept_header()
+        if token:
+            self.session.headers["X-Sync-Token"] = token
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_spec(cls, spec: str, connect_timeout: float, read_timeout: float, pool_size: int = 4,
+                  token: str | None = None, encoding: str = "json", compress_min_bytes: int = 0):
+        parts = urlsplit(spec.strip())
+        options = parse_qs(parts.query)
+        if "connect_timeout" in options:
+            connect_timeout = float(options["connect_timeout"][0])
+        if "read_timeout" in options:
+            read_timeout = float(options["read_timeout"][0])
+        url = urlunsplit((parts.scheme, parts.netloc, parts.path, "", ""))
+        return cls(url, connect_timeout, read_timeout, pool_size, token, encoding, compress_min_bytes)
+
+    def _encode(self, payload) -> tuple:
+        body = SyncCodec.encode(payload, self.content_type)
+        body, content_encoding = SyncCodec.compress(body, self.compress_min_bytes)
+        headers = {"Content-Type": self.content_type}
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        SYNC_BYTES_SENT.inc(len(body), replica=self.url)
+        return body, headers
+
+    def post(self, path: str, payload=None, **kwargs) -> requests.Response:
+        """POSTs `payload` to the replica, raising `requests.RequestException` on failure"""
+        kwargs.setdefault("timeout", self.timeout)
+        if payload is not None:
+            kwargs["data"], kwargs["headers"] = self._encode(payload)
+        response = self.session.post(f"{self.url}{path}", **kwargs)
+
+        if response.status_code == 415 and payload is not None and self.content_type != JSON:
+            # Replica without msgpack support (or an older version)
+            self.content_type = JSON
+            kwargs["data"], kwargs["headers"] = self._encode(payload)
+            response = self.session.post(f"{self.url}{path}", **kwargs)
+
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def decode(response: requests.Response):
+        """Body of a replica response, whichever format it answered in"""
+        return SyncCodec.decode(response.content, response.headers.get("Content-Type"))
+
+    def close(self) -> None:
+        self.session.close()
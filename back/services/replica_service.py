@@ -0,0 +1,302 @@
+import json
+import threading
+import time
+from typing import Dict, Any, List
+
+import requests
+from flask import current_app
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db
+from models.note import Note
+from models.user import User
+from models.sync_position import SyncPosition
+from services.delta_service import DeltaService
+from services.feed_cache import FeedCache
+from services.merkle_service import MerkleService
+from services.metrics import SYNC_APPLY_DURATION, SYNC_OPERATIONS_APPLIED, SYNC_OPERATIONS_FAILED
+
+
+class ReplicationGap(Exception):
+    """Raised when a batch starts after the last change applied by this replica"""
+
+    def __init__(self, last_lsn: int):
+        super().__init__(f"Replica is at LSN {last_lsn}, missing changes before this batch")
+        self.last_lsn = last_lsn
+
+
+class DeltaMismatch(Exception):
+    """Raised when delta-encoded updates do not apply to this replica's note content"""
+
+    def __init__(self, note_ids: List[int]):
+        super().__init__(f"Content of notes {note_ids} does not match the delta base, full content needed")
+        self.note_ids = note_ids
+
+
+class ReplicaService:
+    """Applies replicated operations received from the master.
+
+    Every change carries the master's log sequence number (LSN). The last
+    applied LSN is persisted in the same transaction as the changes, so a
+    restarted replica only needs the changes after it (see `catch_up`).
+    Operations are upserts and already-applied LSNs are skipped, which
+    makes re-delivery harmless.
+    """
+
+    _apply_lock = threading.Lock()
+    _applied = threading.Condition()  # notified after each applied batch
+    _worker = None
+
+    @staticmethod
+    def create_note(data: Dict[Any, Any]) -> None:
+        note = Note(
+            id=data["id"],
+            owner_id=data["owner_id"],
+            title=data["title"],
+            content=data["content"],
+            visibility=data["visibility"],
+            version=data.get("version", 1),
+        )
+        db.session.merge(note)
+
+    @staticmethod
+    def register_user(data: Dict[Any, Any]) -> None:
+        user = User(
+            id=data["id"],
+            nom=data["nom"],
+            pswd_hashed=data["pswd_hashed"]
+        )
+        db.session.merge(user)
+
+    @staticmethod
+    def update_note(data: Dict[Any, Any]) -> None:
+        """Applies the full content, or the chained deltas when only those were sent"""
+        note = Note.query.filter_by(id=data.get("id")).first()
+        if note is None:
+            raise LookupError("could not update note")
+
+        if "content" in data:
+            content = data.get("content")
+        else:
+            if DeltaService.content_hash(note.content) != data["base_hash"]:
+                raise DeltaMismatch([note.id])
+            content = note.content
+            for delta in data["deltas"]:
+                content = DeltaService.apply_delta(content, delta)
+            if DeltaService.content_hash(content) != data["hash"]:
+                raise DeltaMismatch([note.id])
+
+        note.title = data.get("title")
+        note.content = content
+        note.version = data.get("version", note.version + 1)
+
+    @staticmethod
+    def bulk_notes(data: Dict[Any, Any]) -> None:
+        """A bulk write on the master: upserts the created notes and overwrites the updated ones, one executemany each"""
+        table = Note.__table__
+        created = data.get("create") or []
+        updated = data.get("update") or []
+        db.session.flush()
+
+        if created:
+            insert = sqlite_insert(table)
+            db.session.execute(
+                insert.on_conflict_do_update(
+                    index_elements=[table.c.id],
+                    set_={column: insert.excluded[column] for column in ("owner_id", "title", "content", "visibility", "version")},
+                ),
+                [{column: note[column] for column in ("id", "owner_id", "title", "content", "visibility", "version")} for note in created],
+            )
+        if updated:
+            result = db.session.execute(
+                table.update()
+                .where(table.c.id == db.bindparam("b_id"))
+                .values(
+                    title=db.bindparam("b_title"),
+                    content=db.bindparam("b_content"),
+                    version=db.bindparam("b_version"),
+                    updated_at=db.func.now(),
+                ),
+                [{f"b_{key}": note[key] for key in ("id", "title", "content", "version")} for note in updated],
+            )
+            if result.rowcount != len(updated):
+                raise LookupError("could not update notes")
+
+        # Written around the ORM: reload notes the session already holds, and
+        # tell the caches which notes changed
+        db.session.expire_all()
+        ids = [note["id"] for note in created + updated]
+        for note_id in ids:
+            FeedCache.mark_dirty(db.session, note_id, note_id + 1)
+        MerkleService.mark_dirty(db.session, ids)
+
+    @staticmethod
+    def replace_note_range(data: Dict[Any, Any]) -> None:
+        """Anti-entropy repair: makes the notes with ids in [lo, hi) match the master's"""
+        ids = [note["id"] for note in data["notes"]]
+        Note.query.filter(
+            Note.id >= data["lo"],
+            Note.id < data["hi"],
+            Note.id.not_in(ids),
+        ).delete(synchronize_session="fetch")
+        FeedCache.mark_dirty(db.session, data["lo"], data["hi"])
+        for note in data["notes"]:
+            ReplicaService.create_note(note)
+
+    @staticmethod
+    def apply(operation: str, data: Dict[Any, Any]) -> None:
+        """Applies one operation in the current transaction, without committing"""
+        handler = ReplicaService.HANDLERS.get(operation)
+        if handler is None:
+            raise ValueError(f"Unknown sync operation: {operation}")
+        started = time.perf_counter()
+        handler(data)
+        db.session.flush()
+        SYNC_APPLY_DURATION.observe(time.perf_counter() - started, operation=operation)
+
+    @staticmethod
+    def get_applied_lsn() -> int:
+        position = db.session.get(SyncPosition, "applied")
+        return position.lsn if position is not None else 0
+
+    @staticmethod
+    def wait_for_lsn(lsn: int, timeout: float) -> bool:
+        """
+        Waits up to `timeout` seconds for this replica to apply the changes up
+        to `lsn`. Returns False if it is still behind.
+        """
+        query = db.select(SyncPosition.lsn).where(SyncPosition.name == "applied")
+        deadline = time.monotonic() + timeout
+        with ReplicaService._applied:
+            while (db.session.execute(query).scalar() or 0) < lsn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                ReplicaService._applied.wait(remaining)
+        return True
+
+    @staticmethod
+    def apply_batch(operations: List[Dict[Any, Any]], from_lsn: int | None = None, to_lsn: int | None = None) -> int:
+        """
+        Applies an ordered list of {"operation", "data", "lsn"} items in one transaction.
+        `from_lsn` is the position the batch follows and `to_lsn` the position it
+        brings the replica to. Raises ReplicationGap when changes are missing
+        before the batch, and DeltaMismatch listing every note whose delta
+        did not apply. Nothing is committed if any operation fails.
+        Returns the number of operations applied.
+        """
+        with ReplicaService._apply_lock:
+            try:
+                position = SyncPosition.get("applied")
+                if from_lsn is not None and from_lsn > position.lsn:
+                    raise ReplicationGap(position.lsn)
+
+                applied = 0
+                counts = {}  # operation -> number applied, recorded once committed
+                mismatched = []
+                for index, item in enumerate(operations):
+                    operation = item.get("operation") if isinstance(item, dict) else None
+                    try:
+                        lsn = item.get("lsn")
+                        if lsn is not None and lsn <= position.lsn:
+                            continue
+                        ReplicaService.apply(operation, item["data"])
+                    except DeltaMismatch as e:
+                        SYNC_OPERATIONS_FAILED.inc(operation=operation)
+                        mismatched.extend(e.note_ids)
+                        continue
+                    except Exception as e:
+                        known = operation if operation in ReplicaService.HANDLERS else "unknown"
+                        SYNC_OPERATIONS_FAILED.inc(operation=known)
+                        raise ValueError(f"operation {index} ({operation}) failed: {e}") from e
+                    applied += 1
+                    counts[operation] = counts.get(operation, 0) + 1
+
+                if mismatched:
+                    raise DeltaMismatch(mismatched)
+
+                if to_lsn is not None and to_lsn > position.lsn:
+                    position.lsn = to_lsn
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+        for operation, count in counts.items():
+            SYNC_OPERATIONS_APPLIED.inc(count, operation=operation)
+        with ReplicaService._applied:
+            ReplicaService._applied.notify_all()
+        return applied
+
+    @staticmethod
+    def sync_headers() -> Dict[str, str]:
+        """Headers authenticating this node on the master's /api/sync endpoints"""
+        token = current_app.config.get("SYNC_TOKEN")
+        return {"X-Sync-Token": token} if token else {}
+
+    @staticmethod
+    def catch_up() -> int:
+        """
+        Pulls the changes after the last applied LSN from the master's
+        /api/sync/since/<lsn> stream and applies them in chunks.
+        Returns the number of operations applied.
+        """
+        config = current_app.config
+        from_lsn = ReplicaService.get_applied_lsn()
+        url = f"{config['MASTER_URL'].rstrip('/')}/api/sync/since/{from_lsn}"
+
+        try:
+            response = requests.get(
+                url,
+                stream=True,
+                headers=ReplicaService.sync_headers(),
+                timeout=(config["REPLICA_CONNECT_TIMEOUT"], config["REPLICA_READ_TIMEOUT"]),
+            )
+        except requests.RequestException as e:
+            current_app.logger.warning(f"Replica could not reach the master to catch up: {e}")
+            return 0
+
+        if response.status_code in (409, 410):
+            current_app.logger.error(f"Replica cannot catch up from LSN {from_lsn}: {response.json().get('error')}")
+            return 0
+        response.raise_for_status()
+
+        applied = 0
+        chunk = []
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk.append(json.loads(line))
+            if len(chunk) >= config["CATCHUP_CHUNK_SIZE"]:
+                applied += ReplicaService.apply_batch(chunk, from_lsn, chunk[-1]["lsn"])
+                from_lsn = chunk[-1]["lsn"]
+                chunk = []
+        if chunk:
+            applied += ReplicaService.apply_batch(chunk, from_lsn, chunk[-1]["lsn"])
+
+        return applied
+
+    @staticmethod
+    def start_worker(app):
+        """Catches up with the master on startup, then periodically"""
+        from services.background import BackgroundWorker
+
+        if ReplicaService._worker is None:
+            ReplicaService._worker = BackgroundWorker(
+                app,
+                ReplicaService.catch_up,
+                app.config["CATCHUP_INTERVAL_SECONDS"],
+                name="replica-catch-up",
+            )
+            ReplicaService._worker.start()
+            ReplicaService._worker.wake()
+        return ReplicaService._worker
+
+
+ReplicaService.HANDLERS = {
+    "create_note": ReplicaService.create_note,
+    "register_user": ReplicaService.register_user,
+    "update_note": ReplicaService.update_note,
+    "replace_note_range": ReplicaService.replace_note_range,
+    "bulk_notes": ReplicaService.bulk_notes,
+}
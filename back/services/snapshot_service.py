@@ -0,0 +1,145 @@
+import json
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator
+
+from flask import current_app
+from sqlalchemy import DateTime
+
+from models import db
+from models.note import NOTES_CHANGES_DDL, NOTES_FTS_DDL
+from models.note_change import NoteTombstone
+from models.sync_position import SyncPosition
+from services.feed_cache import FeedCache
+from services.merkle_service import MerkleService
+
+
+class SnapshotService:
+    """Bulk copy of the replicated tables, used to seed new replicas.
+
+    A snapshot is NDJSON: a header line with the master's LSN, then one
+    line per chunk of rows, table by table in foreign key order. Rows are
+    read in primary key order with keyset queries, so exporting and
+    loading both run in constant memory.
+
+    The export is not a frozen point in time: rows written while it runs
+    may already be included. The header LSN is taken before reading any
+    row, and replaying the log from it (upserts) converges the replica.
+    """
+
+    TABLES = ("users", "notes", "locks")
+    # Suspended while the tables are emptied, see _clear_tables
+    NOTES_DELETE_TRIGGERS = ("notes_fts_delete", "notes_change_delete")
+
+    @staticmethod
+    def _serialize(value: Any) -> Any:
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return value
+
+    @staticmethod
+    def export(chunk_size: int | None = None) -> Iterator[str]:
+        """Yields the snapshot as NDJSON lines"""
+        from services.sync_service import SyncService
+
+        chunk_size = chunk_size or current_app.config["SNAPSHOT_CHUNK_SIZE"]
+        yield json.dumps({"type": "header", "lsn": SyncService.get_head_lsn(), "tables": list(SnapshotService.TABLES)}) + "\n"
+
+        for name in SnapshotService.TABLES:
+            table = db.metadata.tables[name]
+            key = list(table.primary_key.columns)[0]
+            last = None
+            while True:
+                query = db.select(table).order_by(key).limit(chunk_size)
+                if last is not None:
+                    query = query.where(key > last)
+                rows = db.session.execute(query).mappings().all()
+                db.session.commit()  # short read transactions, writers are not held back
+                if not rows:
+                    break
+                yield json.dumps({
+                    "type": "rows",
+                    "table": name,
+                    "rows": [{column: SnapshotService._serialize(value) for column, value in row.items()} for row in rows],
+                }) + "\n"
+                last = rows[-1][key.name]
+
+    @staticmethod
+    def gzip(lines: Iterable[str]) -> Iterator[bytes]:
+        """Compresses a stream of lines on the fly, in gzip format"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for line in lines:
+            data = compressor.compress(line.encode("utf-8"))
+            if data:
+                yield data
+        yield compressor.flush()
+
+    @staticmethod
+    def _clear_tables() -> None:
+        """
+        Empties the replicated tables. On SQLite the notes delete triggers
+        are dropped meanwhile: instead of one full-text delete and one
+        tombstone per note, the index is emptied at once and the changes
+        feed starts over in a new epoch, so clients reload their listing.
+        """
+        sqlite = db.engine.dialect.name == "sqlite"
+        if sqlite:
+            for name in SnapshotService.NOTES_DELETE_TRIGGERS:
+                db.session.execute(db.text(f"DROP TRIGGER IF EXISTS {name}"))
+
+        for name in reversed(SnapshotService.TABLES):
+            db.session.execute(db.metadata.tables[name].delete())
+
+        if sqlite:
+            db.session.execute(db.text("INSERT INTO notes_fts(notes_fts) VALUES ('delete-all')"))
+            db.session.execute(NoteTombstone.__table__.delete())
+            db.session.execute(db.text(
+                "UPDATE note_change_counter SET seq = 0, epoch = lower(hex(randomblob(8))) WHERE id = 1"
+            ))
+            for statement in NOTES_FTS_DDL + NOTES_CHANGES_DDL:
+                if any(f"TRIGGER IF NOT EXISTS {name} " in statement for name in SnapshotService.NOTES_DELETE_TRIGGERS):
+                    db.session.execute(db.text(statement))
+
+    @staticmethod
+    def load(lines: Iterable[bytes | str], commit_rows: int | None = None) -> Dict[str, int]:
+        """
+        Replaces the replicated tables with the snapshot read from `lines`,
+        using bulk inserts committed every `commit_rows` rows, and sets the
+        replica's applied LSN to the snapshot's.
+        Returns the number of rows loaded per table.
+        """
+        commit_rows = commit_rows or current_app.config["SNAPSHOT_COMMIT_ROWS"]
+        lines = iter(lines)
+
+        header = json.loads(next(lines))
+        if header.get("type") != "header":
+            raise ValueError("Snapshot does not start with a header")
+
+        SnapshotService._clear_tables()
+
+        counts = {name: 0 for name in SnapshotService.TABLES}
+        uncommitted = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            table = db.metadata.tables[chunk["table"]]
+            dates = [column.name for column in table.columns if isinstance(column.type, DateTime)]
+            rows = chunk["rows"]
+            for row in rows:
+                for column in dates:
+                    if row.get(column) is not None:
+                        row[column] = datetime.fromisoformat(row[column])
+
+            db.session.execute(table.insert(), rows)
+            counts[chunk["table"]] += len(rows)
+            uncommitted += len(rows)
+            if uncommitted >= commit_rows:
+                db.session.commit()
+                uncommitted = 0
+
+        SyncPosition.get("applied").lsn = header["lsn"]
+        db.session.commit()
+        MerkleService.invalidate_all()
+        FeedCache.invalidate_all(str(db.engine.url))
+        return counts
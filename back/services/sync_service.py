@@ -1,21 +1,430 @@
 import requests
-import os
-from typing import Dict, Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List
+
+from flask import current_app
+
+from models import db
+from models.outbox import SyncOutbox
+from models.replica_state import ReplicaState
+from models.sync_dead_letter import SyncDeadLetter
+from models.sync_position import SyncPosition
+from services.delta_service import DeltaService
+from services.metrics import SYNC_BATCH_DURATION, SYNC_DEAD_LETTERS, SYNC_OPERATIONS_SENT, SYNC_SEND_FAILURES
+from services.replica_client import ReplicaClient
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
 class SyncService:
+    """Replicates master writes to the replicas through a durable outbox.
+
+    Services call `enqueue` before committing their own transaction; the
+    background sender started by `start_worker` then drains the outbox in
+    order, so write requests never wait for a replica. Every replica has
+    its own delivery position, and batches are sent to all replicas in
+    parallel over pooled keep-alive sessions.
+
+    Outbox ids are the log sequence numbers (LSN) of the changes. They are
+    sent along with every operation so replicas can persist their position
+    and fetch missed changes from /api/sync/since/<lsn>.
+
+    A change a replica keeps rejecting is moved to the dead letters after
+    SYNC_DEAD_LETTER_ATTEMPTS tries, so it does not block the log forever.
+    """
+
+    # Status codes meaning the replica could not apply the batch itself:
+    # resending it unchanged will not help
+    REJECTED_STATUSES = (400, 413)
+
+    _worker = None
+    _drain_lock = threading.Lock()
+    _clients: Dict[str, ReplicaClient] = {}
+    _clients_lock = threading.Lock()
+    _executor = None
+    _isolating: Dict[str, int] = {}  # replica url -> LSN up to which entries are sent one by one
+
+    @staticmethod
+    def get_replicas() -> List[ReplicaClient]:
+        """Returns one pooled client per configured replica (REPLICA_URL, comma separated)"""
+        config = current_app.config
+        with SyncService._clients_lock:
+            replicas = []
+            for spec in config["REPLICA_URLS"]:
+                if spec not in SyncService._clients:
+                    SyncService._clients[spec] = ReplicaClient.from_spec(
+                        spec,
+                        config["REPLICA_CONNECT_TIMEOUT"],
+                        config["REPLICA_READ_TIMEOUT"],
+                        pool_size=config["SYNC_MAX_WORKERS"],
+                        token=config["SYNC_TOKEN"],
+                        encoding=config["SYNC_ENCODING"],
+                        compress_min_bytes=config["SYNC_COMPRESS_MIN_BYTES"],
+                    )
+                replicas.append(SyncService._clients[spec])
+            return replicas
+
+    @staticmethod
+    def close_clients() -> None:
+        with SyncService._clients_lock:
+            for client in SyncService._clients.values():
+                client.close()
+            SyncService._clients.clear()
+
+    @staticmethod
+    def _get_executor() -> ThreadPoolExecutor:
+        if SyncService._executor is None:
+            SyncService._executor = ThreadPoolExecutor(
+                max_workers=current_app.config["SYNC_MAX_WORKERS"],
+                thread_name_prefix="sync-fanout",
+            )
+        return SyncService._executor
+
+    @staticmethod
+    def enqueue(operation: str, data: Dict[Any, Any]) -> SyncOutbox:
+        """Adds a change to the outbox. The caller owns the commit."""
+        from services.consistency_service import ConsistencyService
+
+        entry = SyncOutbox(operation=operation, payload=data, created_at=_utcnow())
+        db.session.add(entry)
+        ConsistencyService.mark_write()
+        return entry
+
+    @staticmethod
+    def notify() -> None:
+        """Wakes the background sender after a commit that enqueued changes"""
+        if SyncService._worker is not None:
+            SyncService._worker.wake()
+
+    @staticmethod
+    def start_worker(app):
+        from services.background import BackgroundWorker
+
+        if SyncService._worker is None:
+            SyncService._worker = BackgroundWorker(
+                app,
+                SyncService.drain_outbox,
+                app.config["SYNC_INTERVAL_SECONDS"],
+                name="sync-outbox",
+            )
+            SyncService._worker.start()
+        return SyncService._worker
+
+    @staticmethod
+    def get_pruned_lsn() -> int:
+        position = db.session.get(SyncPosition, "pruned")
+        return position.lsn if position is not None else 0
+
+    @staticmethod
+    def get_head_lsn() -> int:
+        """LSN of the last change written to the log"""
+        head = db.session.query(db.func.max(SyncOutbox.id)).scalar()
+        return head if head is not None else SyncService.get_pruned_lsn()
+
+    @staticmethod
+    def outbox_depth() -> int:
+        return db.session.query(db.func.count(SyncOutbox.id)).scalar()
+
+    @staticmethod
+    def backlog() -> Dict[str, tuple]:
+        """Per replica: (changes not yet delivered, age in seconds of the oldest one)"""
+        now = _utcnow()
+        backlog = {}
+        for state in ReplicaState.query.all():
+            pending, oldest = db.session.query(
+                db.func.count(SyncOutbox.id), db.func.min(SyncOutbox.created_at)
+            ).filter(SyncOutbox.id > state.last_sent_id).one()
+            backlog[state.url] = (pending, (now - oldest).total_seconds() if oldest else 0)
+        return backlog
+
+    @staticmethod
+    def send_batch(replica: ReplicaClient, operations: List[Dict[Any, Any]], from_lsn: int | None, to_lsn: int | None) -> None:
+        """
+        Sends an ordered list of operations to a replica, raising on failure.
+        Note updates go out as deltas; if the replica reports notes whose
+        content does not match a delta's base, the batch is resent with the
+        full content of those notes.
+        """
+        def post(full_ids):
+            started = time.perf_counter()
+            try:
+                replica.post("/api/sync/batch", {
+                    "operations": SyncService.wire_operations(operations, full_ids),
+                    "from_lsn": from_lsn,
+                    "to_lsn": to_lsn,
+                })
+            finally:
+                SYNC_BATCH_DURATION.observe(time.perf_counter() - started, replica=replica.url)
+
+        try:
+            post(frozenset())
+        except requests.HTTPError as e:
+            try:
+                resync = ReplicaClient.decode(e.response)["resync"]
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise e
+            post(frozenset(resync))
+
+    @staticmethod
+    def wire_operations(operations: List[Dict[Any, Any]], full_ids=frozenset()) -> List[Dict[Any, Any]]:
+        """Drops the content of delta-encoded updates, or the delta when full content is wanted"""
+        wire = []
+        for operation in operations:
+            data = operation["data"]
+            if operation["operation"] == "update_note" and "deltas" in data:
+                if data["id"] in full_ids:
+                    data = {key: data[key] for key in ("id", "title", "content", "version") if key in data}
+                else:
+                    data = {key: value for key, value in data.items() if key != "content"}
+            wire.append({**operation, "data": data})
+        return wire
+
+    @staticmethod
+    def _chain_updates(previous: Dict[Any, Any], data: Dict[Any, Any]) -> None:
+        """Makes `data` (a later update) carry the deltas since `previous`'s base"""
+        if "deltas" in previous and "deltas" in data and previous["hash"] == data["base_hash"]:
+            deltas = previous["deltas"] + data["deltas"]
+            if sum(DeltaService.delta_size(delta) for delta in deltas) < len(data["content"]):
+                data.update(base_hash=previous["base_hash"], deltas=deltas)
+                return
+        for key in ("base_hash", "hash", "deltas"):
+            data.pop(key, None)
+
+    @staticmethod
+    def coalesce(entries: List[SyncOutbox]) -> List[Dict[Any, Any]]:
+        """
+        Turns outbox entries into the list of operations to send.
+        Successive updates of a note collapse into the last one, and updates
+        of a note created in the same batch are folded into its creation.
+        A merged operation carries the LSN of the last change it includes,
+        and collapsed updates chain their deltas.
+        """
+        operations = []
+        latest_by_note = {}  # note id -> index of its last create/update in operations
+
+        for entry in entries:
+            data = dict(entry.payload)
+            if "delta" in data:
+                data["deltas"] = [data.pop("delta")]
+
+            if entry.operation == "update_note" and data["id"] in latest_by_note:
+                index = latest_by_note[data["id"]]
+                previous = operations[index]
+                if previous["operation"] == "create_note":
+                    previous["data"].update({key: data[key] for key in ("title", "content", "version") if key in data})
+                    previous["lsn"] = entry.id
+                    continue
+                SyncService._chain_updates(previous["data"], data)
+                operations[index] = None
+
+            operations.append({"operation": entry.operation, "data": data, "lsn": entry.id})
+            if entry.operation in ("create_note", "update_note"):
+                latest_by_note[data["id"]] = len(operations) - 1
+            elif entry.operation == "bulk_notes":
+                # Later updates of these notes must not be moved before the bulk write
+                for note in data.get("create", []) + data.get("update", []):
+                    latest_by_note.pop(note["id"], None)
+
+        return [operation for operation in operations if operation is not None]
+
+    @staticmethod
+    def is_stuck(url: str) -> bool:
+        """Whether deliveries to a replica have failed SYNC_DEAD_LETTER_ATTEMPTS times in a row"""
+        state = db.session.get(ReplicaState, url)
+        return state is not None and state.attempts >= current_app.config["SYNC_DEAD_LETTER_ATTEMPTS"]
+
+    @staticmethod
+    def _get_states(replicas: List[ReplicaClient]) -> Dict[str, ReplicaState]:
+        states = {state.url: state for state in ReplicaState.query.all()}
+        for replica in replicas:
+            if replica.url not in states:
+                # A replica added after pruning starts where the log does: one
+                # that does not have the pruned changes reports a gap
+                states[replica.url] = ReplicaState(url=replica.url, last_sent_id=SyncService.get_pruned_lsn(), attempts=0)
+                db.session.add(states[replica.url])
+        db.session.commit()
+        return states
+
+    @staticmethod
+    def drain_outbox() -> int:
+        """
+        Sends pending outbox entries to every replica, one coalesced batch per
+        replica and round, all replicas in parallel. A failing replica stops at
+        its first failure, so no replica applies changes out of order, and it
+        does not hold back the others. Entries are deleted once every replica
+        has received them.
+        When a replica rejects a batch, its entries are resent one by one to
+        find the rejected change, which is dead-lettered after
+        SYNC_DEAD_LETTER_ATTEMPTS failures.
+        Returns the number of entries sent, summed over replicas.
+        """
+        with SyncService._drain_lock:
+            replicas = SyncService.get_replicas()
+            replicas_by_url = {replica.url: replica for replica in replicas}
+            states = SyncService._get_states(replicas)
+            batch_size = current_app.config["SYNC_BATCH_SIZE"]
+            delivered = 0
+
+            while True:
+                now = _utcnow()
+                pending = {}  # replica url -> (entries, operations) to send
+                batches = {}  # (position, size) -> (entries, operations), shared by replicas at the same position
+                for replica in replicas:
+                    state = states[replica.url]
+                    if state.next_attempt_at is not None and state.next_attempt_at > now:
+                        continue
+                    size = batch_size
+                    if state.last_sent_id < SyncService._isolating.get(replica.url, 0):
+                        size = 1
+                    else:
+                        SyncService._isolating.pop(replica.url, None)
+                    key = (state.last_sent_id, size)
+                    if key not in batches:
+                        entries = (
+                            SyncOutbox.query
+                            .filter(SyncOutbox.id > state.last_sent_id)
+                            .order_by(SyncOutbox.id)
+                            .limit(size)
+                            .all()
+                        )
+                        batches[key] = (entries, SyncService.coalesce(entries))
+                    if batches[key][0]:
+                        pending[replica.url] = batches[key]
+
+                if not pending:
+                    break
+
+                executor = SyncService._get_executor()
+                futures = {
+                    replica.url: executor.submit(
+                        SyncService.send_batch,
+                        replica,
+                        pending[replica.url][1],
+                        states[replica.url].last_sent_id,
+                        pending[replica.url][0][-1].id,
+                    )
+                    for replica in replicas
+                    if replica.url in pending
+                }
+
+                for url, future in futures.items():
+                    state = states[url]
+                    entries = pending[url][0]
+                    try:
+                        future.result()
+                    except requests.RequestException as e:
+                        SYNC_SEND_FAILURES.inc(replica=url)
+                        if SyncService._rewind(state, e):
+                            continue
+                        if SyncService._rejected(e):
+                            if len(entries) > 1:
+                                # Resent right away one entry at a time, to find the rejected one
+                                SyncService._isolating[url] = entries[-1].id
+                                continue
+                            if (state.attempts + 1 >= current_app.config["SYNC_DEAD_LETTER_ATTEMPTS"]
+                                    and SyncService._dead_letter(replicas_by_url[url], state, entries[0], e)):
+                                continue
+                        SyncService._schedule_retry(state, e)
+                        continue
+                    SYNC_OPERATIONS_SENT.inc(len(entries), replica=url)
+                    state.last_sent_id = entries[-1].id
+                    state.attempts = 0
+                    state.next_attempt_at = None
+                    state.last_error = None
+                    delivered += len(entries)
+
+                SyncService._prune([states[replica.url] for replica in replicas])
+                db.session.commit()
+
+            return delivered
 
     @staticmethod
-    def get_replica_url():
-        return os.getenv("REPLICA_URL", "http://localhost:5001")
-    
+    def _rewind(state: ReplicaState, error: requests.RequestException) -> bool:
+        """
+        Moves a replica's position back when it reports missing changes
+        (e.g. it was restored from an older copy). Returns False when the
+        missing changes are no longer in the log.
+        """
+        response = getattr(error, "response", None)
+        if response is None or response.status_code != 409:
+            return False
+        try:
+            last_lsn = int(ReplicaClient.decode(response)["last_lsn"])
+        except (ValueError, KeyError, TypeError):
+            return False
+
+        if last_lsn < SyncService.get_pruned_lsn():
+            current_app.logger.error(
+                f"Replica {state.url} is at LSN {last_lsn} but the log was pruned past it; "
+                f"it must be reseeded"
+            )
+            return False
+
+        current_app.logger.warning(f"Replica {state.url} is at LSN {last_lsn}, resending from there")
+        state.last_sent_id = last_lsn
+        return True
+
+    @staticmethod
+    def _rejected(error: requests.RequestException) -> bool:
+        response = getattr(error, "response", None)
+        return response is not None and response.status_code in SyncService.REJECTED_STATUSES
+
     @staticmethod
-    def sync_to_replica(operation: str, data: Dict[Any, Any]) -> None:
-        replica_url = SyncService.get_replica_url()
-        endpoint = f"{replica_url}/api/sync/{operation}"
-        
+    def _dead_letter(replica: ReplicaClient, state: ReplicaState, entry: SyncOutbox, error: Exception) -> bool:
+        """
+        Records a change the replica keeps rejecting and moves the replica
+        past it. An empty batch advances the replica's own position first,
+        so the following changes are not refused as a gap.
+        Returns False if the replica could not be reached.
+        """
         try:
-            response = requests.post(endpoint, json=data)
-            response.raise_for_status()
+            SyncService.send_batch(replica, [], state.last_sent_id, entry.id)
         except requests.RequestException as e:
-            print(f"Failed to sync with replica: {e}")
\ No newline at end of file
+            current_app.logger.warning(f"Could not skip change #{entry.id} on replica {state.url}: {e}")
+            return False
+
+        db.session.add(SyncDeadLetter(
+            replica_url=state.url,
+            lsn=entry.id,
+            operation=entry.operation,
+            payload=entry.payload,
+            error=str(error),
+            created_at=_utcnow(),
+        ))
+        SYNC_DEAD_LETTERS.inc(replica=state.url)
+        current_app.logger.error(
+            f"Replica {state.url} rejected change #{entry.id} ({entry.operation}) "
+            f"{state.attempts + 1} times, moved to the dead letters: {error}"
+        )
+        state.last_sent_id = entry.id
+        state.attempts = 0
+        state.next_attempt_at = None
+        state.last_error = None
+        return True
+
+    @staticmethod
+    def _prune(states: List[ReplicaState]) -> None:
+        """Deletes the entries every configured replica has received"""
+        if not states:
+            return
+        acknowledged = min(state.last_sent_id for state in states)
+        pruned = SyncPosition.get("pruned")
+        if acknowledged > pruned.lsn:
+            SyncOutbox.query.filter(SyncOutbox.id <= acknowledged).delete(synchronize_session=False)
+            pruned.lsn = acknowledged
+
+    @staticmethod
+    def _schedule_retry(state: ReplicaState, error: Exception) -> None:
+        state.attempts += 1
+        state.last_error = str(error)
+        delay = min(2 ** state.attempts, current_app.config["SYNC_MAX_BACKOFF_SECONDS"])
+        state.next_attempt_at = _utcnow() + timedelta(seconds=delay)
+        current_app.logger.warning(
+            f"Failed to sync with replica {state.url} after #{state.last_sent_id} "
+            f"(attempt {state.attempts}, retry in {delay}s): {error}"
+        )
@@ -25,14 +25,19 @@ class UserService:
 
         user = User(nom=username, pswd_hashed=pswd_string)
         db.session.add(user)
-        db.session.commit()
 
-        if current_app.config.get("SERVER_MODE") == "master":
-            SyncService.sync_to_replica("register_user", {
+        is_master = current_app.config.get("SERVER_MODE") == "master"
+        if is_master:
+            db.session.flush()  # assigns user.id for the outbox payload
+            SyncService.enqueue("register_user", {
                 "id": user.id,
                 "nom": username,
                 "pswd_hashed": pswd_string
             })
+        db.session.commit()
+
+        if is_master:
+            SyncService.notify()
         return user
 
     @staticmethod
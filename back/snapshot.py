@@ -0,0 +1,83 @@
+"""
+Export / import de snapshots pour initialiser un réplica.
+
+    python snapshot.py export master.ndjson.gz          # depuis la base du master
+    python snapshot.py load master.ndjson.gz            # dans la base du réplica
+    python snapshot.py load http://localhost:5000       # directement depuis le master
+
+Le chargement remplace les tables users, notes et locks du réplica : arrêter
+le serveur réplica pendant l'import. Au redémarrage, il rattrape les
+changements postérieurs au snapshot via /api/sync/since/<lsn>.
+"""
+import argparse
+import gzip
+import io
+import time
+
+import requests
+
+from app import create_app
+from models import db
+from services.replica_service import ReplicaService
+from services.snapshot_service import SnapshotService
+
+
+def export_snapshot(path: str):
+    master_app = create_app('master')
+    with master_app.app_context():
+        lines = SnapshotService.export()
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'wt', encoding='utf-8') as output:
+            for line in lines:
+                output.write(line)
+    print(f"Snapshot écrit dans {path}")
+
+
+def open_source(source: str):
+    """Returns an iterator over the snapshot lines of a file or of the master's endpoint"""
+    if source.startswith(('http://', 'https://')):
+        response = requests.get(
+            f"{source.rstrip('/')}/api/sync/snapshot",
+            params={'compress': 'gzip'},
+            headers=ReplicaService.sync_headers(),
+            stream=True,
+        )
+        response.raise_for_status()
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=response.raw), encoding='utf-8')
+
+    with open(source, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    if compressed:
+        return gzip.open(source, 'rt', encoding='utf-8')
+    return open(source, 'r', encoding='utf-8')
+
+
+def load_snapshot(source: str):
+    replica_app = create_app('replica')
+    with replica_app.app_context():
+        db.create_all()
+        started = time.monotonic()
+        with open_source(source) as lines:
+            counts = SnapshotService.load(lines)
+
+        print(f"\nSnapshot chargé en {time.monotonic() - started:.1f}s")
+        for table, count in counts.items():
+            print(f"   - {table}: {count} lignes")
+        print(f"   - LSN appliqué: {ReplicaService.get_applied_lsn()}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Snapshot export / import pour les réplicas")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help="exporte la base du master")
+    export_parser.add_argument('path', help="fichier de sortie (.gz pour compresser)")
+
+    load_parser = subparsers.add_parser('load', help="charge un snapshot dans la base du réplica")
+    load_parser.add_argument('source', help="fichier snapshot ou URL du master")
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        export_snapshot(args.path)
+    else:
+        load_snapshot(args.source)
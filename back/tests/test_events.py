@@ -0,0 +1,225 @@
+# tests/test_events.py
+"""
+Event stream test suite for Notes application
+Tests: fan-out filtered by read access, note and lock events, Last-Event-ID replay,
+slow clients told to resync, unsubscribing on disconnect
+"""
+
+import sys
+import os
+# Add parent folder to path to import app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import json
+from types import SimpleNamespace
+
+import bcrypt
+
+from app import app, reset_db, limiter
+from models import db
+from models.user import User
+from services.event_broker import EventBroker
+from services.metrics import EVENTS_DROPPED
+
+
+class EventsTestCase(unittest.TestCase):
+    """/api/events tests"""
+
+    def setUp(self):
+        self.app = app
+        self.app.config['TESTING'] = True
+        self.alice = self.app.test_client()
+        self.bob = self.app.test_client()
+        limiter.reset()
+
+        with self.app.app_context():
+            reset_db()
+
+            pswd_hashed = bcrypt.hashpw('password123'.encode('utf-8'), bcrypt.gensalt(rounds=4)).decode('utf-8')
+            alice = User(nom='alice', pswd_hashed=pswd_hashed)
+            bob = User(nom='bob', pswd_hashed=pswd_hashed)
+            db.session.add_all([alice, bob])
+            db.session.commit()
+            self.alice_id = alice.id
+            self.bob_id = bob.id
+
+        for client, username in ((self.alice, 'alice'), (self.bob, 'bob')):
+            client.post('/api/login',
+                data=json.dumps({'username': username, 'password': 'password123'}),
+                content_type='application/json'
+            )
+
+        # Streams wake up often so a test never waits long for "no event"
+        heartbeat, queue_size = EventBroker.heartbeat_seconds, EventBroker.queue_size
+        EventBroker.heartbeat_seconds = 0.05
+        self.addCleanup(setattr, EventBroker, 'heartbeat_seconds', heartbeat)
+        self.addCleanup(setattr, EventBroker, 'queue_size', queue_size)
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+        limiter.reset()
+
+    def open_stream(self, client, **headers):
+        response = client.get('/api/events', headers=headers, buffered=False)
+        self.addCleanup(response.close)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/event-stream'))
+        return response, iter(response.response)
+
+    def read_events(self, chunks, until_keep_alive=True):
+        """Parses the stream up to the next keep-alive (or its end)"""
+        events = []
+        for chunk in chunks:
+            text = chunk.decode() if isinstance(chunk, bytes) else chunk
+            if text.startswith(': keep-alive'):
+                if until_keep_alive:
+                    break
+                continue
+            fields = dict(line.split(': ', 1) for line in text.strip().split('\n'))
+            if 'event' in fields:
+                events.append({
+                    'id': int(fields['id']) if 'id' in fields else None,
+                    'type': fields['event'],
+                    'data': json.loads(fields['data']),
+                })
+        return events
+
+    def create_note(self, client, title, visibility):
+        response = client.post('/api/notes',
+            data=json.dumps({'title': title, 'content': 'Content', 'visibility': visibility}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.get_json()['note']['id']
+
+    # ------------------------------------------------------------------
+    # STREAM
+    # ------------------------------------------------------------------
+
+    def test_events_require_authentication(self):
+        """Without the JWT cookie the stream is refused"""
+        response = self.app.test_client().get('/api/events')
+        self.assertEqual(response.status_code, 401)
+
+    def test_note_events_reach_the_users_who_can_read_them(self):
+        """A public note is announced to everyone, a private one only to its owner"""
+        _, alice_stream = self.open_stream(self.alice)
+        _, bob_stream = self.open_stream(self.bob)
+        self.read_events(alice_stream)
+        self.read_events(bob_stream)
+
+        public_id = self.create_note(self.alice, 'Shared', 'read')
+        private_id = self.create_note(self.alice, 'Secret', 'private')
+
+        alice_events = self.read_events(alice_stream)
+        bob_events = self.read_events(bob_stream)
+        self.assertEqual([(e['type'], e['data']['id']) for e in alice_events],
+                         [('note-created', public_id), ('note-created', private_id)])
+        self.assertEqual([(e['type'], e['data']['id']) for e in bob_events], [('note-created', public_id)])
+        self.assertEqual(bob_events[0]['data']['title'], 'Shared')
+        self.assertNotIn('content', bob_events[0]['data'])
+
+    def test_edit_publishes_lock_and_update_events(self):
+        """Locking, saving and unlocking a public note is seen by another reader"""
+        note_id = self.create_note(self.alice, 'Shared', 'write')
+        _, bob_stream = self.open_stream(self.bob)
+        self.read_events(bob_stream)
+
+        self.assertEqual(self.alice.post(f'/api/notes/{note_id}/lock').status_code, 200)
+        response = self.alice.put(f'/api/notes/{note_id}/edit',
+            data=json.dumps({'title': 'Shared v2', 'content': 'New content'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+        events = self.read_events(bob_stream)
+        self.assertEqual([e['type'] for e in events], ['lock-acquired', 'note-updated', 'lock-released'])
+        self.assertEqual((events[0]['data']['user_id'], events[0]['data']['locked']), (self.alice_id, True))
+        self.assertIsNotNone(events[0]['data']['expires_at'])
+        self.assertEqual(events[1]['data']['title'], 'Shared v2')
+        self.assertEqual(events[1]['data']['version'], 2)
+        self.assertFalse(events[2]['data']['locked'])
+
+    def test_bulk_write_publishes_one_event_per_note(self):
+        """Bulk creates and updates are announced like single writes"""
+        note_id = self.create_note(self.alice, 'Mine', 'private')
+        _, alice_stream = self.open_stream(self.alice)
+        _, bob_stream = self.open_stream(self.bob)
+        self.read_events(alice_stream)
+        self.read_events(bob_stream)
+
+        response = self.alice.post('/api/notes/bulk',
+            data=json.dumps({'notes': [
+                {'title': 'Bulk public', 'content': 'x', 'visibility': 'read'},
+                {'id': note_id, 'title': 'Mine v2', 'content': 'y'},
+            ]}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+        alice_events = self.read_events(alice_stream)
+        self.assertEqual([e['type'] for e in alice_events], ['note-created', 'note-updated'])
+        self.assertEqual(alice_events[1]['data']['id'], note_id)
+        self.assertEqual([e['data']['title'] for e in self.read_events(bob_stream)], ['Bulk public'])
+
+    def test_reconnect_replays_missed_events(self):
+        """Last-Event-ID resumes the stream after the last event received"""
+        _, stream = self.open_stream(self.bob)
+        self.read_events(stream)
+        self.create_note(self.alice, 'First', 'read')
+        last_seen = self.read_events(stream)[-1]['id']
+
+        second_id = self.create_note(self.alice, 'Second', 'read')
+        self.create_note(self.alice, 'Hidden', 'private')
+
+        _, stream = self.open_stream(self.bob, **{'Last-Event-ID': str(last_seen)})
+        events = self.read_events(stream)
+        self.assertEqual([e['data']['id'] for e in events], [second_id])
+
+    def test_reconnect_after_backlog_asks_to_resync(self):
+        """Events no longer kept cannot be replayed; the client must reload"""
+        self.create_note(self.alice, 'Old', 'read')
+        with EventBroker._lock:
+            EventBroker._backlog.clear()
+        self.create_note(self.alice, 'New', 'read')
+
+        response = self.bob.get('/api/events', headers={'Last-Event-ID': '0'}, buffered=False)
+        self.addCleanup(response.close)
+        events = self.read_events(iter(response.response), until_keep_alive=False)
+        self.assertEqual([e['type'] for e in events], ['resync'])
+
+    def test_slow_client_is_told_to_resync(self):
+        """A client that falls behind the queue is dropped instead of slowing publishers"""
+        EventBroker.queue_size = 2
+        dropped = EVENTS_DROPPED.value()
+        response, stream = self.open_stream(self.bob)
+        next(stream)
+
+        note = SimpleNamespace(id=1, owner_id=self.alice_id, visibility='read')
+        for version in range(3):
+            EventBroker.publish('note-updated', note, {'id': 1, 'version': version})
+
+        events = self.read_events(stream, until_keep_alive=False)
+        self.assertEqual([e['type'] for e in events], ['resync'])
+        self.assertEqual(EVENTS_DROPPED.value(), dropped + 1)
+        self.assertEqual(EventBroker.subscriber_count(), 0)
+
+    def test_closing_the_stream_unsubscribes(self):
+        """Disconnected clients are forgotten, even before their stream started"""
+        self.assertEqual(EventBroker.subscriber_count(), 0)
+        started, stream = self.open_stream(self.alice)
+        next(stream)
+        not_started = self.bob.get('/api/events', buffered=False)
+        self.assertEqual(EventBroker.subscriber_count(), 2)
+
+        started.close()
+        not_started.close()
+        self.assertEqual(EventBroker.subscriber_count(), 0)
+
+        self.create_note(self.alice, 'Nobody listening', 'read')
+
+
+if __name__ == '__main__':
+    unittest.main()
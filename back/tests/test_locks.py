@@ -0,0 +1,567 @@
+# tests/test_locks.py
+"""
+Edit lock test suite for Notes application
+Tests: lock leases, renewal, expiry, background reaper, concurrent acquisition,
+in-memory lock table with write-behind, waiting in line for a lock
+"""
+
+import sys
+import os
+# Add parent folder to path to import app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import json
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+import bcrypt
+from sqlalchemy import event
+
+from app import app, reset_db, limiter
+from models import db
+from models.lock import Lock, utcnow
+from models.note import Note
+from models.user import User
+from services.event_broker import EventBroker
+from services.lock_service import LockService
+from services.lock_table import LockTable
+from services.lock_waiters import Waiter
+
+
+class LocksTestCase(unittest.TestCase):
+    """Lock endpoints and LockService tests"""
+
+    def setUp(self):
+        self.app = app
+        self.app.config['TESTING'] = True
+        self.alice = self.app.test_client()
+        self.bob = self.app.test_client()
+        limiter.reset()
+
+        with self.app.app_context():
+            reset_db()
+
+            pswd_hashed = bcrypt.hashpw('password123'.encode('utf-8'), bcrypt.gensalt(rounds=4)).decode('utf-8')
+            alice = User(nom='alice', pswd_hashed=pswd_hashed)
+            bob = User(nom='bob', pswd_hashed=pswd_hashed)
+            db.session.add_all([alice, bob])
+            db.session.commit()
+            self.alice_id = alice.id
+            self.bob_id = bob.id
+
+            note = Note(owner_id=alice.id, title='Shared', content='Content', visibility='write')
+            db.session.add(note)
+            db.session.commit()
+            self.note_id = note.id
+
+        for client, username in ((self.alice, 'alice'), (self.bob, 'bob')):
+            client.post('/api/login',
+                data=json.dumps({'username': username, 'password': 'password123'}),
+                content_type='application/json'
+            )
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+        limiter.reset()
+
+    def lock_row(self, note_id=None):
+        with self.app.app_context():
+            lock = db.session.get(Lock, note_id or self.note_id)
+            return (lock.locked, lock.user_id, lock.expires_at) if lock else None
+
+    def expire(self, note_id=None, ago=timedelta(seconds=1)):
+        """Moves the lease's expiry to the past"""
+        with self.app.app_context():
+            db.session.get(Lock, note_id or self.note_id).expires_at = utcnow() - ago
+            db.session.commit()
+
+    # ------------------------------------------------------------------
+    # LEASES
+    # ------------------------------------------------------------------
+
+    def test_acquire_grants_a_lease(self):
+        """A new lock expires LOCK_LEASE_SECONDS from now"""
+        before = utcnow()
+        response = self.alice.post(f'/api/notes/{self.note_id}/lock')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.get_json()['lock']['expires_at'])
+
+        locked, user_id, expires_at = self.lock_row()
+        lease = timedelta(seconds=self.app.config['LOCK_LEASE_SECONDS'])
+        self.assertEqual((locked, user_id), (True, self.alice_id))
+        self.assertTrue(before + lease <= expires_at <= utcnow() + lease)
+
+    def test_expired_lease_can_be_taken_by_another_user(self):
+        """A lock left behind by a closed editor frees itself"""
+        self.alice.post(f'/api/notes/{self.note_id}/lock')
+        self.assertEqual(self.bob.post(f'/api/notes/{self.note_id}/lock').status_code, 409)
+
+        self.expire()
+        status = self.bob.get(f'/api/notes/{self.note_id}/lock').get_json()['lock']
+        self.assertFalse(status['locked'])
+
+        response = self.bob.post(f'/api/notes/{self.note_id}/lock')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['message'], 'Lock acquired')
+        self.assertEqual(self.lock_row()[1], self.bob_id)
+
+    def test_renew_extends_the_lease(self):
+        """The editor's heartbeat pushes the expiry back"""
+        self.alice.post(f'/api/notes/{self.note_id}/lock')
+        self.expire(ago=-timedelta(seconds=5))  # 5 seconds left
+
+        response = self.alice.post(f'/api/notes/{self.note_id}/lock/renew')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(self.lock_row()[2], utcnow() + timedelta(seconds=60))
+
+    def test_renew_fails_without_a_live_lease(self):
+        """Only the holder renews, and only before the lease ran out"""
+        self.alice.post(f'/api/notes/{self.note_id}/lock')
+        self.assertEqual(self.bob.post(f'/api/notes/{self.note_id}/lock/renew').status_code, 409)
+
+        self.expire()
+        self.assertEqual(self.alice.post(f'/api/notes/{self.note_id}/lock/renew').status_code, 409)
+
+    def test_release_clears_the_lease(self):
+        """A released lock leaves the expiry index"""
+        self.alice.post(f'/api/notes/{self.note_id}/lock')
+        self.assertEqual(self.alice.delete(f'/api/notes/{self.note_id}/lock').status_code, 200)
+        self.assertEqual(self.lock_row(), (False, None, None))
+
+    def test_expired_lease_does_not_block_bulk_writes(self):
+        """Bulk updates only skip notes whose lock is still held"""
+        self.bob.post(f'/api/notes/{self.note_id}/lock')
+        self.expire()
+
+        response = self.alice.post('/api/notes/bulk',
+            data=json.dumps({'notes': [{'id': self.note_id, 'title': 'Edited', 'content': 'x'}]}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.get_json()['results'][0]['status'], 200)
+
+    def test_edit_requires_a_live_lease(self):
+        """A save after the lease ran out and the lock changed hands is refused"""
+        self.alice.post(f'/api/notes/{self.note_id}/lock')
+        self.expire()
+        self.assertEqual(self.bob.post(f'/api/notes/{self.note_id}/lock').status_code, 200)
+
+        response = self.alice.put(f'/api/notes/{self.note_id}/edit',
+            data=json.dumps({'title': 'Stale', 'content': 'Overwritten'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 409)
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Note, self.note_id).title, 'Shared')
+        self.assertEqual(self.lock_row()[:2], (True, self.bob_id))
+
+        response = self.bob.put(f'/api/notes/{self.note_id}/edit',
+            data=json.dumps({'title': 'Edited', 'content': 'By the holder'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    # ------------------------------------------------------------------
+    # REAPER
+    # ------------------------------------------------------------------
+
+    def test_reaper_releases_expired_leases_in_batches(self):
+        """Every expired lock is released, live ones are kept"""
+        with self.app.app_context():
+            notes = [Note(owner_id=self.alice_id, title=f'Note {i}', content='x') for i in range(5)]
+            db.session.add_all(notes)
+            db.session.flush()
+            now = utcnow()
+            db.session.add_all([
+                Lock(note_id=note.id, user_id=self.alice_id, locked=True, expires_at=now - timedelta(seconds=i + 1))
+                for i, note in enumerate(notes)
+            ])
+            db.session.add(Lock(note_id=self.note_id, user_id=self.bob_id, locked=True,
+                                expires_at=now + timedelta(minutes=5)))
+            db.session.commit()
+            expired_ids = [note.id for note in notes]
+
+            subscription = EventBroker.subscribe(self.alice_id)
+            self.addCleanup(EventBroker.unsubscribe, subscription)
+            self.assertEqual(LockService.expire_leases(batch_size=2), 5)
+            self.assertEqual(LockService.expire_leases(batch_size=2), 0)
+
+        for note_id in expired_ids:
+            self.assertEqual(self.lock_row(note_id), (False, None, None))
+        self.assertEqual(self.lock_row()[:2], (True, self.bob_id))
+
+        events = subscription.wait(0)
+        self.assertEqual(sorted(event['data']['note_id'] for event in events), sorted(expired_ids))
+        self.assertEqual({event['type'] for event in events}, {'lock-released'})
+
+    def test_reaper_reads_the_expiry_index(self):
+        """Finding expired leases does not scan the locks table"""
+        with self.app.app_context():
+            compiled = LockService.expired_leases_query(utcnow(), 10).compile(dialect=db.engine.dialect)
+            params = tuple(compiled.params[name] for name in compiled.positiontup)
+            plan = ' '.join(row[-1] for row in db.session.connection().exec_driver_sql(
+                'EXPLAIN QUERY PLAN ' + str(compiled), params))
+        self.assertIn('ix_locks_expires_at', plan)
+        self.assertNotIn('SCAN locks', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+    # ------------------------------------------------------------------
+    # CONCURRENCY
+    # ------------------------------------------------------------------
+
+    def add_editors(self, count):
+        """Users allowed to edit the shared note; returns their ids"""
+        with self.app.app_context():
+            users = [User(nom=f'editor {i}', pswd_hashed='-') for i in range(count)]
+            db.session.add_all(users)
+            db.session.commit()
+            return [user.id for user in users]
+
+    def run_threads(self, user_ids, target):
+        """Runs target(user_id) in one thread per user, started together"""
+        barrier = threading.Barrier(len(user_ids))
+        errors = []
+
+        def run(user_id):
+            with self.app.app_context():
+                try:
+                    barrier.wait()
+                    target(user_id)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=run, args=(user_id,)) for user_id in user_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_acquire_grants_a_single_holder(self):
+        """Users racing for a free lock: exactly one gets it"""
+        editors = self.add_editors(8)
+        for _ in range(10):
+            results = {}
+            self.run_threads(editors, lambda user_id: results.update({user_id: LockService.acquire_lock(self.note_id, user_id)}))
+
+            winners = [user_id for user_id, result in results.items() if result['success']]
+            self.assertEqual(len(winners), 1, results)
+            self.assertEqual(self.lock_row()[:2], (True, winners[0]))
+            with self.app.app_context():
+                self.assertTrue(LockService.release_lock(self.note_id, winners[0])['success'])
+
+    def hammer_lock(self, editors):
+        """Acquire/release cycles from one thread per editor; returns the grants"""
+        holders, overlaps, grants = set(), [], []
+        guard = threading.Lock()
+
+        def edit(user_id):
+            for _ in range(15):
+                if not LockService.acquire_lock(self.note_id, user_id)['success']:
+                    continue
+                with guard:
+                    if holders:
+                        overlaps.append((user_id, set(holders)))
+                    holders.add(user_id)
+                    grants.append(user_id)
+                time.sleep(0.001)
+                with guard:
+                    holders.discard(user_id)
+                self.assertTrue(LockService.release_lock(self.note_id, user_id)['success'])
+
+        self.run_threads(editors, edit)
+        self.assertEqual(overlaps, [])
+        return grants
+
+    def test_lock_holders_never_overlap(self):
+        """Acquire and release hammered from many threads: one holder at a time"""
+        grants = self.hammer_lock(self.add_editors(8))
+        self.assertGreater(len(grants), 1)
+        self.assertEqual(self.lock_row(), (False, None, None))
+
+    def test_acquire_is_a_single_statement(self):
+        """Once the note is loaded, taking the lock is one conditional upsert"""
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            from services.note_service import NoteService
+            note = NoteService.get_note(self.note_id)  # as the routes have it loaded already
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                self.assertTrue(LockService.acquire_lock(self.note_id, self.bob_id)['success'])
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            self.assertEqual(note.id, self.note_id)
+        self.assertEqual(len(statements), 1, statements)
+        self.assertTrue(statements[0].startswith('INSERT INTO locks'), statements[0])
+
+    # ------------------------------------------------------------------
+    # IN-MEMORY LOCK TABLE
+    # ------------------------------------------------------------------
+
+    def use_lock_table(self, stripes=4):
+        """Switches LockService to an in-memory table for this test"""
+        self.addCleanup(setattr, LockService, 'table', None)
+        LockService.table = LockTable(stripes)
+        return LockService.table
+
+    def test_memory_locks_do_not_touch_the_database(self):
+        """Taking, checking and releasing a lock run no SQL once the note is loaded"""
+        self.use_lock_table()
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            from services.note_service import NoteService
+            note = NoteService.get_note(self.note_id)
+            LockService.memory_table()  # loaded from the locks table once
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                self.assertTrue(LockService.acquire_lock(self.note_id, self.bob_id)['success'])
+                self.assertEqual(LockService.get_lock_status(self.note_id)['user_id'], self.bob_id)
+                self.assertFalse(LockService.acquire_lock(self.note_id, self.alice_id)['success'])
+                self.assertTrue(LockService.renew_lock(self.note_id, self.bob_id)['success'])
+                self.assertTrue(LockService.release_lock(self.note_id, self.bob_id)['success'])
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            self.assertEqual(note.id, self.note_id)
+        self.assertEqual(statements, [])
+        self.assertIsNone(self.lock_row())
+
+    def test_memory_locks_through_the_api(self):
+        """The endpoints and bulk writes see the in-memory leases"""
+        self.use_lock_table()
+        self.assertEqual(self.bob.post(f'/api/notes/{self.note_id}/lock').status_code, 200)
+        self.assertEqual(self.alice.post(f'/api/notes/{self.note_id}/lock').status_code, 409)
+        status = self.alice.get(f'/api/notes/{self.note_id}/lock').get_json()['lock']
+        self.assertEqual((status['locked'], status['user_id']), (True, self.bob_id))
+
+        response = self.alice.post('/api/notes/bulk',
+            data=json.dumps({'notes': [{'id': self.note_id, 'title': 'Edited', 'content': 'x'}]}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.get_json()['results'][0]['status'], 409)
+
+        # The note owner may release anyone's lock
+        self.assertEqual(self.alice.delete(f'/api/notes/{self.note_id}/lock').status_code, 200)
+        self.assertEqual(self.alice.post(f'/api/notes/{self.note_id}/lock').status_code, 200)
+
+    def test_write_behind_persists_leases_for_restart(self):
+        """Leases reach the locks table in the background and are read back by a new table"""
+        self.use_lock_table()
+        with self.app.app_context():
+            LockService.acquire_lock(self.note_id, self.bob_id)
+        self.assertIsNone(self.lock_row())
+
+        with self.app.app_context():
+            self.assertEqual(LockService.write_behind(), 1)
+            self.assertEqual(LockService.write_behind(), 0)
+        self.assertEqual(self.lock_row()[:2], (True, self.bob_id))
+
+        # Restart: a new table loads the live leases
+        LockService.table = LockTable(4)
+        with self.app.app_context():
+            self.assertEqual(LockService.get_lock_status(self.note_id)['user_id'], self.bob_id)
+            self.assertTrue(LockService.release_lock(self.note_id, self.bob_id)['success'])
+            LockService.write_behind()
+        self.assertEqual(self.lock_row(), (False, None, None))
+
+    def test_memory_leases_expire(self):
+        """The reaper drops expired in-memory leases and announces them"""
+        table = self.use_lock_table()
+        now = utcnow()
+        table.ensure_loaded(lambda: [])
+        table.acquire(self.note_id, self.bob_id, now, now - timedelta(seconds=1))
+
+        with self.app.app_context():
+            LockService.write_behind()
+            subscription = EventBroker.subscribe(self.alice_id)
+            self.addCleanup(EventBroker.unsubscribe, subscription)
+            self.assertFalse(LockService.get_lock_status(self.note_id)['locked'])
+            self.assertEqual(LockService.expire_leases(), 1)
+            LockService.write_behind()
+        self.assertEqual(len(table), 0)
+        self.assertEqual([event['type'] for event in subscription.wait(0)], ['lock-released'])
+        self.assertEqual(self.lock_row(), (False, None, None))
+
+    def test_memory_lock_holders_never_overlap(self):
+        """The striped table keeps a single holder under contention"""
+        self.use_lock_table()
+        grants = self.hammer_lock(self.add_editors(8))
+        self.assertGreater(len(grants), 1)
+        with self.app.app_context():
+            self.assertFalse(LockService.get_lock_status(self.note_id)['locked'])
+
+    # ------------------------------------------------------------------
+    # WAIT QUEUE
+    # ------------------------------------------------------------------
+
+    def start_waiting(self, user_id, timeout, results):
+        """wait_for_lock in a thread, returning once the user is queued"""
+        queued = LockService.waiters.waiting(self.note_id)
+
+        def run():
+            with self.app.app_context():
+                try:
+                    results.append((user_id, LockService.wait_for_lock(self.note_id, user_id, timeout)))
+                finally:
+                    db.session.remove()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+        deadline = time.monotonic() + 5
+        while LockService.waiters.waiting(self.note_id) == queued and thread.is_alive():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.005)
+        return thread
+
+    def release(self, user_id):
+        with self.app.app_context():
+            self.assertTrue(LockService.release_lock(self.note_id, user_id)['success'])
+
+    def test_waiter_gets_the_lock_when_released(self):
+        """A waiting editor is handed the lock as soon as it is free"""
+        with self.app.app_context():
+            LockService.acquire_lock(self.note_id, self.bob_id)
+        results = []
+        waiting = self.start_waiting(self.alice_id, 5, results)
+
+        started = time.monotonic()
+        self.release(self.bob_id)
+        waiting.join()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(results[0][1]['success'], results)
+        self.assertEqual(self.lock_row()[:2], (True, self.alice_id))
+        self.assertEqual(LockService.waiters.waiting(self.note_id), 0)
+
+    def test_waiters_are_served_in_order(self):
+        """Queued editors get the lock one after the other, first come first served"""
+        editors = self.add_editors(3)
+        with self.app.app_context():
+            LockService.acquire_lock(self.note_id, self.bob_id)
+        results = []
+        threads = [self.start_waiting(user_id, 5, results) for user_id in editors]
+
+        holder = self.bob_id
+        for thread in threads:
+            self.release(holder)
+            thread.join()
+            holder = results[-1][0]
+        self.assertEqual([user_id for user_id, _ in results], editors)
+        self.assertTrue(all(result['success'] for _, result in results), results)
+
+    def test_queued_editors_go_before_newcomers(self):
+        """While someone waits, a free lock cannot be taken without queueing"""
+        waiter = LockService.waiters.join(self.note_id, self.alice_id)
+        self.addCleanup(LockService.waiters.leave, self.note_id, waiter)
+
+        with self.app.app_context():
+            result = LockService.acquire_lock(self.note_id, self.bob_id)
+            self.assertFalse(result['success'])
+            self.assertEqual(result['error'], 'Other editors are waiting for this note')
+            self.assertTrue(LockService.acquire_lock(self.note_id, self.alice_id)['success'])
+
+    def test_wait_times_out(self):
+        """A lock that stays held ends the wait with a conflict"""
+        with self.app.app_context():
+            LockService.acquire_lock(self.note_id, self.bob_id)
+            started = time.monotonic()
+            result = LockService.wait_for_lock(self.note_id, self.alice_id, 0.2)
+        self.assertFalse(result['success'])
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(LockService.waiters.waiting(self.note_id), 0)
+
+    def test_waiter_takes_an_expired_lease(self):
+        """The first waiter wakes up when the lease runs out, without a release"""
+        with self.app.app_context():
+            LockService.acquire_lock(self.note_id, self.bob_id)
+        self.expire(ago=-timedelta(seconds=0.3))
+
+        with self.app.app_context():
+            started = time.monotonic()
+            result = LockService.wait_for_lock(self.note_id, self.alice_id, 5)
+        self.assertTrue(result['success'], result)
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_wait_queue_is_bounded(self):
+        """Beyond LOCK_WAIT_QUEUE_SIZE waiters, requests are turned away at once"""
+        self.bob.post(f'/api/notes/{self.note_id}/lock')
+        LockService.waiters.max_waiters = 1
+        waiter = LockService.waiters.join(self.note_id, self.bob_id)
+        self.addCleanup(LockService.waiters.leave, self.note_id, waiter)
+
+        response = self.alice.post(f'/api/notes/{self.note_id}/lock?wait=5')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(LockService.waiters.waiting(self.note_id), 1)
+
+    def test_lock_endpoint_waits(self):
+        """POST /lock?wait= answers once the lock is handed over"""
+        self.bob.post(f'/api/notes/{self.note_id}/lock')
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(
+            self.alice.post(f'/api/notes/{self.note_id}/lock?wait=5')))
+        thread.start()
+        deadline = time.monotonic() + 5
+        while not LockService.waiters.waiting(self.note_id):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.005)
+
+        self.assertEqual(self.bob.delete(f'/api/notes/{self.note_id}/lock').status_code, 200)
+        thread.join()
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(responses[0].get_json()['lock']['user_id'], self.alice_id)
+        self.assertEqual(self.alice.post(f'/api/notes/{self.note_id}/lock?wait=0.1').status_code, 200)
+
+    def test_parked_waiter_holds_no_connection(self):
+        """A request waiting in line gives its database connection back to the pool"""
+        self.bob.post(f'/api/notes/{self.note_id}/lock')
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(
+            self.alice.post(f'/api/notes/{self.note_id}/lock?wait=5')))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.release, self.bob_id)
+        deadline = time.monotonic() + 5
+        while not LockService.waiters.waiting(self.note_id):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.005)
+
+        with self.app.app_context():
+            pool = db.engine.pool
+        deadline = time.monotonic() + 1
+        while pool.checkedout():
+            self.assertLess(time.monotonic(), deadline, 'the parked request kept its connection')
+            time.sleep(0.005)
+        self.assertTrue(thread.is_alive())
+
+    def test_wake_after_a_timed_out_wait_is_kept(self):
+        """A release landing just as a wait times out still wakes the waiter"""
+        waiter = Waiter(self.alice_id)
+        waiter.reset()
+        real_wait = waiter._event.wait
+
+        def times_out_then_woken(timeout):
+            real_wait(0)
+            waiter.wake()
+            return False
+
+        with mock.patch.object(waiter._event, 'wait', side_effect=times_out_then_woken):
+            waiter.wait(0.01)
+        started = time.monotonic()
+        waiter.wait(1)
+        self.assertLess(time.monotonic() - started, 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
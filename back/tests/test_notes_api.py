@@ -0,0 +1,768 @@
+# tests/test_notes_api.py
+"""
+Notes API test suite for Notes application
+Tests: listing pagination, query counts, field projection, conditional GET, public feed cache,
+full-text search, batch reads, bulk writes, changes feed
+"""
+
+import sys
+import os
+# Add parent folder to path to import app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import json
+from contextlib import contextmanager
+from unittest import mock
+
+import bcrypt
+from sqlalchemy import event
+
+from app import app, reset_db, limiter
+from models import db
+from models.user import User
+from models.note import Note
+from models.outbox import SyncOutbox
+from services.feed_cache import FeedCache, LRUCache
+from services.note_service import NoteService
+from services.metrics import CACHE_HITS, CACHE_MISSES
+
+
+class NotesApiTestCase(unittest.TestCase):
+    """Notes endpoints tests"""
+
+    def setUp(self):
+        self.app = app
+        self.app.config['TESTING'] = True
+        self.client = self.app.test_client()
+        limiter.reset()
+
+        with self.app.app_context():
+            reset_db()
+
+            pswd_hashed = bcrypt.hashpw('password123'.encode('utf-8'), bcrypt.gensalt(rounds=4)).decode('utf-8')
+            alice = User(nom='alice', pswd_hashed=pswd_hashed)
+            bob = User(nom='bob', pswd_hashed=pswd_hashed)
+            db.session.add_all([alice, bob])
+            db.session.commit()
+            self.alice_id = alice.id
+            self.bob_id = bob.id
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+        limiter.reset()
+
+    def login(self, username='alice', password='password123'):
+        return self.client.post('/api/login',
+            data=json.dumps({'username': username, 'password': password}),
+            content_type='application/json'
+        )
+
+    def add_notes(self, owner_id, count, visibility='private', content='Content'):
+        """Inserts notes directly, bypassing the API; returns their ids"""
+        with self.app.app_context():
+            notes = [
+                Note(owner_id=owner_id, title=f'{visibility} {i}', content=content, visibility=visibility)
+                for i in range(count)
+            ]
+            db.session.add_all(notes)
+            db.session.commit()
+            return [note.id for note in notes]
+
+    @contextmanager
+    def count_queries(self):
+        """Collects the SQL statements run on the master database inside the block"""
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+    def assertQueryCount(self, expected, statements):
+        self.assertEqual(len(statements), expected, '\n'.join(statements))
+
+    def get_page(self, cursor=None, limit=None, path='/api/notes'):
+        params = {}
+        if cursor:
+            params['cursor'] = cursor
+        if limit:
+            params['limit'] = limit
+        response = self.client.get(path, query_string=params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    # ===== TESTS PAGINATION =====
+
+    def test_listing_pages_through_visible_notes(self):
+        """Test: Pages cover owned and shared notes once each, newest first"""
+        owned = self.add_notes(self.alice_id, 7)
+        shared = self.add_notes(self.bob_id, 4, 'read') + self.add_notes(self.bob_id, 3, 'write')
+        self.add_notes(self.bob_id, 5, 'private')
+        self.login()
+
+        seen = []
+        cursor = None
+        while True:
+            page = self.get_page(cursor, limit=4)
+            self.assertLessEqual(len(page['notes']), 4)
+            seen.extend(page['notes'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+
+        ids = [note['id'] for note in seen]
+        self.assertEqual(ids, sorted(owned + shared, reverse=True))
+        self.assertEqual({note['id'] for note in seen if note['is_owner']}, set(owned))
+
+    def test_last_full_page_has_no_cursor(self):
+        """Test: No cursor is returned once the listing is exhausted"""
+        self.add_notes(self.alice_id, 4)
+        self.login()
+        page = self.get_page(limit=4)
+        self.assertEqual(len(page['notes']), 4)
+        self.assertIsNone(page['next_cursor'])
+
+    def test_page_size_is_capped(self):
+        """Test: The page size defaults to NOTES_PAGE_SIZE and cannot exceed NOTES_MAX_PAGE_SIZE"""
+        self.addCleanup(self.app.config.update, {key: self.app.config[key] for key in ('NOTES_PAGE_SIZE', 'NOTES_MAX_PAGE_SIZE')})
+        self.app.config.update(NOTES_PAGE_SIZE=3, NOTES_MAX_PAGE_SIZE=5)
+        self.add_notes(self.alice_id, 8)
+        self.login()
+
+        self.assertEqual(len(self.get_page()['notes']), 3)
+        self.assertEqual(len(self.get_page(limit=1000)['notes']), 5)
+
+    def test_invalid_cursor_is_rejected(self):
+        """Test: A malformed cursor is a client error"""
+        self.login()
+        response = self.client.get('/api/notes?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+
+    def test_user_notes_listing_is_paginated(self):
+        """Test: /api/users/<id>/notes pages the same way"""
+        self.add_notes(self.bob_id, 3)
+        page = self.get_page(limit=2, path=f'/api/users/{self.bob_id}/notes')
+        self.assertEqual(len(page['notes']), 2)
+        page = self.get_page(page['next_cursor'], limit=2, path=f'/api/users/{self.bob_id}/notes')
+        self.assertEqual(len(page['notes']), 1)
+        self.assertIsNone(page['next_cursor'])
+
+    def test_listing_queries_use_index_order(self):
+        """Test: Listing streams are read in index order, without sorting"""
+        with self.app.app_context():
+            for criteria in ('owner_id = 1', "visibility = 'read'"):
+                plan = db.session.execute(db.text(
+                    f'EXPLAIN QUERY PLAN SELECT * FROM notes WHERE {criteria} AND id < 100 ORDER BY id DESC LIMIT 51'
+                )).all()
+                details = ' '.join(row[-1] for row in plan)
+                self.assertIn('INDEX ix_notes_', details)
+                self.assertNotIn('TEMP B-TREE', details)
+
+    # ===== TESTS QUERY COUNTS =====
+
+    def test_listing_runs_constant_number_of_queries(self):
+        """Test: A 500-note listing page loads notes and owners in one query"""
+        self.addCleanup(self.app.config.update, {'NOTES_MAX_PAGE_SIZE': self.app.config['NOTES_MAX_PAGE_SIZE']})
+        self.app.config['NOTES_MAX_PAGE_SIZE'] = 1000
+        self.add_notes(self.alice_id, 250)
+        self.add_notes(self.bob_id, 250, 'read')
+        self.login()
+
+        with self.count_queries() as statements:
+            page = self.get_page(limit=500)
+        self.assertEqual(len(page['notes']), 500)
+        self.assertEqual({note['owner_name'] for note in page['notes']}, {'alice', 'bob'})
+        # Listing fingerprint (ETag), changes feed position, then the public
+        # feed and the user's own notes, with their owners
+        self.assertQueryCount(4, statements)
+
+        # The public feed is now cached
+        with self.count_queries() as statements:
+            self.assertEqual(self.get_page(limit=500), page)
+        self.assertQueryCount(3, statements)
+
+    def test_user_notes_listing_runs_constant_number_of_queries(self):
+        """Test: /api/users/<id>/notes does not load owners one by one"""
+        self.add_notes(self.alice_id, 20, 'write')
+        self.add_notes(self.bob_id, 20)
+
+        with self.count_queries() as statements:
+            page = self.get_page(path=f'/api/users/{self.bob_id}/notes')
+        self.assertEqual(len(page['notes']), 40)
+        self.assertQueryCount(4, statements)
+
+    def test_note_detail_is_one_query(self):
+        """Test: The detail loads the note, its owner and its lock in one query"""
+        [note_id] = self.add_notes(self.alice_id, 1)
+        self.login()
+        for locked in (False, True):
+            with self.count_queries() as statements:
+                note = self.client.get(f'/api/notes/{note_id}').get_json()['note']
+            self.assertEqual((note['owner_name'], note['lock']['locked']), ('alice', locked))
+            self.assertQueryCount(1, statements)
+            self.client.post(f'/api/notes/{note_id}/lock')
+
+    def test_edit_endpoints_read_the_note_once(self):
+        """Test: Repeated lookups of the note while editing reuse the loaded row"""
+        [note_id] = self.add_notes(self.alice_id, 1)
+        self.login()
+        self.client.post(f'/api/notes/{note_id}/lock')
+
+        with self.count_queries() as statements:
+            self.assertEqual(self.client.get(f'/api/notes/{note_id}/edit').status_code, 200)
+        # The note with its lock, then the renewal of the lock's lease
+        self.assertQueryCount(2, statements)
+        self.assertTrue(statements[1].startswith('INSERT INTO locks'), statements[1])
+
+        with self.count_queries() as statements:
+            response = self.client.put(f'/api/notes/{note_id}/edit',
+                data=json.dumps({'title': 'Edited', 'content': 'Edited content'}),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        reads = [statement for statement in statements if statement.startswith('SELECT notes.')]
+        # Before the update, then once after it for the server-set updated_at
+        self.assertEqual(len(reads), 2, '\n'.join(statements))
+
+
+    # ===== TESTS FIELD PROJECTION =====
+
+    def test_summary_view_returns_bounded_preview(self):
+        """Test: view=summary replaces the content with a short preview"""
+        self.add_notes(self.alice_id, 2, content='x' * 5000)
+        self.login()
+
+        with self.count_queries() as statements:
+            notes = self.client.get('/api/notes?view=summary').get_json()['notes']
+        self.assertEqual(len(notes), 2)
+        for note in notes:
+            self.assertNotIn('content', note)
+            self.assertEqual(note['preview'], 'x' * self.app.config['NOTES_PREVIEW_LENGTH'])
+            self.assertEqual(note['owner_name'], 'alice')
+            self.assertTrue(note['is_owner'])
+        self.assertNotIn('notes.content AS', statements[-1])
+
+    def test_fields_selects_requested_columns(self):
+        """Test: fields= returns and reads only the requested columns"""
+        self.add_notes(self.alice_id, 3)
+        self.login()
+
+        with self.count_queries() as statements:
+            page = self.client.get('/api/notes?fields=id,title').get_json()
+        self.assertEqual([set(note) for note in page['notes']], [{'id', 'title'}] * 3)
+        self.assertNotIn('content', statements[-1])
+        self.assertNotIn('users', statements[-1])
+
+    def test_unknown_field_is_rejected(self):
+        """Test: Asking for a field that does not exist is a client error"""
+        self.login()
+        self.assertEqual(self.client.get('/api/notes?fields=id,pswd_hashed').status_code, 400)
+        self.assertEqual(self.client.get('/api/notes?view=everything').status_code, 400)
+
+
+    # ===== TESTS CONDITIONAL GET =====
+
+    def edit_note(self, note_id, title='Edited', content='Edited content'):
+        self.client.post(f'/api/notes/{note_id}/lock')
+        response = self.client.put(f'/api/notes/{note_id}/edit',
+            data=json.dumps({'title': title, 'content': content}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_update_increments_version(self):
+        """Test: Every update bumps the note's version"""
+        [note_id] = self.add_notes(self.alice_id, 1)
+        self.login()
+        self.edit_note(note_id)
+        self.edit_note(note_id, title='Again')
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Note, note_id).version, 3)
+
+    def test_version_added_to_an_existing_database(self):
+        """Test: A notes table created before versions gets the column on startup"""
+        [note_id] = self.add_notes(self.alice_id, 1)
+        with self.app.app_context():
+            for index in ('ix_notes_owner_listing', 'ix_notes_visibility_listing'):
+                db.session.execute(db.text(f'DROP INDEX {index}'))
+            db.session.execute(db.text('ALTER TABLE notes DROP COLUMN version'))
+            db.session.commit()
+
+            NoteService.ensure_note_versions()
+            NoteService.ensure_note_versions()
+            indexes = {row[1] for row in db.session.execute(db.text('PRAGMA index_list(notes)'))}
+            self.assertTrue({'ix_notes_owner_listing', 'ix_notes_visibility_listing'} <= indexes)
+
+        self.login()
+        response = self.client.get(f'/api/users/{self.alice_id}/notes')
+        self.assertEqual(response.status_code, 200)
+        self.edit_note(note_id)
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Note, note_id).version, 2)
+
+    def test_listing_not_modified(self):
+        """Test: An unchanged listing answers 304 to If-None-Match"""
+        self.add_notes(self.alice_id, 3)
+        [public_id] = self.add_notes(self.bob_id, 1, 'write')
+        self.login()
+
+        response = self.client.get('/api/notes?view=summary')
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+
+        with self.count_queries() as statements:
+            response = self.client.get('/api/notes?view=summary', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertQueryCount(1, statements)
+
+        # Another representation of the same data has its own ETag
+        self.assertNotEqual(self.client.get('/api/notes').headers['ETag'], etag)
+
+        # Someone else's public note changes
+        self.edit_note(public_id)
+        response = self.client.get('/api/notes?view=summary', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_note_detail_not_modified(self):
+        """Test: The note detail answers 304 until the note or its lock changes"""
+        [note_id] = self.add_notes(self.alice_id, 1)
+        self.login()
+
+        etag = self.client.get(f'/api/notes/{note_id}').headers['ETag']
+        response = self.client.get(f'/api/notes/{note_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.client.post(f'/api/notes/{note_id}/lock')
+        response = self.client.get(f'/api/notes/{note_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        etag = response.headers['ETag']
+        self.edit_note(note_id)
+        response = self.client.get(f'/api/notes/{note_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_not_modified_still_checks_access(self):
+        """Test: A 304 is never served to a user who cannot read the note"""
+        [note_id] = self.add_notes(self.alice_id, 1)
+        self.login()
+        etag = self.client.get(f'/api/notes/{note_id}').headers['ETag']
+
+        self.login('bob')
+        response = self.client.get(f'/api/notes/{note_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 403)
+
+
+    # ===== TESTS PUBLIC FEED CACHE =====
+
+    def test_public_feed_is_shared_between_users(self):
+        """Test: The public notes are read once for all users, without their own notes"""
+        alice_public = self.add_notes(self.alice_id, 2, 'read')
+        bob_public = self.add_notes(self.bob_id, 2, 'write')
+        bob_private = self.add_notes(self.bob_id, 1)
+
+        self.login()
+        misses = CACHE_MISSES.value(cache='public_feed')
+        alice_notes = self.get_page()['notes']
+        self.login('bob')
+        hits = CACHE_HITS.value(cache='public_feed')
+        bob_notes = self.get_page()['notes']
+
+        self.assertEqual(CACHE_MISSES.value(cache='public_feed'), misses + 1)
+        self.assertEqual(CACHE_HITS.value(cache='public_feed'), hits + 1)
+        self.assertEqual([note['id'] for note in alice_notes], sorted(alice_public + bob_public, reverse=True))
+        self.assertEqual([note['id'] for note in bob_notes], sorted(alice_public + bob_public + bob_private, reverse=True))
+        self.assertEqual({note['id'] for note in bob_notes if note['is_owner']}, set(bob_public + bob_private))
+
+    def test_public_feed_cache_follows_writes(self):
+        """Test: Creating or editing a public note refreshes the cached feed"""
+        [public_id] = self.add_notes(self.bob_id, 1, 'read')
+        self.login()
+        self.get_page()
+
+        self.client.post('/api/notes',
+            data=json.dumps({'title': 'New', 'content': 'Content', 'visibility': 'write'}),
+            content_type='application/json'
+        )
+        self.login('bob')
+        self.edit_note(public_id, title='Edited')
+
+        self.login()
+        titles = [note['title'] for note in self.get_page()['notes']]
+        self.assertEqual(titles, ['New', 'Edited'])
+
+    def test_public_feed_invalidation_is_targeted(self):
+        """Test: A write only drops the cached pages whose id range holds the note"""
+        ids = self.add_notes(self.bob_id, 6, 'read')
+        self.login()
+        first = self.get_page(limit=3)
+        self.get_page(first['next_cursor'], limit=3)
+        self.assertEqual(len(FeedCache.cache), 2)
+
+        self.login('bob')
+        self.edit_note(ids[0])
+        self.assertEqual(len(FeedCache.cache), 1)
+        self.login()
+        hits = CACHE_HITS.value(cache='public_feed')
+        self.get_page(limit=3)
+        self.assertEqual(CACHE_HITS.value(cache='public_feed'), hits + 1)
+
+    def test_private_note_writes_keep_the_feed(self):
+        """Test: Editing a private note does not invalidate the public feed"""
+        self.add_notes(self.bob_id, 2, 'read')
+        [private_id] = self.add_notes(self.alice_id, 1)
+        self.login()
+        self.get_page()
+        self.edit_note(private_id)
+        self.assertEqual(len(FeedCache.cache), 1)
+
+    def test_lru_cache_evicts_and_expires(self):
+        """Test: The cache keeps at most max_entries, least recently used first, for ttl_seconds"""
+        cache = LRUCache('test', max_entries=2, ttl_seconds=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+        # Computed before an invalidation: not stored
+        generation = cache.generation
+        cache.discard(lambda key, value: key == 'a')
+        self.assertFalse(cache.put('a', 1, generation))
+        self.assertIsNone(cache.get('a'))
+
+        cache.configure(max_entries=2, ttl_seconds=0)
+        cache.put('d', 4)
+        self.assertIsNone(cache.get('d'))
+
+
+    # ===== TESTS SEARCH =====
+
+    def add_note(self, owner_id, title, content='Content', visibility='private'):
+        with self.app.app_context():
+            note = Note(owner_id=owner_id, title=title, content=content, visibility=visibility)
+            db.session.add(note)
+            db.session.commit()
+            return note.id
+
+    def search(self, q, **params):
+        response = self.client.get('/api/notes/search', query_string={'q': q, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_search_ranks_title_matches_first(self):
+        """Test: Notes matching in the title come before notes matching in the content"""
+        in_content = self.add_note(self.alice_id, 'Groceries', 'buy a new keyboard')
+        in_title = self.add_note(self.alice_id, 'Keyboard shortcuts', 'ctrl c, ctrl v')
+        self.add_note(self.alice_id, 'Unrelated', 'nothing here')
+        self.login()
+
+        notes = self.search('keyboard')['notes']
+        self.assertEqual([note['id'] for note in notes], [in_title, in_content])
+
+    def test_search_follows_read_permissions(self):
+        """Test: Search only returns the user's notes and the public ones"""
+        own = self.add_note(self.alice_id, 'Secret recipe')
+        public = self.add_note(self.bob_id, 'Recipe book', visibility='read')
+        self.add_note(self.bob_id, 'Private recipe')
+        self.login()
+
+        notes = self.search('recipe')['notes']
+        self.assertEqual({note['id'] for note in notes}, {own, public})
+        self.assertEqual({note['id'] for note in notes if note['is_owner']}, {own})
+
+    def test_search_index_follows_writes(self):
+        """Test: Created and edited notes are found by their new text only"""
+        self.login()
+        response = self.client.post('/api/notes',
+            data=json.dumps({'title': 'Holiday plans', 'content': 'Visit Lisbon', 'visibility': 'private'}),
+            content_type='application/json'
+        )
+        note_id = response.get_json()['note']['id']
+        self.assertEqual([note['id'] for note in self.search('lisbon')['notes']], [note_id])
+
+        self.edit_note(note_id, content='Visit Porto')
+        self.assertEqual(self.search('lisbon')['notes'], [])
+        self.assertEqual([note['id'] for note in self.search('porto')['notes']], [note_id])
+
+    def test_search_is_paginated(self):
+        """Test: Search results are paged with a cursor, each match once"""
+        ids = [self.add_note(self.alice_id, f'Meeting {i}', 'meeting notes ' * (i + 1)) for i in range(7)]
+        self.login()
+
+        seen = []
+        cursor = None
+        while True:
+            params = {'limit': 3, 'cursor': cursor} if cursor else {'limit': 3}
+            page = self.search('meeting', **params)
+            self.assertLessEqual(len(page['notes']), 3)
+            seen.extend(note['id'] for note in page['notes'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(sorted(seen), ids)
+
+    def test_search_query_syntax_is_plain_text(self):
+        """Test: Prefixes and accents match, FTS operators are searched as words"""
+        note_id = self.add_note(self.alice_id, 'Café "AND" réunion', 'OR NEAR(x)')
+        self.login()
+
+        for q in ('cafe reu', 'CAFÉ', '"and"', 'near(', 'OR'):
+            self.assertEqual([note['id'] for note in self.search(q)['notes']], [note_id], q)
+        response = self.client.get('/api/notes/search', query_string={'q': '*** "'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_uses_full_text_index(self):
+        """Test: Search reads the FTS index, not the whole notes table"""
+        self.add_notes(self.alice_id, 3)
+        self.login()
+        with self.count_queries() as statements:
+            self.search('content', view='summary')
+        self.assertQueryCount(1, statements)
+        self.assertIn('notes_fts MATCH', statements[0])
+        self.assertNotIn('notes.content AS', statements[0])
+
+    # ===== TESTS BATCH GET =====
+
+    def batch_get(self, ids):
+        return self.client.post('/api/notes/batch-get',
+            data=json.dumps({'ids': ids}),
+            content_type='application/json'
+        )
+
+    def test_batch_get_returns_per_id_results(self):
+        """Test: Each id gets its note or its own error, in the requested order"""
+        own, public = self.add_notes(self.alice_id, 1) + self.add_notes(self.bob_id, 1, 'read')
+        [private] = self.add_notes(self.bob_id, 1)
+        self.login()
+        self.client.post(f'/api/notes/{own}/lock')
+
+        with self.count_queries() as statements:
+            response = self.batch_get([public, 999, own, private])
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryCount(1, statements)
+
+        results = response.get_json()['results']
+        self.assertEqual([(result['id'], result['status']) for result in results],
+                         [(public, 200), (999, 404), (own, 200), (private, 403)])
+        self.assertEqual(results[0]['note']['access_level'], 'read')
+        self.assertEqual(results[0]['note']['owner_name'], 'bob')
+        self.assertTrue(results[2]['note']['is_owner'])
+        self.assertTrue(results[2]['note']['lock']['locked'])
+        self.assertNotIn('note', results[3])
+        # Same representation as the single note endpoint
+        self.assertEqual(results[2]['note'], self.client.get(f'/api/notes/{own}').get_json()['note'])
+
+    def test_batch_get_validates_ids(self):
+        """Test: ids must be a bounded list of integers"""
+        self.addCleanup(self.app.config.update, {'NOTES_BATCH_MAX_IDS': self.app.config['NOTES_BATCH_MAX_IDS']})
+        self.app.config['NOTES_BATCH_MAX_IDS'] = 3
+        self.login()
+        for ids in ('1,2', [1, '2'], [True], None, [1, 2, 3, 4]):
+            self.assertEqual(self.batch_get(ids).status_code, 400, ids)
+        self.assertEqual(self.batch_get([]).get_json()['results'], [])
+
+
+    # ===== TESTS BULK WRITE =====
+
+    def bulk_write(self, notes):
+        response = self.client.post('/api/notes/bulk',
+            data=json.dumps({'notes': notes}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()['results']
+
+    def test_bulk_write_creates_and_updates(self):
+        """Test: Valid items are saved in one transaction, invalid ones reported"""
+        [own] = self.add_notes(self.alice_id, 1)
+        [shared] = self.add_notes(self.bob_id, 1, 'write')
+        [readonly] = self.add_notes(self.bob_id, 1, 'read')
+        self.login()
+
+        with self.count_queries() as statements:
+            results = self.bulk_write([
+                {'title': ' Imported ', 'content': 'First', 'visibility': 'read'},
+                {'title': '', 'content': 'No title'},
+                {'id': own, 'title': 'Own', 'content': 'Updated'},
+                {'id': readonly, 'title': 'Nope', 'content': 'Nope'},
+                {'title': 'Second', 'content': 'x' * 10001},
+                {'id': shared, 'title': 'Shared', 'content': 'Updated too'},
+                {'id': 999, 'title': 'Missing', 'content': 'Missing'},
+                {'title': 'Third', 'content': 'Last', 'visibility': 'private'},
+            ])
+        self.assertEqual([result['status'] for result in results], [201, 400, 200, 403, 400, 200, 404, 201])
+        self.assertEqual(results[1]['error'], 'Title cannot be empty')
+        self.assertEqual(results[4]['error'], 'Content cannot exceed 10000 characters')
+        self.assertEqual(len([statement for statement in statements if statement.startswith('INSERT INTO notes')]), 1)
+        self.assertEqual(len([statement for statement in statements if statement.startswith('UPDATE notes')]), 1)
+
+        with self.app.app_context():
+            created = db.session.get(Note, results[0]['id'])
+            self.assertEqual((created.title, created.owner_id, created.visibility), ('Imported', self.alice_id, 'read'))
+            self.assertEqual(db.session.get(Note, results[7]['id']).content, 'Last')
+            updated = db.session.get(Note, own)
+            self.assertEqual((updated.title, updated.content, updated.version), ('Own', 'Updated', 2))
+            self.assertEqual(db.session.get(Note, shared).content, 'Updated too')
+            self.assertEqual(db.session.get(Note, readonly).title, 'read 0')
+
+            # One replication event for the whole request
+            [entry] = SyncOutbox.query.all()
+            self.assertEqual(entry.operation, 'bulk_notes')
+            self.assertEqual([note['id'] for note in entry.payload['create']], [results[0]['id'], results[7]['id']])
+            self.assertEqual([note['id'] for note in entry.payload['update']], [own, shared])
+
+    def test_bulk_write_matches_returned_ids_to_items(self):
+        """Test: Created ids go to the right items whatever order RETURNING lists them in"""
+        execute = db.session.execute
+
+        def reversed_returning(statement, *args, **kwargs):
+            result = execute(statement, *args, **kwargs)
+            if statement.is_insert and statement.table is Note.__table__:
+                return list(reversed(result.all()))
+            return result
+
+        self.login()
+        items = [{'title': title, 'content': 'Same'} for title in ('One', 'Two', 'Two', 'Three')]
+        with mock.patch.object(db.session, 'execute', side_effect=reversed_returning) as patched:
+            results = self.bulk_write(items)
+        self.assertTrue(any(call.args[0].is_insert for call in patched.call_args_list))
+        self.assertEqual(len({result['id'] for result in results}), 4)
+        with self.app.app_context():
+            titles = [db.session.get(Note, result['id']).title for result in results]
+        self.assertEqual(titles, ['One', 'Two', 'Two', 'Three'])
+
+    def test_bulk_write_respects_locks(self):
+        """Test: A note locked by someone else is not overwritten"""
+        [note_id] = self.add_notes(self.bob_id, 1, 'write')
+        self.login('bob')
+        self.client.post(f'/api/notes/{note_id}/lock')
+
+        self.login()
+        self.assertEqual(self.bulk_write([{'id': note_id, 'title': 'Mine', 'content': 'Mine'}])[0]['status'], 409)
+
+    def test_bulk_write_refreshes_feed_and_search(self):
+        """Test: Bulk writes show up in the cached feed and in search"""
+        [public_id] = self.add_notes(self.bob_id, 1, 'read')
+        self.login('bob')
+        self.get_page()
+
+        self.bulk_write([
+            {'title': 'Bulk import', 'content': 'zanzibar', 'visibility': 'write'},
+            {'id': public_id, 'title': 'Renamed', 'content': 'Content'},
+        ])
+        self.login()
+        self.assertEqual([note['title'] for note in self.get_page()['notes']], ['Bulk import', 'Renamed'])
+        self.assertEqual([note['title'] for note in self.search('zanzibar')['notes']], ['Bulk import'])
+
+    def test_bulk_write_is_bounded(self):
+        """Test: The request must be a bounded list of notes"""
+        self.addCleanup(self.app.config.update, {'NOTES_BULK_MAX_ITEMS': self.app.config['NOTES_BULK_MAX_ITEMS']})
+        self.app.config['NOTES_BULK_MAX_ITEMS'] = 2
+        self.login()
+        for notes in ({'title': 't'}, [{}, {}, {}]):
+            response = self.client.post('/api/notes/bulk',
+                data=json.dumps({'notes': notes}),
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 400)
+
+
+    # ===== TESTS CHANGES FEED =====
+
+    def changes(self, cursor, **params):
+        response = self.client.get('/api/notes/changes', query_string={'since': cursor, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.get_json()
+
+    def test_changes_since_listing(self):
+        """Test: The changes feed returns created, updated and removed notes only"""
+        [edited, hidden, deleted] = self.add_notes(self.bob_id, 3, 'read')
+        [untouched] = self.add_notes(self.alice_id, 1)
+        [bob_private] = self.add_notes(self.bob_id, 1)
+        self.login()
+        cursor = self.get_page()['changes_cursor']
+        self.assertEqual(self.changes(cursor)['notes'], [])
+
+        created = self.add_note(self.alice_id, 'Created')
+        with self.app.app_context():
+            db.session.get(Note, edited).title = 'Edited'
+            db.session.get(Note, hidden).visibility = 'private'
+            db.session.delete(db.session.get(Note, deleted))
+            db.session.get(Note, bob_private).title = 'Still private'
+            db.session.commit()
+
+        with self.count_queries() as statements:
+            changes = self.changes(cursor)
+        self.assertQueryCount(3, statements)
+        self.assertEqual({note['id']: note['title'] for note in changes['notes']}, {created: 'Created', edited: 'Edited'})
+        self.assertEqual(sorted(changes['removed']), [hidden, deleted])
+        self.assertFalse(changes['has_more'])
+
+        # Nothing new after the returned cursor
+        changes = self.changes(changes['next_cursor'])
+        self.assertEqual((changes['notes'], changes['removed']), ([], []))
+
+        # The owner still sees their note made private
+        self.login('bob')
+        cursor = self.get_page()['changes_cursor']
+        with self.app.app_context():
+            db.session.get(Note, untouched).title = 'Private edit'
+            db.session.commit()
+        self.assertEqual(self.changes(cursor)['notes'], [])
+
+    def test_changes_last_write_wins(self):
+        """Test: A note hidden then shared again comes back as a change"""
+        [note_id] = self.add_notes(self.bob_id, 1, 'read')
+        self.login()
+        cursor = self.get_page()['changes_cursor']
+        for visibility in ('private', 'write'):
+            with self.app.app_context():
+                db.session.get(Note, note_id).visibility = visibility
+                db.session.commit()
+
+        changes = self.changes(cursor, view='summary')
+        self.assertEqual([note['visibility'] for note in changes['notes']], ['write'])
+        self.assertEqual(changes['removed'], [])
+
+    def test_changes_are_paginated(self):
+        """Test: has_more and next_cursor page through many changes"""
+        self.login()
+        cursor = self.get_page()['changes_cursor']
+        self.bulk_write([{'title': f'Imported {i}', 'content': 'Content'} for i in range(7)])
+
+        seen = []
+        while True:
+            changes = self.changes(cursor, limit=3)
+            seen.extend(note['title'] for note in changes['notes'])
+            cursor = changes['next_cursor']
+            if not changes['has_more']:
+                break
+        self.assertEqual(seen, [f'Imported {i}' for i in range(7)])
+
+    def test_changes_cursor_from_another_database_expires(self):
+        """Test: A cursor from another node or an older database asks for a reload"""
+        self.login()
+        cursor = self.get_page()['changes_cursor']
+        reset_db()
+        self.setUp()
+        self.login()
+
+        response = self.client.get('/api/notes/changes', query_string={'since': cursor})
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(self.client.get('/api/notes/changes').status_code, 400)
+        self.assertEqual(self.client.get('/api/notes/changes?since=garbage').status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
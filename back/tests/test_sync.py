@@ -0,0 +1,946 @@
+# tests/test_sync.py
+"""
+Replication test suite for Notes application
+Tests: outbox, delivery to the replica, retries, batching, delta updates, wire format,
+LSN catch-up, read-your-writes, snapshots, anti-entropy, metrics
+"""
+
+import sys
+import os
+# Add parent folder to path to import app
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import unittest
+import gzip
+import io
+import json
+import threading
+import time
+import zlib
+from unittest import mock
+from urllib.parse import urlsplit
+
+import bcrypt
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from app import app, reset_db, limiter, create_app
+from models import db
+from models.user import User
+from models.note import Note
+from models.note_change import NoteTombstone
+from models.outbox import SyncOutbox
+from models.replica_state import ReplicaState
+from models.sync_dead_letter import SyncDeadLetter
+from services.delta_service import DeltaService
+from services.replica_client import ReplicaClient
+from services.merkle_service import MerkleService
+from services.note_service import NoteService
+from services.metrics import SYNC_OPERATIONS_APPLIED, SYNC_OPERATIONS_SENT, MetricsRegistry
+from services.replica_service import ReplicaService
+from services.snapshot_service import SnapshotService
+from services.sync_codec import JSON, MSGPACK, SyncCodec
+from services.sync_service import SyncService
+
+
+class FlaskClientAdapter(requests.adapters.BaseAdapter):
+    """Transport adapter handing replica requests to a Flask test client instead of the network"""
+
+    def __init__(self, client=None, error=None, delay=0):
+        super().__init__()
+        self.client = client
+        self.error = error
+        self.delay = delay
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        if self.client is None:
+            response.status_code = 200
+            response._content = b'{"success": true}'
+            return response
+
+        parts = urlsplit(request.url)
+        resp = self.client.open(parts.path, query_string=parts.query, method=request.method,
+                                data=request.body, headers=dict(request.headers))
+        response.status_code = resp.status_code
+        response._content = resp.data
+        response.headers = CaseInsensitiveDict(resp.headers)
+        return response
+
+    def close(self):
+        pass
+
+
+class SyncTestCase(unittest.TestCase):
+    """Master to replica replication tests"""
+
+    SYNC_TOKEN = 'sync-secret'
+    ADMIN_TOKEN = 'admin-secret'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_app = create_app('replica')
+        cls.replica_app.config['TESTING'] = True
+
+    def setUp(self):
+        self.app = app
+        self.app.config['TESTING'] = True
+        # Both nodes share the token the /api/sync endpoints require, and
+        # /api/admin requires its own
+        self.addCleanup(self.app.config.update, {key: self.app.config[key] for key in ('SYNC_TOKEN', 'ADMIN_TOKEN')})
+        for node in (self.app, self.replica_app):
+            node.config.update(SYNC_TOKEN=self.SYNC_TOKEN, ADMIN_TOKEN=self.ADMIN_TOKEN)
+        self.client = self.app.test_client()
+        self.replica_client = self.replica_app.test_client()
+        for client in (self.client, self.replica_client):
+            client.environ_base['HTTP_X_SYNC_TOKEN'] = self.SYNC_TOKEN
+        self.replica_urls = self.app.config['REPLICA_URLS']
+        self.replica = FlaskClientAdapter(self.replica_client)
+        self.connect_replicas(replica=self.replica)
+        limiter.reset()
+
+        with self.replica_app.app_context():
+            db.drop_all()
+            db.create_all()
+            MerkleService.invalidate_all()
+
+        with self.app.app_context():
+            reset_db()
+            MerkleService.invalidate_all()
+
+            pswd_hashed = bcrypt.hashpw('password123'.encode('utf-8'), bcrypt.gensalt(rounds=4)).decode('utf-8')
+            alice = User(nom='alice', pswd_hashed=pswd_hashed)
+            db.session.add(alice)
+            db.session.commit()
+            self.alice_id = alice.id
+
+            # Seed the replica with the same user, as if it had been replicated
+            self.replicate_user(alice)
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+        SyncService.close_clients()
+        SyncService._isolating.clear()
+        self.app.config['REPLICA_URLS'] = self.replica_urls
+        limiter.reset()
+
+    def connect_replicas(self, **adapters):
+        """Points the master at fake replicas named after the keyword arguments"""
+        SyncService.close_clients()
+        self.app.config['REPLICA_URLS'] = [f'http://{name}' for name in adapters]
+        with self.app.app_context():
+            for replica in SyncService.get_replicas():
+                replica.session.mount(replica.url, adapters[urlsplit(replica.url).hostname])
+
+    def replicate_user(self, user):
+        with self.replica_app.app_context():
+            db.session.add(User(id=user.id, nom=user.nom, pswd_hashed=user.pswd_hashed))
+            db.session.commit()
+
+    def login(self, username='alice', password='password123'):
+        return self.client.post('/api/login',
+            data=json.dumps({'username': username, 'password': password}),
+            content_type='application/json'
+        )
+
+    def create_note(self, title='Title', content='Content', visibility='private'):
+        response = self.client.post('/api/notes',
+            data=json.dumps({'title': title, 'content': content, 'visibility': visibility}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.data)['note']
+
+    def drain(self):
+        with self.app.app_context():
+            return SyncService.drain_outbox()
+
+    def sent(self, request):
+        """Payload of a request the master sent to a replica"""
+        return SyncCodec.decode(request.body, request.headers.get('Content-Type'), request.headers.get('Content-Encoding'))
+
+    # ===== TESTS OUTBOX =====
+
+    def test_write_does_not_wait_for_replica(self):
+        """Test: Creating a note never calls the replica inline"""
+        self.login()
+        self.create_note()
+        self.assertEqual(self.replica.requests, [])
+
+    def test_create_note_writes_outbox_entry(self):
+        """Test: The note and its outbox entry are committed together"""
+        self.login()
+        note = self.create_note(title='Outboxed')
+
+        with self.app.app_context():
+            entries = SyncOutbox.query.filter_by(operation='create_note').all()
+            self.assertEqual(len(entries), 1)
+            self.assertEqual(entries[0].payload['id'], note['id'])
+            self.assertEqual(entries[0].payload['title'], 'Outboxed')
+
+    def test_drain_delivers_to_replica(self):
+        """Test: Draining the outbox applies the changes on the replica in order"""
+        self.login()
+        note = self.create_note(title='First version')
+        self.edit_note(note['id'], 'Second version', 'Edited')
+
+        self.assertEqual(self.drain(), 2)
+
+        with self.app.app_context():
+            self.assertEqual(SyncOutbox.query.count(), 0)
+        with self.replica_app.app_context():
+            replica_note = db.session.get(Note, note['id'])
+            self.assertEqual(replica_note.title, 'Second version')
+            self.assertEqual(replica_note.content, 'Edited')
+            self.assertEqual(replica_note.version, 2)
+
+    def test_failed_send_is_kept_for_retry(self):
+        """Test: A replica failure keeps the entry and schedules a retry"""
+        self.login()
+        self.create_note()
+
+        self.replica.error = requests.ConnectionError('replica down')
+        self.assertEqual(self.drain(), 0)
+        # Backoff: an immediate second drain does not hammer the replica
+        self.assertEqual(self.drain(), 0)
+        self.assertEqual(len(self.replica.requests), 1)
+
+        with self.app.app_context():
+            self.assertEqual(SyncOutbox.query.count(), 1)
+            state = ReplicaState.query.one()
+            self.assertEqual(state.attempts, 1)
+            self.assertIn('replica down', state.last_error)
+            self.assertIsNotNone(state.next_attempt_at)
+
+            state.next_attempt_at = None
+            db.session.commit()
+
+        self.replica.error = None
+        self.assertEqual(self.drain(), 1)
+        with self.replica_app.app_context():
+            self.assertEqual(Note.query.count(), 1)
+
+    # ===== TESTS BATCHING =====
+
+    def test_coalesce_collapses_note_updates(self):
+        """Test: Updates of the same note collapse into the last one"""
+        entries = [
+            SyncOutbox(operation='create_note', payload={'id': 1, 'owner_id': 1, 'title': 'a', 'content': 'a', 'visibility': 'private'}),
+            SyncOutbox(operation='update_note', payload={'id': 2, 'title': 'b1', 'content': 'b1'}),
+            SyncOutbox(operation='update_note', payload={'id': 1, 'title': 'a2', 'content': 'a2'}),
+            SyncOutbox(operation='update_note', payload={'id': 2, 'title': 'b2', 'content': 'b2'}),
+        ]
+
+        operations = SyncService.coalesce(entries)
+
+        self.assertEqual([op['operation'] for op in operations], ['create_note', 'update_note'])
+        self.assertEqual(operations[0]['data']['title'], 'a2')
+        self.assertEqual(operations[1]['data']['title'], 'b2')
+        # The outbox payloads themselves are left untouched
+        self.assertEqual(entries[0].payload['title'], 'a')
+
+    def test_drain_sends_one_batch(self):
+        """Test: Several pending changes go out in a single request"""
+        self.login()
+        note = self.create_note(title='v1')
+        for version in ('v2', 'v3', 'v4'):
+            self.edit_note(note['id'], version, 'Edited')
+
+        self.assertEqual(self.drain(), 4)
+        self.assertEqual(len(self.replica.requests), 1)
+        sent = self.sent(self.replica.requests[0])['operations']
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['data']['title'], 'v4')
+
+        with self.replica_app.app_context():
+            self.assertEqual(db.session.get(Note, note['id']).title, 'v4')
+
+    def test_batch_endpoint_is_atomic(self):
+        """Test: A failing operation rolls back the whole batch"""
+        response = self.replica_client.post('/api/sync/batch', json={'operations': [
+            {'operation': 'create_note', 'data': {'id': 10, 'owner_id': self.alice_id, 'title': 't', 'content': 'c', 'visibility': 'read'}},
+            {'operation': 'update_note', 'data': {'id': 999, 'title': 't', 'content': 'c'}},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('operation 1', json.loads(response.data)['error'])
+
+        with self.replica_app.app_context():
+            self.assertIsNone(db.session.get(Note, 10))
+
+    # ===== TESTS DELTA UPDATES =====
+
+    def edit_note(self, note_id, title, content):
+        self.client.post(f'/api/notes/{note_id}/lock')
+        response = self.client.put(f'/api/notes/{note_id}/edit',
+            data=json.dumps({'title': title, 'content': content}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_delta_roundtrip(self):
+        """Test: A delta turns the old content into the new one"""
+        old = 'The quick brown fox jumps over the lazy dog. ' * 20
+        new = old.replace('lazy', 'sleepy', 3) + 'The end.'
+        delta = DeltaService.make_delta(old, new)
+        self.assertEqual(DeltaService.apply_delta(old, delta), new)
+        self.assertLess(DeltaService.delta_size(delta), len(new))
+        self.assertEqual(DeltaService.make_delta(old, old), [])
+
+    def test_delta_stays_cheap(self):
+        """Test: Nearby edits are diffed, repetitive or large regions become one edit without diffing"""
+        old = 'Meet at noon on Monday, bring the report and the slides.'
+        new = 'Meet at ten on Tuesday, bring the report and two slides.'
+        delta = DeltaService.make_delta(old, new)
+        self.assertGreater(len(delta), 1)
+        self.assertEqual(DeltaService.apply_delta(old, delta), new)
+
+        for old, new in ((('ab ' * 3000)[:9000], ('ba  ' * 3000)[:9000]), ('ab ' * 80, 'ba  ' * 60)):
+            started = time.perf_counter()
+            delta = DeltaService.make_delta(old, new)
+            self.assertLess(time.perf_counter() - started, 0.05)
+            self.assertEqual(len(delta), 1)
+            self.assertEqual(DeltaService.apply_delta(old, delta), new)
+
+    def test_update_is_sent_as_delta(self):
+        """Test: A small edit of a long note reaches the replica without its full content"""
+        self.login()
+        content = 'Lorem ipsum dolor sit amet. ' * 100
+        note = self.create_note(content=content)
+        self.drain()
+
+        self.edit_note(note['id'], 'Title', content + 'One more line.')
+        self.drain()
+
+        sent = self.sent(self.replica.requests[-1])['operations'][0]['data']
+        self.assertNotIn('content', sent)
+        self.assertEqual(len(sent['deltas']), 1)
+        with self.replica_app.app_context():
+            self.assertEqual(db.session.get(Note, note['id']).content, content + 'One more line.')
+
+    def test_collapsed_updates_chain_deltas(self):
+        """Test: Successive delta updates of a note are sent as one chain"""
+        self.login()
+        content = 'Lorem ipsum dolor sit amet. ' * 100
+        note = self.create_note(content=content)
+        self.drain()
+
+        self.edit_note(note['id'], 'Title', 'Start. ' + content)
+        self.edit_note(note['id'], 'Title', 'Start. ' + content + 'End.')
+        self.drain()
+
+        sent = self.sent(self.replica.requests[-1])['operations']
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(sent[0]['data']['deltas']), 2)
+        with self.replica_app.app_context():
+            self.assertEqual(db.session.get(Note, note['id']).content, 'Start. ' + content + 'End.')
+
+    def test_delta_mismatch_falls_back_to_full_content(self):
+        """Test: A replica whose content differs from the delta base gets the full content"""
+        self.login()
+        content = 'Lorem ipsum dolor sit amet. ' * 100
+        note = self.create_note(content=content)
+        self.drain()
+        with self.replica_app.app_context():
+            db.session.get(Note, note['id']).content = 'diverged'
+            db.session.commit()
+
+        self.edit_note(note['id'], 'Title', content + 'One more line.')
+        self.drain()
+
+        retried = [self.sent(request)['operations'][0]['data'] for request in self.replica.requests[-2:]]
+        self.assertIn('deltas', retried[0])
+        self.assertEqual(retried[1]['content'], content + 'One more line.')
+        self.assertNotIn('deltas', retried[1])
+        with self.replica_app.app_context():
+            self.assertEqual(db.session.get(Note, note['id']).content, content + 'One more line.')
+            self.assertEqual(db.session.get(Note, note['id']).version, 2)
+            self.assertEqual(ReplicaService.get_applied_lsn(), self.head_lsn())
+
+    def head_lsn(self):
+        with self.app.app_context():
+            return SyncService.get_head_lsn()
+
+    def bulk_write(self, notes):
+        response = self.client.post('/api/notes/bulk',
+            data=json.dumps({'notes': notes}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        return [result['id'] for result in response.get_json()['results']]
+
+    def test_bulk_write_is_one_replicated_operation(self):
+        """Test: A bulk write reaches the replica as a single operation"""
+        self.login()
+        note = self.create_note(title='Existing', visibility='read')
+        ids = self.bulk_write([{'title': f'Imported {i}', 'content': f'Content {i}'} for i in range(50)]
+                              + [{'id': note['id'], 'title': 'Renamed', 'content': 'Bulk edited'}])
+
+        self.drain()
+        [request] = self.replica.requests
+        operations = self.sent(request)['operations']
+        self.assertEqual([operation['operation'] for operation in operations], ['create_note', 'bulk_notes'])
+
+        with self.replica_app.app_context():
+            self.assertEqual(Note.query.count(), 51)
+            self.assertEqual(db.session.get(Note, ids[10]).title, 'Imported 10')
+            edited = db.session.get(Note, note['id'])
+            self.assertEqual((edited.title, edited.content, edited.version), ('Renamed', 'Bulk edited', 2))
+
+        # Redelivery is harmless
+        with self.replica_app.app_context():
+            ReplicaService.apply_batch(operations)
+            self.assertEqual(Note.query.count(), 51)
+
+    def test_update_after_bulk_write_is_not_folded_before_it(self):
+        """Test: Coalescing keeps a later update after the bulk write it follows"""
+        self.login()
+        note = self.create_note(title='v1')
+        self.bulk_write([{'id': note['id'], 'title': 'v2', 'content': 'Bulk'}])
+        self.edit_note(note['id'], title='v3', content='Single')
+
+        self.drain()
+        with self.replica_app.app_context():
+            replica_note = db.session.get(Note, note['id'])
+            self.assertEqual((replica_note.title, replica_note.content, replica_note.version), ('v3', 'Single', 3))
+
+    # ===== TESTS WIRE FORMAT =====
+
+    def test_batch_is_sent_as_compressed_msgpack(self):
+        """Test: Large batches go out as deflated msgpack and are applied by the replica"""
+        content = 'Lorem ipsum dolor sit amet. ' * 350 + 'End.'
+        self.login()
+        notes = [self.create_note(content=content) for _ in range(2)]
+        self.drain()
+
+        request = self.replica.requests[-1]
+        self.assertEqual(request.headers['Content-Type'], MSGPACK)
+        self.assertEqual(request.headers['Content-Encoding'], 'deflate')
+        self.assertLess(len(request.body), len(content) // 4)
+        with self.replica_app.app_context():
+            for note in notes:
+                self.assertEqual(db.session.get(Note, note['id']).content, content)
+
+    def test_replica_rejecting_msgpack_gets_json(self):
+        """Test: A replica answering 415 is switched to JSON"""
+        class JsonOnlyAdapter(FlaskClientAdapter):
+            def send(self, request, **kwargs):
+                if request.headers.get('Content-Type') != JSON:
+                    self.requests.append(request)
+                    response = requests.Response()
+                    response.status_code = 415
+                    response._content = b'{}'
+                    return response
+                return super().send(request, **kwargs)
+
+        replica = JsonOnlyAdapter(self.replica_client)
+        self.connect_replicas(replica=replica)
+        self.login()
+        self.create_note()
+        self.create_note()
+
+        self.assertEqual(self.drain(), 2)
+        self.assertEqual([r.headers['Content-Type'] for r in replica.requests], [MSGPACK, JSON])
+        with self.replica_app.app_context():
+            self.assertEqual(Note.query.count(), 2)
+
+    def test_sync_responses_follow_accept_header(self):
+        """Test: Sync endpoints answer msgpack only to callers asking for it"""
+        response = self.replica_client.post('/api/sync/merkle', json={'ranges': []})
+        self.assertEqual(response.mimetype, JSON)
+
+        body = SyncCodec.encode({'ranges': [[0, 256]]}, MSGPACK)
+        response = self.replica_client.post('/api/sync/merkle', data=body,
+            headers={'Content-Type': MSGPACK, 'Accept': SyncCodec.accept_header()})
+        self.assertEqual(response.mimetype, MSGPACK)
+        self.assertEqual(len(SyncCodec.decode(response.data, response.mimetype)['hashes']), 1)
+
+        response = self.replica_client.post('/api/sync/batch', data=b'\x00', headers={'Content-Type': 'text/plain'})
+        self.assertEqual(response.status_code, 415)
+
+    def test_compressed_body_size_is_capped(self):
+        """Test: A body inflating beyond SYNC_MAX_BODY_BYTES is refused without being expanded"""
+        self.addCleanup(self.replica_app.config.update, {'SYNC_MAX_BODY_BYTES': self.replica_app.config['SYNC_MAX_BODY_BYTES']})
+        self.replica_app.config['SYNC_MAX_BODY_BYTES'] = 1024
+        bomb = zlib.compress(b'{"operations": [' + b' ' * (64 * 1024 * 1024) + b']}', 9)
+        for encoding, body in (('deflate', bomb), ('gzip', gzip.compress(b' ' * 4096))):
+            response = self.replica_client.post('/api/sync/batch', data=body,
+                headers={'Content-Type': JSON, 'Content-Encoding': encoding})
+            self.assertEqual(response.status_code, 413)
+
+        body = zlib.compress(b'{"operations": []}')
+        response = self.replica_client.post('/api/sync/batch', data=body[:-4],
+            headers={'Content-Type': JSON, 'Content-Encoding': 'deflate'})
+        self.assertEqual(response.status_code, 400)
+        response = self.replica_client.post('/api/sync/batch', data=body,
+            headers={'Content-Type': JSON, 'Content-Encoding': 'deflate'})
+        self.assertEqual(response.status_code, 200)
+
+    # ===== TESTS MULTIPLE REPLICAS =====
+
+    def test_replica_timeouts_from_url(self):
+        """Test: Timeouts can be overridden per replica"""
+        replica = ReplicaClient.from_spec('http://replica-2:5001?connect_timeout=0.5&read_timeout=30', 2, 10)
+        self.assertEqual(replica.url, 'http://replica-2:5001')
+        self.assertEqual(replica.timeout, (0.5, 30.0))
+        self.assertEqual(ReplicaClient.from_spec('http://replica-3:5001', 2, 10).timeout, (2, 10))
+
+    def test_dead_replica_does_not_block_others(self):
+        """Test: Each replica progresses on its own; entries are kept until all have them"""
+        dead = FlaskClientAdapter(error=requests.ConnectionError('replica down'))
+        self.connect_replicas(replica=self.replica, dead=dead)
+        self.login()
+        note = self.create_note()
+
+        self.assertEqual(self.drain(), 1)
+        with self.replica_app.app_context():
+            self.assertIsNotNone(db.session.get(Note, note['id']))
+        with self.app.app_context():
+            self.assertEqual(SyncOutbox.query.count(), 1)
+            ReplicaState.query.filter_by(url='http://dead').update({'next_attempt_at': None})
+            db.session.commit()
+
+        dead.error = None
+        self.assertEqual(self.drain(), 1)
+        with self.app.app_context():
+            self.assertEqual(SyncOutbox.query.count(), 0)
+
+    def test_fanout_is_parallel(self):
+        """Test: Replication time is bounded by the slowest replica, not the sum"""
+        self.connect_replicas(slow1=FlaskClientAdapter(delay=0.3), slow2=FlaskClientAdapter(delay=0.3))
+        self.login()
+        self.create_note()
+
+        started = time.monotonic()
+        self.assertEqual(self.drain(), 2)
+        self.assertLess(time.monotonic() - started, 0.55)
+
+    # ===== TESTS LSN / CATCH-UP =====
+
+    def replica_lsn(self):
+        with self.replica_app.app_context():
+            return ReplicaService.get_applied_lsn()
+
+    def test_replica_persists_applied_lsn(self):
+        """Test: The replica records the position of the last change it applied"""
+        self.login()
+        self.create_note()
+        self.create_note()
+        self.drain()
+
+        with self.app.app_context():
+            head = SyncService.get_head_lsn()
+        self.assertEqual(self.replica_lsn(), head)
+
+    def test_redelivered_batch_is_idempotent(self):
+        """Test: Resending already applied changes is harmless"""
+        batch = {
+            'operations': [{'operation': 'create_note', 'lsn': 1, 'data': {
+                'id': 10, 'owner_id': self.alice_id, 'title': 't', 'content': 'c', 'visibility': 'read'}}],
+            'from_lsn': 0,
+            'to_lsn': 1,
+        }
+        self.assertEqual(self.replica_client.post('/api/sync/batch', json=batch).status_code, 200)
+        response = self.replica_client.post('/api/sync/batch', json=batch)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['applied'], 0)
+
+    def test_gap_makes_master_resend(self):
+        """Test: A replica missing earlier changes gets them resent"""
+        self.login()
+        first = self.create_note(title='first')
+        with self.app.app_context():
+            # The master believes the first change was delivered but the replica lost it
+            db.session.add(ReplicaState(url='http://replica', last_sent_id=SyncService.get_head_lsn(), attempts=0))
+            db.session.commit()
+        second = self.create_note(title='second')
+
+        self.drain()
+
+        with self.replica_app.app_context():
+            self.assertIsNotNone(db.session.get(Note, first['id']))
+            self.assertIsNotNone(db.session.get(Note, second['id']))
+
+    def test_rejected_change_is_dead_lettered(self):
+        """Test: A change the replica keeps rejecting is skipped, the others get through"""
+        self.addCleanup(self.app.config.update, {'SYNC_DEAD_LETTER_ATTEMPTS': self.app.config['SYNC_DEAD_LETTER_ATTEMPTS']})
+        self.app.config['SYNC_DEAD_LETTER_ATTEMPTS'] = 2
+        self.login()
+        lost = self.create_note(title='lost')
+        self.drain()
+        with self.replica_app.app_context():
+            # The replica cannot apply updates of a note it no longer has
+            db.session.delete(db.session.get(Note, lost['id']))
+            db.session.commit()
+
+        before = self.create_note(title='before')
+        self.edit_note(lost['id'], 'edited', 'Edited')
+        after = self.create_note(title='after')
+
+        self.assertEqual(self.drain(), 1)
+        with self.replica_app.app_context():
+            self.assertIsNotNone(db.session.get(Note, before['id']))
+            self.assertIsNone(db.session.get(Note, after['id']))
+        with self.app.app_context():
+            ReplicaState.query.update({'next_attempt_at': None})
+            db.session.commit()
+
+        self.assertEqual(self.drain(), 1)
+        with self.replica_app.app_context():
+            self.assertIsNotNone(db.session.get(Note, after['id']))
+        with self.app.app_context():
+            dead = SyncDeadLetter.query.one()
+            self.assertEqual(dead.operation, 'update_note')
+            self.assertEqual(dead.payload['id'], lost['id'])
+            self.assertEqual(SyncOutbox.query.count(), 0)
+            self.assertEqual(self.replica_lsn(), SyncService.get_head_lsn())
+            self.assertEqual(ReplicaState.query.one().attempts, 0)
+        self.assertIn('sync_dead_letters_total{replica="http://replica"} 1', self.scrape())
+
+    def test_reconcile_repairs_stuck_replica(self):
+        """Test: Anti-entropy skips a replica that is catching up, not one that is stuck"""
+        self.login()
+        note = self.create_note()
+        with self.app.app_context():
+            replica = SyncService.get_replicas()[0]
+            self.assertEqual(MerkleService.reconcile(replica), [])
+
+            db.session.add(ReplicaState(url=replica.url, last_sent_id=0,
+                                        attempts=self.app.config['SYNC_DEAD_LETTER_ATTEMPTS']))
+            db.session.commit()
+            self.assertNotEqual(MerkleService.reconcile(replica), [])
+        with self.replica_app.app_context():
+            self.assertIsNotNone(db.session.get(Note, note['id']))
+
+    def test_replica_added_after_pruning_reports_the_gap(self):
+        """Test: A new empty replica is not sent changes that skip the pruned ones"""
+        self.login()
+        self.create_note(title='pruned')
+        self.drain()
+        with self.app.app_context():
+            pruned = SyncService.get_pruned_lsn()
+            self.assertGreater(pruned, 0)
+
+        with self.replica_app.app_context():
+            db.drop_all()
+            db.create_all()
+        with self.app.app_context():
+            self.replicate_user(db.session.get(User, self.alice_id))
+        self.connect_replicas(replica=self.replica, late=FlaskClientAdapter(self.replica_client))
+        self.create_note(title='after')
+
+        self.drain()
+        with self.replica_app.app_context():
+            self.assertEqual(Note.query.count(), 0)
+        with self.app.app_context():
+            late = db.session.get(ReplicaState, 'http://late')
+            self.assertEqual(late.last_sent_id, pruned)
+            self.assertEqual(late.attempts, 1)
+
+    def test_since_streams_missing_range(self):
+        """Test: The master streams only the changes after the given LSN"""
+        self.login()
+        self.create_note(title='first')
+        self.create_note(title='second')
+        with self.app.app_context():
+            head = SyncService.get_head_lsn()
+
+        response = self.client.get(f'/api/sync/since/{head - 1}')
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([line['lsn'] for line in lines], [head])
+        self.assertEqual(lines[0]['data']['title'], 'second')
+
+    def test_since_pruned_range_is_gone(self):
+        """Test: Asking for changes that were pruned from the log fails explicitly"""
+        self.login()
+        self.create_note()
+        self.drain()
+
+        response = self.client.get('/api/sync/since/0')
+        self.assertEqual(response.status_code, 410)
+
+    def test_replica_catches_up_on_startup(self):
+        """Test: A replica pulls the changes it missed from the master"""
+        self.login()
+        note = self.create_note(title='missed')
+
+        def get(url, **kwargs):
+            resp = self.client.get(urlsplit(url).path)
+            response = requests.Response()
+            response.status_code = resp.status_code
+            response.raw = io.BytesIO(resp.data)
+            return response
+
+        with self.replica_app.app_context():
+            with mock.patch('services.replica_service.requests.get', side_effect=get):
+                self.assertEqual(ReplicaService.catch_up(), 1)
+            self.assertEqual(db.session.get(Note, note['id']).title, 'missed')
+
+        with self.app.app_context():
+            head = SyncService.get_head_lsn()
+        self.assertEqual(self.replica_lsn(), head)
+
+    # ===== TESTS READ-YOUR-WRITES =====
+
+    def replica_get(self, path, position):
+        """GET on the replica with alice's session and a replication position"""
+        token = self.client.get_cookie('access_token_cookie', path='/api/').value
+        self.replica_client.set_cookie('access_token_cookie', token, path='/api/')
+        return self.replica_client.get(path, headers={'X-Replication-Position': str(position)})
+
+    def test_write_returns_replication_position(self):
+        """Test: Writes return the log position to read them back from a replica"""
+        response = self.login()
+        self.assertNotIn('X-Replication-Position', response.headers)
+
+        response = self.client.post('/api/notes',
+            data=json.dumps({'title': 't', 'content': 'c', 'visibility': 'private'}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.headers['X-Replication-Position'], str(self.head_lsn()))
+        self.assertEqual(self.client.get_cookie('replication_position', path='/api/').value, str(self.head_lsn()))
+
+    def test_lagging_replica_redirects_read_to_master(self):
+        """Test: A replica that has not applied the position sends the read to the master"""
+        self.addCleanup(self.replica_app.config.update, {'READ_WAIT_SECONDS': self.replica_app.config['READ_WAIT_SECONDS']})
+        self.replica_app.config['READ_WAIT_SECONDS'] = 0
+        self.login()
+        note = self.create_note()
+
+        response = self.replica_get(f"/api/notes/{note['id']}", self.head_lsn())
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(response.headers['Location'], f"{self.replica_app.config['MASTER_URL']}/api/notes/{note['id']}")
+
+        self.drain()
+        response = self.replica_get(f"/api/notes/{note['id']}", self.head_lsn())
+        self.assertEqual(response.status_code, 200)
+
+    def test_replica_read_waits_for_position(self):
+        """Test: A read waits for the replica to apply the position it carries"""
+        self.login()
+        self.create_note(title='fresh')
+        position = self.head_lsn()
+
+        drainer = threading.Timer(0.1, self.drain)
+        drainer.start()
+        self.addCleanup(drainer.join)
+        response = self.replica_get('/api/notes', position)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([note['title'] for note in json.loads(response.data)['notes']], ['fresh'])
+
+    # ===== TESTS SNAPSHOTS =====
+
+    def test_snapshot_seeds_replica(self):
+        """Test: A gzip snapshot from the master rebuilds the replica and its LSN"""
+        self.login()
+        notes = [self.create_note(title=f'note {i}', visibility='read') for i in range(5)]
+        with self.app.app_context():
+            head = SyncService.get_head_lsn()
+
+        response = self.client.get('/api/sync/snapshot?compress=gzip&chunk_size=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/gzip')
+        lines = gzip.decompress(response.data).decode('utf-8').splitlines()
+        self.assertEqual(json.loads(lines[0])['lsn'], head)
+
+        with self.replica_app.app_context():
+            counts = SnapshotService.load(lines, commit_rows=2)
+            self.assertEqual(counts['users'], 1)
+            self.assertEqual(counts['notes'], 5)
+            self.assertEqual(Note.query.count(), 5)
+            self.assertEqual(db.session.get(Note, notes[-1]['id']).title, 'note 4')
+            self.assertEqual(ReplicaService.get_applied_lsn(), head)
+
+    def test_snapshot_reseeds_replica_without_tombstones(self):
+        """Test: Reloading a replica that holds data resets its search index and changes feed"""
+        self.login()
+        stale = self.create_note(title='stale', content='obsolete')
+        self.drain()
+        with self.replica_app.app_context():
+            epoch = NoteService.changes_head()[0]
+        with self.app.app_context():
+            db.session.delete(db.session.get(Note, stale['id']))
+            db.session.commit()
+        fresh = self.create_note(title='fresh', content='current')
+        lines = list(self.client.get('/api/sync/snapshot').response)
+
+        def search(word):
+            return [row[0] for row in db.session.execute(
+                db.text("SELECT rowid FROM notes_fts WHERE notes_fts MATCH :word"), {'word': word})]
+
+        with self.replica_app.app_context():
+            SnapshotService.load(lines)
+            self.assertEqual(NoteTombstone.query.count(), 0)
+            self.assertNotEqual(NoteService.changes_head()[0], epoch)
+            self.assertEqual(search('obsolete'), [])
+            self.assertEqual(search('current'), [fresh['id']])
+
+            # The delete triggers are back in place
+            db.session.delete(db.session.get(Note, fresh['id']))
+            db.session.commit()
+            self.assertEqual(NoteTombstone.query.count(), 1)
+            self.assertEqual(search('current'), [])
+
+    def test_sync_token_required(self):
+        """Test: Node-to-node endpoints reject calls without the shared token"""
+        client = self.app.test_client()
+        self.assertEqual(client.get('/api/sync/snapshot').status_code, 403)
+        self.assertEqual(client.get('/api/sync/snapshot', headers={'X-Sync-Token': 'wrong'}).status_code, 403)
+        response = client.get('/api/sync/snapshot', headers={'X-Sync-Token': self.SYNC_TOKEN})
+        self.assertEqual(response.status_code, 200)
+
+    def test_sync_endpoints_closed_without_a_token(self):
+        """Test: With no SYNC_TOKEN configured, every sync call is refused"""
+        self.app.config['SYNC_TOKEN'] = None
+        self.assertEqual(self.app.test_client().get('/api/sync/since/0').status_code, 403)
+        self.assertEqual(self.client.get('/api/sync/snapshot', headers={'X-Sync-Token': ''}).status_code, 403)
+
+    # ===== TESTS ANTI-ENTROPY =====
+
+    def test_merkle_reconcile_repairs_only_differing_ranges(self):
+        """Test: Divergent notes are found through the hash tree and re-synced"""
+        for node in (self.app, self.replica_app):
+            self.addCleanup(node.config.update, {key: node.config[key] for key in ('MERKLE_BUCKET_SIZE', 'MERKLE_FANOUT')})
+            node.config.update(MERKLE_BUCKET_SIZE=4, MERKLE_FANOUT=4)
+        self.login()
+        notes = [self.create_note(title=f'note {i}', visibility='read') for i in range(40)]
+        self.drain()
+
+        with self.replica_app.app_context():
+            db.session.get(Note, notes[5]['id']).content = 'diverged'
+            db.session.delete(db.session.get(Note, notes[30]['id']))
+            db.session.commit()
+
+        with self.app.app_context():
+            replica = SyncService.get_replicas()[0]
+            repaired = MerkleService.reconcile(replica)
+
+            self.assertEqual(len(repaired), 2)
+            for lo, hi in repaired:
+                self.assertEqual(hi - lo, 4)
+            # Converged: the next pass finds nothing to repair
+            self.assertEqual(MerkleService.reconcile(replica), [])
+
+        with self.replica_app.app_context():
+            self.assertEqual(db.session.get(Note, notes[5]['id']).content, 'Content')
+            self.assertIsNotNone(db.session.get(Note, notes[30]['id']))
+            self.assertEqual(Note.query.count(), 40)
+
+    def test_merkle_cache_follows_writes(self):
+        """Test: Cached leaf hashes are invalidated when a note changes"""
+        self.login()
+        note = self.create_note()
+        with self.app.app_context():
+            before = MerkleService.range_hashes([(0, 1024)])
+            db.session.get(Note, note['id']).title = 'changed'
+            db.session.commit()
+            self.assertNotEqual(MerkleService.range_hashes([(0, 1024)]), before)
+
+    def test_replica_feed_follows_replicated_writes(self):
+        """Test: Applying replicated changes refreshes the replica's cached public feed"""
+        self.login()
+        note = self.create_note(title='First version', visibility='read')
+        self.drain()
+        response = self.replica_get('/api/notes', 0)
+        self.assertEqual([note['title'] for note in json.loads(response.data)['notes']], ['First version'])
+
+        self.client.post(f"/api/notes/{note['id']}/lock")
+        self.client.put(f"/api/notes/{note['id']}/edit",
+            data=json.dumps({'title': 'Second version', 'content': 'Edited'}),
+            content_type='application/json'
+        )
+        self.drain()
+        response = self.replica_get('/api/notes', 0)
+        self.assertEqual([note['title'] for note in json.loads(response.data)['notes']], ['Second version'])
+
+
+    # ===== TESTS METRICS =====
+
+    def scrape(self, client=None):
+        response = (client or self.client).get('/api/admin/metrics',
+            headers={'Authorization': f'Bearer {self.ADMIN_TOKEN}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        return response.data.decode()
+
+    def test_metrics_count_sent_and_applied_operations(self):
+        """Test: Delivered and applied changes show up in the metrics of both nodes"""
+        sent = SYNC_OPERATIONS_SENT.value(replica='http://replica')
+        applied = SYNC_OPERATIONS_APPLIED.value(operation='create_note')
+        self.login()
+        self.create_note()
+        self.create_note()
+        self.drain()
+
+        self.assertEqual(SYNC_OPERATIONS_SENT.value(replica='http://replica'), sent + 2)
+        self.assertEqual(SYNC_OPERATIONS_APPLIED.value(operation='create_note'), applied + 2)
+        master = self.scrape()
+        self.assertIn('sync_replica_pending_operations{replica="http://replica"} 0', master)
+        self.assertIn('sync_bytes_sent_total{replica="http://replica"}', master)
+        replica = self.scrape(self.replica_client)
+        self.assertIn('sync_apply_duration_seconds_count{operation="create_note"}', replica)
+        self.assertIn(f'sync_applied_lsn {self.head_lsn()}', replica)
+
+    def test_metrics_show_replica_backlog(self):
+        """Test: Undelivered changes and their age are reported per replica"""
+        self.login()
+        self.create_note()
+        self.replica.error = requests.ConnectionError('replica down')
+        self.drain()
+        self.create_note()
+
+        with self.app.app_context():
+            pending, age = SyncService.backlog()['http://replica']
+        self.assertEqual(pending, 2)
+        self.assertGreaterEqual(age, 0)
+        self.assertIn('sync_replica_pending_operations{replica="http://replica"} 2', self.scrape())
+        self.assertIn('sync_outbox_depth 2', self.scrape())
+        self.assertIn('sync_send_failures_total{replica="http://replica"}', self.scrape())
+
+    def test_metrics_require_admin_token(self):
+        """Test: The metrics endpoint is closed without the admin token"""
+        self.assertEqual(self.client.get('/api/admin/metrics').status_code, 403)
+        response = self.client.get('/api/admin/metrics', headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get('/api/admin/metrics', headers={'Authorization': f'Bearer {self.ADMIN_TOKEN}'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_metrics_closed_without_a_token(self):
+        """Test: With no ADMIN_TOKEN configured, the metrics are not served"""
+        self.app.config['ADMIN_TOKEN'] = None
+        response = self.client.get('/api/admin/metrics', headers={'Authorization': 'Bearer None'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_metrics_text_format(self):
+        """Test: Counters and histograms render in the Prometheus text format"""
+        registry = MetricsRegistry()
+        registry.counter('requests_total', 'Requests', ['path']).inc(2, path='/a"b')
+        registry.histogram('latency_seconds', 'Latency', buckets=[0.1, 1]).observe(0.5)
+
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{path="/a\\"b"} 2',
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 0',
+            'latency_seconds_bucket{le="1"} 1',
+            'latency_seconds_bucket{le="+Inf"} 1',
+            'latency_seconds_sum 0.5',
+            'latency_seconds_count 1',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
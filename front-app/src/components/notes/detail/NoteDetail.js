@@ -3,10 +3,14 @@ import './NoteDetail.css';
 import { escapeHtml } from '../../../utils/security';
 import { Link, useNavigate } from 'react-router-dom';
 
+// Longest wait accepted by the server (LOCK_WAIT_MAX_SECONDS)
+const LOCK_WAIT_SECONDS = 30;
+
 const NoteDetail = ({ noteId, userId, onBack }) => {
     const [note, setNote] = useState(null);
     const [loading, setLoading] = useState(true);
     const [error, setError] = useState(null);
+    const [waiting, setWaiting] = useState(false);
     const navigate = useNavigate();
 
     useEffect(() => {
@@ -48,6 +52,28 @@ const NoteDetail = ({ noteId, userId, onBack }) => {
         }
     }
 
+    // One long request in the note's queue instead of retrying until the lock is free
+    const waitForLock = async () => {
+        setWaiting(true);
+        try {
+            const response = await fetch(`http://localhost:5000/api/notes/${noteId}/lock?wait=${LOCK_WAIT_SECONDS}`, {
+                method: 'POST',
+                credentials: 'include'
+            });
+            if (response.ok) {
+                navigate(`/notes/${noteId}/edit/`);
+            } else if (response.status === 429) {
+                setError('Too many editors are waiting for this note, try again later');
+            } else {
+                fetchNoteDetail();
+            }
+        } catch (err) {
+            console.error('Error waiting for the lock:', err);
+        } finally {
+            setWaiting(false);
+        }
+    }
+
     if (loading) {
         return <div className="note-detail-loading">Loading note...</div>;
     }
@@ -139,6 +165,9 @@ const NoteDetail = ({ noteId, userId, onBack }) => {
                 {(note.access_level === 'write' && note.lock.locked) && (
                     <div className="read-only-notice">
                         This note is currently locked by another user. You cannot edit it at the moment.
+                        <button className="wait-lock-btn" onClick={waitForLock} disabled={waiting}>
+                            {waiting ? 'Waiting for the lock...' : 'Edit when available'}
+                        </button>
                     </div>
                 )}
 
@@ -8,15 +8,28 @@ const NotesList = ({ userId, onSelectNote }) => {
     const [loading, setLoading] = useState(true);
     const [error, setError] = useState(null);
     const [filter, setFilter] = useState('all');
+    const [nextCursor, setNextCursor] = useState(null);
+    const [loadingMore, setLoadingMore] = useState(false);
+    const [changesCursor, setChangesCursor] = useState(null);
+    const [refreshing, setRefreshing] = useState(false);
 
     useEffect(() => {
         fetchNotes();
     }, [userId]);
 
-    const fetchNotes = async () => {
+    // Without a cursor, reloads the first page; with one, appends the next page
+    const fetchNotes = async (cursor = null) => {
         try {
-            setLoading(true);
-            const response = await fetch('http://localhost:5000/api/notes', {
+            if (cursor) {
+                setLoadingMore(true);
+            } else {
+                setLoading(true);
+            }
+            // The cards only show a preview, not the full content
+            const query = `?view=summary${cursor ? `&cursor=${encodeURIComponent(cursor)}` : ''}`;
+            // Served by the replica: the replication_position cookie set by the master
+            // after our own writes makes it wait for them (or redirect to the master)
+            const response = await fetch(`http://localhost:5001/api/notes${query}`, {
                 method: 'GET',
                 credentials: 'include'  // Important: sends cookies automatically
             });
@@ -29,7 +42,11 @@ const NotesList = ({ userId, onSelectNote }) => {
             const data = await response.json();
 
             if (data.success) {
-                setNotes(data.notes);
+                setNotes(previous => cursor ? [...previous, ...data.notes] : data.notes);
+                setNextCursor(data.next_cursor);
+                if (!cursor) {
+                    setChangesCursor(data.changes_cursor);
+                }
                 setError(null);
             } else {
                 setError(data.error);
@@ -39,6 +56,64 @@ const NotesList = ({ userId, onSelectNote }) => {
             console.error('Error fetching notes:', err);
         } finally {
             setLoading(false);
+            setLoadingMore(false);
+        }
+    };
+
+    // Applies what changed since the last load instead of reloading every note
+    const refreshNotes = async () => {
+        if (!changesCursor) {
+            fetchNotes();
+            return;
+        }
+        try {
+            setRefreshing(true);
+            let cursor = changesCursor;
+            let hasMore = true;
+            while (hasMore) {
+                const response = await fetch(
+                    `http://localhost:5001/api/notes/changes?view=summary&since=${encodeURIComponent(cursor)}`,
+                    { method: 'GET', credentials: 'include' }
+                );
+
+                if (response.status === 401) {
+                    window.location.href = '/login';
+                    return;
+                }
+                // Cursor from another server or an older database
+                if (response.status === 410) {
+                    fetchNotes();
+                    return;
+                }
+
+                const data = await response.json();
+                if (!data.success) {
+                    setError(data.error);
+                    return;
+                }
+
+                setNotes(previous => {
+                    const changed = new Map(data.notes.map(note => [note.id, note]));
+                    const removed = new Set(data.removed);
+                    const kept = previous
+                        .filter(note => !removed.has(note.id))
+                        .map(note => changed.get(note.id) || note);
+                    const known = new Set(previous.map(note => note.id));
+                    // Notes older than the loaded pages arrive with "Load more"
+                    const oldest = previous.length ? previous[previous.length - 1].id : 0;
+                    const added = data.notes.filter(note => !known.has(note.id) && (!nextCursor || note.id > oldest));
+                    return [...added, ...kept].sort((a, b) => b.id - a.id);
+                });
+                cursor = data.next_cursor;
+                hasMore = data.has_more;
+            }
+            setChangesCursor(cursor);
+            setError(null);
+        } catch (err) {
+            setError('Server connection error');
+            console.error('Error refreshing notes:', err);
+        } finally {
+            setRefreshing(false);
         }
     };
 
@@ -67,7 +142,7 @@ const NotesList = ({ userId, onSelectNote }) => {
         return (
             <div className="notes-error">
                 <p>Error: {error}</p>
-                <button onClick={fetchNotes}>Retry</button>
+                <button onClick={() => fetchNotes()}>Retry</button>
             </div>
         );
     }
@@ -78,7 +153,9 @@ const NotesList = ({ userId, onSelectNote }) => {
                 <h2>My Notes</h2>
                 <div className="notes-actions">
                     <NewNoteButton userId={userId} />
-                    <button className="refresh-btn" onClick={fetchNotes}>Refresh</button>
+                    <button className="refresh-btn" onClick={refreshNotes} disabled={refreshing}>
+                        {refreshing ? 'Refreshing...' : 'Refresh'}
+                    </button>
                 </div>
 
             </div>
@@ -121,7 +198,7 @@ const NotesList = ({ userId, onSelectNote }) => {
                                 {getAccessBadge(note)}
                             </div>
                             <div className="note-card-content">
-                                <p>{note.content.substring(0, 100)}...</p>
+                                <p>{note.preview.substring(0, 100)}...</p>
                             </div>
                             <div className="note-card-footer">
                                 <span className="note-owner">{note.owner_name}</span>
@@ -133,6 +210,16 @@ const NotesList = ({ userId, onSelectNote }) => {
                     ))}
                 </div>
             )}
+
+            {nextCursor && (
+                <button
+                    className="load-more-btn"
+                    onClick={() => fetchNotes(nextCursor)}
+                    disabled={loadingMore}
+                >
+                    {loadingMore ? 'Loading...' : 'Load more'}
+                </button>
+            )}
         </div>
     );
 };
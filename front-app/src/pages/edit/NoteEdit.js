@@ -2,6 +2,9 @@ import { useEffect, useState } from "react";
 import { useNavigate, useParams } from "react-router-dom";
 import "./NoteEdit.css";
 
+// Well under the server's lock lease (LOCK_LEASE_SECONDS, 5 minutes by default)
+const LOCK_RENEW_INTERVAL_MS = 60 * 1000;
+
 export default function NoteEdit() {
 
     const navigate = useNavigate();
@@ -36,6 +39,29 @@ export default function NoteEdit() {
         checkRights();
     }, [navigate, noteId]);
 
+    // The lock is a lease: renew it while the editor is open
+    const isLoaded = note !== null;
+    useEffect(() => {
+        if (!isLoaded) {
+            return;
+        }
+        const heartbeat = setInterval(async () => {
+            try {
+                const response = await fetch(`http://localhost:5000/api/notes/${noteId}/lock/renew`, {
+                    method: 'POST',
+                    credentials: 'include'
+                });
+                if (response.status === 409) {
+                    setMessage("Your edit lock expired. Reload the note before saving.");
+                    clearInterval(heartbeat);
+                }
+            } catch (error) {
+                // Retried on the next beat, well before the lease runs out
+            }
+        }, LOCK_RENEW_INTERVAL_MS);
+        return () => clearInterval(heartbeat);
+    }, [isLoaded, noteId]);
+
     const saveNote = async () => {
         setIsSaving(true);
         setMessage("");
@@ -56,6 +82,8 @@ export default function NoteEdit() {
                 setTimeout(() => {
                     navigate(`/`);
                 }, 1200);
+            } else if (response.status === 409) {
+                setMessage("Your edit lock expired. Reload the note before saving.");
             } else {
                 setMessage("Failed to save note.");
             }
@@ -9,6 +9,11 @@ if not exist ".venv" (
 call .venv\Scripts\activate
 pip install -r .\requirements.txt
 
+REM Master and replica must share SYNC_TOKEN: generate one unless .env sets it
+if not defined SYNC_TOKEN (
+    findstr /b /r /c:"SYNC_TOKEN=." .env >nul 2>&1 || for /f %%t in ('python -c "import secrets; print(secrets.token_hex(16))"') do set SYNC_TOKEN=%%t
+)
+
 REM Start master and replica servers
 start cmd /k ".venv\Scripts\activate && .\scripts\windows\run_master.bat"
 start cmd /k ".venv\Scripts\activate && .\scripts\windows\run_replica.bat"
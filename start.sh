@@ -26,6 +26,11 @@ echo "Installing dependencies..."
 python -m pip install python-dotenv
 python -m pip install -r requirements.txt
 
+# Master and replica must share SYNC_TOKEN: generate one unless .env sets it
+if [ -z "$SYNC_TOKEN" ] && ! grep -qs '^SYNC_TOKEN=.' .env; then
+    export SYNC_TOKEN=$(python -c "import secrets; print(secrets.token_hex(16))")
+fi
+
 # --- Start Backend Servers ---
 
 echo "Starting Master Server..."